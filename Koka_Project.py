@@ -1,8 +1,24 @@
 import pygame as pg
+import numpy as np
 import sys
 import os
 import math
 import random
+import time
+import copy
+import gc
+import csv
+import io
+import json
+import pickle
+import struct
+import zlib
+import argparse
+import itertools
+import mmap
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Set, List, Tuple
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -10,7 +26,8 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 # 画面設定
 SCREEN_WIDTH = 600
 SCREEN_HEIGHT = 800
-FPS = 60
+FPS = 60  # ゲームの進行は常に60ティック/秒
+MAX_RENDER_FPS = 144  # 描画フレームレートの上限 (高リフレッシュレートのディスプレイ向け)
 
 # 色の定義
 BLACK = (0, 0, 0)
@@ -21,6 +38,451 @@ BLUE = (0, 0, 255)
 YELLOW = (255, 255, 0)
 
 
+# スケール済み画像のバンドル (python Koka_Project.py build-bundle で作る)
+BUNDLE_PATH = "data/assets.bundle"
+
+
+class AssetBundle:
+    """
+    スケール済みの画像のピクセルを1つにまとめたファイル
+    実行時はファイルをメモリマップし、Surface はマップしたバッファをそのまま使う (デコード・スケール・コピーなし)
+    索引は (パス, サイズ, alpha) ごとに元ファイルの大きさと更新時刻を持ち、元ファイルが変わった画像は使わない
+    ファイルの中身: MAGIC, 索引長, 索引 (JSON), 画像ごとのピクセル (BGRA)
+    ピクセルの部分は索引の後ろの ALIGN バイト境界から始まり、索引の offset はそこからの位置 (これも ALIGN の倍数)
+    """
+    MAGIC = b"KOKABUNDLE1"
+    ALIGN = 64
+
+    def __init__(self, path: str):
+        """ バンドルを開く (無い・壊れている場合は OSError / ValueError) """
+        with open(path, "rb") as f:
+            # 書き込み時コピー: 共有 Surface を誤って書き換えてもファイルには影響せず、その時だけページがコピーされる
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"バンドルファイルではありません: {path}")
+        offset = len(self.MAGIC)
+        (index_size,) = struct.unpack_from("<I", self._map, offset)
+        offset += 4
+        index = json.loads(self._map[offset:offset + index_size])
+        offset += index_size
+        self.data_start = offset + (-offset % self.ALIGN)
+        # 索引のキーは image() と同じ (パス, (幅, 高さ), alpha)
+        self.entries = {(e["path"], tuple(e["size"]), e["alpha"]): e for e in index}
+
+    @classmethod
+    def open(cls, path: str) -> "AssetBundle | None":
+        """ バンドルを開く (使えなければ None、ばらばらのファイルから読み込むことになる) """
+        try:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"バンドルを使わずに読み込みます: {path} ({e})")
+            return None
+
+    @staticmethod
+    def source_stamp(path: str) -> list[int]:
+        """ 元ファイルが変わったかを調べるための値 (大きさ, 更新時刻) """
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def has(self, key: tuple) -> bool:
+        """ key の画像がバンドルにあり、元ファイルから変わっていないか """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        try:
+            return self.source_stamp(key[0]) == entry["source"]
+        except OSError:
+            return False
+
+    def surface(self, key: tuple) -> pg.Surface | None:
+        """ key の画像をマップしたバッファのまま Surface にする (使えなければ None) """
+        if not self.has(key):
+            return None
+        entry = self.entries[key]
+        width, height = entry["size"]
+        offset = self.data_start + entry["offset"]
+        surface = pg.image.frombuffer(memoryview(self._map)[offset:offset + width * height * 4], (width, height), "BGRA")
+        if not key[2]:
+            # 不透明な画像 (背景) はピクセルごとのアルファを切り、convert() した Surface と同じくコピーだけで描く
+            surface.set_alpha(None)
+        display = pg.display.get_surface()
+        if display is not None and display.get_bitsize() != 32:
+            # 画面が 32bit でなければ、画面の形式に変換したものを使う (この時だけコピーになる)
+            surface = surface.convert_alpha() if key[2] else surface.convert()
+        return surface
+
+    @classmethod
+    def build(cls, path: str, images: list[tuple], backgrounds: list[str]) -> list[tuple]:
+        """
+        images (image() の引数) と backgrounds (背景のパス) を読み込んでスケールし、バンドルに書き出す
+        ピクセルは AssetRegistry が読み込んだものと同じ (画面の初期化が必要)。書き出したキーのリストを返す
+        """
+        registry = AssetRegistry(bundle_path=None)  # 既存のバンドルではなく元ファイルから読む
+        keys = [(args[0], args[1], args[4] if len(args) > 4 else True) for args in images]
+        keys += [(bg, (SCREEN_WIDTH, SCREEN_HEIGHT), False) for bg in backgrounds]
+        index, blobs = [], []
+        offset = 0
+        for key in dict.fromkeys(keys):  # 重複を除く (順番は保つ)
+            if not os.path.exists(key[0]):
+                continue  # 元ファイルが無い画像は実行時も代わりの単色 Surface を使う
+            surface = registry._load(*key)
+            if surface is None:
+                continue
+            offset += -offset % cls.ALIGN
+            pixels = pg.image.tobytes(surface, "BGRA")
+            index.append({"path": key[0], "size": list(surface.get_size()), "alpha": key[2],
+                          "offset": offset, "source": cls.source_stamp(key[0])})
+            blobs.append(pixels)
+            offset += len(pixels)
+
+        header = json.dumps(index).encode("utf-8")
+        head = len(cls.MAGIC) + 4 + len(header)
+        data_start = head + (-head % cls.ALIGN)
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for entry, pixels in zip(index, blobs):
+                f.seek(data_start + entry["offset"])
+                f.write(pixels)
+        os.replace(temp, path)  # 書き終わってから差し替える (途中のファイルを読ませない)
+        return [(e["path"], tuple(e["size"]), e["alpha"]) for e in index]
+
+
+class AssetRegistry:
+    """
+    画像アセットの共有レジストリ
+    (パス, サイズ) ごとに一度だけ読み込み・スケールし、同じ Surface を全インスタンスで共有する
+    背景のような大きな画像はメモリ上限を超えた時に古いものから解放する (LRU)
+    背景と BGM は prefetch で別スレッドに読み込ませておける (画面遷移の瞬間にファイルを読まない)
+    バンドル (AssetBundle) に入っている画像は、ファイルを読まずにバンドルのメモリマップから作る
+    """
+    def __init__(self, large_budget_bytes: int = 6 * 1024 * 1024, large_threshold_bytes: int = 256 * 1024,
+                 bundle_path: str | None = BUNDLE_PATH):
+        # 小さな画像 (弾・自機・ボスなど) は常駐させる
+        self.images: dict[tuple, pg.Surface] = {}
+        # 大きな画像 (背景) は LRU で管理する
+        self.large_images: OrderedDict[tuple, pg.Surface] = OrderedDict()
+        self.large_budget_bytes = large_budget_bytes
+        self.large_threshold_bytes = large_threshold_bytes
+
+        # Surface の id -> image() の引数 (スナップショットで Surface を作り方として保存するため)
+        self.recipes: dict[int, tuple] = {}
+
+        # メモリ使用量 (バイト)
+        self.resident_bytes = 0
+        self.large_bytes = 0
+        self.evictions = 0
+
+        # バンドル (最初に画像が必要になった時に開く)
+        self.bundle_path = bundle_path
+        self._bundle: AssetBundle | None = None
+        self._bundle_checked = bundle_path is None
+        self.bundled = 0  # バンドルから作った画像の数
+
+        # 先読み: 背景のデコード・スケールと BGM ファイルの読み込みを別スレッド1本で行う
+        # (スレッドはファイルを読むだけで、このレジストリの辞書と convert はメインスレッドだけが触る)
+        self._executor: ThreadPoolExecutor | None = None
+        self.pending: dict[tuple, Future] = {}  # 読み込み中 (または結果を受け取る前) のキー -> Future
+        self.music_data: dict[str, io.BytesIO] = {}  # BGM のパス -> ファイルの中身
+
+    @staticmethod
+    def surface_bytes(surface: pg.Surface) -> int:
+        """ Surface が占めるピクセルデータのバイト数 """
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def image(self, path: str, size: tuple[int, int], fallback_size: tuple[int, int] | None = None,
+              fallback_color: tuple[int, int, int] = (255, 0, 255), alpha: bool = True) -> pg.Surface:
+        """
+        スケール済みの画像を返す (共有 Surface なので呼び出し側で書き換えないこと)
+        読み込みに失敗した場合は fallback_size の単色 Surface を返す
+        """
+        surface = self._lookup((path, size, alpha))
+        if surface is not None:
+            return surface
+
+        surface = self._from_bundle((path, size, alpha))
+        if surface is None:
+            future = self.pending.pop((path, size, alpha), None)
+            if future is not None:
+                surface = self._finish(path, future.result(), alpha)
+            else:
+                surface = self._load(path, size, alpha)
+        if surface is None:
+            surface = pg.Surface(fallback_size or size)
+            surface.fill(fallback_color)
+        self._store((path, size, alpha), surface)
+        self.recipes[id(surface)] = (path, size, fallback_size, fallback_color, alpha)
+        return surface
+
+    def recipe(self, surface: pg.Surface) -> tuple:
+        """ image() で得た Surface を作り直すための引数を返す (レジストリのものでなければ KeyError) """
+        return self.recipes[id(surface)]
+
+    def background(self, path: str) -> pg.Surface | None:
+        """
+        画面サイズにスケールした背景画像を返す (読み込み失敗時は None)
+        先読み中ならその結果を使う (終わっていなければ待つ)
+        """
+        key = (path, (SCREEN_WIDTH, SCREEN_HEIGHT), False)
+        surface = self._lookup(key)
+        if surface is None:
+            surface = self._from_bundle(key)
+            if surface is None:
+                future = self.pending.pop(key, None)
+                if future is not None:
+                    surface = self._finish(path, future.result(), False)
+                else:
+                    surface = self._load(path, key[1], False)
+            if surface is not None:
+                self._store(key, surface)
+        return surface
+
+    def _open_bundle(self) -> AssetBundle | None:
+        """ バンドルを開く (最初の1回だけ、使えなければ None) """
+        if not self._bundle_checked:
+            self._bundle_checked = True
+            self._bundle = AssetBundle.open(self.bundle_path)
+        return self._bundle
+
+    def _from_bundle(self, key: tuple) -> pg.Surface | None:
+        """ バンドルに key の画像があれば、マップしたバッファから Surface を作る """
+        bundle = self._open_bundle()
+        if bundle is None:
+            return None
+        surface = bundle.surface(key)
+        if surface is not None:
+            self.pending.pop(key, None)  # 先読みを頼んでいても結果は使わない
+            self.bundled += 1
+        return surface
+
+    def prefetch(self, backgrounds=(), music=(), images=()) -> bool:
+        """
+        まだ読み込んでいない背景・BGM・画像を別スレッドで読み込み始める (毎フレーム呼んでよい)
+        images は image() の引数のタプル
+        全て使える状態 (常駐済み、または読み込みが終わっている) なら True を返す
+        """
+        ready = True
+        for path in backgrounds:
+            key = (path, (SCREEN_WIDTH, SCREEN_HEIGHT), False)
+            if self._lookup(key) is None:
+                if self._in_bundle(key):
+                    self.background(path)  # バンドルからならマップするだけなので、その場で作る
+                else:
+                    ready = self._submit(key, self._decode, path, key[1]) and ready
+        for args in images:
+            key = (args[0], args[1], args[4] if len(args) > 4 else True)
+            if self._lookup(key) is None:
+                if self._in_bundle(key):
+                    self.image(*args)
+                else:
+                    ready = self._submit(key, self._decode, key[0], key[1]) and ready
+        for path in music:
+            if path not in self.music_data:
+                ready = self._submit(("music", path), self._read, path) and ready
+        return ready
+
+    def _in_bundle(self, key: tuple) -> bool:
+        bundle = self._open_bundle()
+        return bundle is not None and bundle.has(key)
+
+    def _submit(self, key: tuple, fn, *args) -> bool:
+        """ key の読み込みを別スレッドに依頼する (依頼済みなら何もしない)、読み込みが終わっていれば True """
+        future = self.pending.get(key)
+        if future is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asset-prefetch")
+            future = self.pending[key] = self._executor.submit(fn, *args)
+        return future.done()
+
+    def load_music(self, path: str):
+        """
+        BGM を pg.mixer.music に読み込む (先読み済みならメモリ上の中身から、失敗時は pg.error)
+        """
+        future = self.pending.pop(("music", path), None)
+        if future is not None:
+            content = future.result()
+            if content is not None:
+                self.music_data[path] = io.BytesIO(content)
+        data = self.music_data.get(path)
+        if data is None:
+            pg.mixer.music.load(path)
+            return
+        # 再生中も SDL が読み続けるので、中身は捨てずに先頭へ戻して使い回す
+        data.seek(0)
+        pg.mixer.music.load(data, os.path.splitext(path)[1].lstrip("."))
+
+    def settle_prefetch(self):
+        """
+        先読みしたが使われなかった結果を片付ける (先読みした中から使うものを選び終えた時に呼ぶ)
+        読み込み済みの画像は image() で読んだものと同じく保持し (大きな画像は LRU の上限に数える)、
+        まだ読み込んでいない依頼は取り消し、使われなかった BGM の中身は捨てる
+        """
+        for key, future in list(self.pending.items()):
+            del self.pending[key]
+            if not future.done():
+                future.cancel()  # 読み込み中のものは結果を受け取らない
+                continue
+            if key[0] == "music":
+                continue
+            path, size, alpha = key
+            surface = self._finish(path, future.result(), alpha)
+            if surface is not None:
+                self._store(key, surface)
+                self.recipes[id(surface)] = (path, size, None, (255, 0, 255), alpha)
+
+    def shutdown(self):
+        """ 先読みのスレッドを止める (pg.quit の前に呼ぶ) """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self.pending.clear()
+
+    @staticmethod
+    def _decode(path: str, size: tuple[int, int]) -> pg.Surface | Exception:
+        """
+        別スレッド用: 画像をデコードしてスケールする (convert は画面に依存するのでメインスレッドで行う)
+        スケールしてから convert しても、convert してからスケールした _load と同じピクセルになる
+        """
+        try:
+            return pg.transform.scale(pg.image.load(path), size)
+        except (pg.error, FileNotFoundError) as e:
+            return e
+
+    @staticmethod
+    def _read(path: str) -> bytes | None:
+        """ 別スレッド用: ファイルの中身を読む (失敗時は None、読み込み時にエラーを出す) """
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _finish(path: str, decoded: pg.Surface | Exception, alpha: bool) -> pg.Surface | None:
+        """ 先読みでデコードした画像を画面のピクセル形式に合わせる """
+        if isinstance(decoded, Exception):
+            print(f"画像の読み込みに失敗しました: {path} ({decoded})")
+            return None
+        return decoded.convert_alpha() if alpha else decoded.convert()
+
+    def _lookup(self, key: tuple) -> pg.Surface | None:
+        surface = self.images.get(key)
+        if surface is None:
+            surface = self.large_images.get(key)
+            if surface is not None:
+                self.large_images.move_to_end(key)  # 最近使ったものとして末尾へ
+        return surface
+
+    def _store(self, key: tuple, surface: pg.Surface):
+        nbytes = self.surface_bytes(surface)
+        if nbytes >= self.large_threshold_bytes:
+            self.large_images[key] = surface
+            self.large_bytes += nbytes
+            self._evict_large(keep=key)
+        else:
+            self.images[key] = surface
+            self.resident_bytes += nbytes
+
+    def _load(self, path: str, size: tuple[int, int], alpha: bool) -> pg.Surface | None:
+        try:
+            surface = pg.image.load(path)
+            surface = surface.convert_alpha() if alpha else surface.convert()  # 画面のピクセル形式に合わせる
+            return pg.transform.scale(surface, size)
+        except (pg.error, FileNotFoundError) as e:
+            print(f"画像の読み込みに失敗しました: {path} ({e})")
+            return None
+
+    def _evict_large(self, keep: tuple):
+        """ 上限を超えた分だけ古い大きな画像を解放する """
+        while self.large_bytes > self.large_budget_bytes and len(self.large_images) > 1:
+            key, surface = next(iter(self.large_images.items()))
+            if key == keep:
+                break
+            del self.large_images[key]
+            self.recipes.pop(id(surface), None)
+            self.large_bytes -= self.surface_bytes(surface)
+            self.evictions += 1
+
+    def memory_usage(self) -> dict[str, int]:
+        """ メモリ使用量の内訳を返す (デバッグ・計測用) """
+        return {
+            "resident_images": len(self.images),
+            "resident_bytes": self.resident_bytes,
+            "large_images": len(self.large_images),
+            "large_bytes": self.large_bytes,
+            "evictions": self.evictions,
+            "bundled": self.bundled,
+        }
+
+
+# プロセス全体で共有するアセットレジストリ
+ASSETS = AssetRegistry()
+
+
+class RotationCache:
+    """
+    回転済み画像のキャッシュ
+    角度を resolution 度単位に量子化し、同じ角度の回転結果を使い回す
+    保持する総バイト数が max_bytes を超えたら古いものから解放する (LRU)
+    """
+    def __init__(self, load_base, resolution: float = 2.0, max_bytes: int = 4 * 1024 * 1024):
+        self.load_base = load_base  # 回転前の画像を返す関数 (画面初期化後に呼ぶため遅延)
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self.steps = max(1, round(360 / resolution))
+
+        self.base_image: pg.Surface | None = None
+        self.rotated: OrderedDict[int, pg.Surface] = OrderedDict()
+        self.total_bytes = 0
+
+    def quantize(self, angle: float) -> int:
+        """ 角度を量子化したインデックス (0 ～ steps-1) に変換する """
+        return round(angle / self.resolution) % self.steps
+
+    def base(self) -> pg.Surface:
+        """ 回転前の画像を返す """
+        if self.base_image is None:
+            self.base_image = self.load_base()
+        return self.base_image
+
+    def get(self, angle: float) -> pg.Surface:
+        """ angle 度 (時計回り) に回転した画像を返す """
+        index = self.quantize(angle)
+        surface = self.rotated.get(index)
+        if surface is not None:
+            self.rotated.move_to_end(index)
+            return surface
+        return self._render(index)
+
+    def prewarm(self):
+        """ 全ての量子化角度をまとめて生成しておく (ステージ開始時に呼ぶ) """
+        for index in range(self.steps):
+            if index not in self.rotated:
+                self._render(index)
+
+    def _render(self, index: int) -> pg.Surface:
+        # pygame の rotate は反時計回りなので符号を反転する
+        surface = pg.transform.rotate(self.base(), -index * self.resolution)
+        self.rotated[index] = surface
+        self.total_bytes += AssetRegistry.surface_bytes(surface)
+
+        while self.total_bytes > self.max_bytes and len(self.rotated) > 1:
+            _, old = self.rotated.popitem(last=False)
+            self.total_bytes -= AssetRegistry.surface_bytes(old)
+        return surface
+
+
+# 細レーザーの回転前の画像と、回転キャッシュ (2度単位)
+LASER_IMAGE = ("data/laser.png", (100, 5), (100, 5), (255, 200, 0))
+LASER_ROTATIONS = RotationCache(lambda: ASSETS.image(*LASER_IMAGE))
+
+
+ITEM_IMAGE = ("data/PW_Item.png", (75, 75), (10, 10), (0, 255, 255))
+
+
 class PowerItem(pg.sprite.Sprite):
     """
     パワーアップアイテム
@@ -29,18 +491,8 @@ class PowerItem(pg.sprite.Sprite):
         super().__init__()
         self.speed = 3
         
-        # アイテム画像
-        try:
-            self.image = pg.image.load("data/PW_Item.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (75, 75))
-        except pg.error:
-            self.image = pg.Surface((10, 10))
-            self.image.fill((0, 255, 255))
-                
-        font = pg.font.Font(None, 28)
-        text_surf = font.render(" ", True, WHITE)
-        text_rect = text_surf.get_rect(center=(15, 15))
-        self.image.blit(text_surf, text_rect)
+        # アイテム画像 (共有 Surface なので文字の書き込みなどはしない)
+        self.image = ASSETS.image(*ITEM_IMAGE)
         
         self.rect = self.image.get_rect(center=pos)
         
@@ -61,181 +513,983 @@ class PowerItem(pg.sprite.Sprite):
             self.kill()
 
 
-class PlayerBullet(pg.sprite.Sprite):
-    """
-    自機の弾 (ホーミング)
-    """
-    def __init__(self, pos: tuple[int, int], target: pg.sprite.Sprite,damage: int = 1):
-        super().__init__()
-        try:
-            self.image = pg.image.load("data/bullet_player.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (12, 12))
-        except pg.error:
-            self.image = pg.Surface((10, 10))
-            self.image.fill((0, 255, 255))
-        
-        self.rect = self.image.get_rect(center=pos)
-        self.target = target
-        self.speed = 8
-        self.turn_speed = 3  # ホーミングの追尾性能 (角度)
-        self.damage = damage
-
-        # 初期ベクトル (とりあえず上)
-        self.dx = 0
-        self.dy = -self.speed
+# 自機の弾 (ホーミング) の画像・速さ・1ティックで曲がれる角度
+PLAYER_BULLET_IMAGE = ("data/bullet_player.png", (12, 12), (10, 10), (0, 255, 255))
+PLAYER_BULLET_SPEED = 8
+PLAYER_BULLET_TURN = 3  # ホーミングの追尾性能 (度)
 
-    def update(self):
-        # # ターゲット参照は安全に（target が None や属性を持たない場合を考慮）
-        # if getattr(self.target, "is_active", False) or getattr(self.target, "is_ex_stage", False):
-        # ターゲット参照は安全に（target が None や属性を持たない場合を考慮）
-        if getattr(self.target, "is_active", False) or getattr(self.target, "is_ex_stage", False): # 重複削除
-            # ターゲットへの角度
-            target_dx = self.target.rect.centerx - self.rect.centerx
-            target_dy = self.target.rect.centery - self.rect.centery
-            target_angle = math.degrees(math.atan2(target_dy, target_dx))
-            
-            # 現在の角度
-            current_angle = math.degrees(math.atan2(self.dy, self.dx))
 
-            # 角度の差
-            delta_angle = (target_angle - current_angle + 540) % 360 - 180  # (-180～180の範囲に)
+def round_half_away(values: np.ndarray) -> np.ndarray:
+    """ pg.Rect に小数を代入した時と同じ丸め (0.5 は 0 から遠い方へ) """
+    return np.trunc(values + np.copysign(0.5, values))
 
-            # 旋回
-            if delta_angle > self.turn_speed:
-                current_angle += self.turn_speed
-            elif delta_angle < -self.turn_speed:
-                current_angle -= self.turn_speed
-            else:
-                current_angle = target_angle
-            
-            # ベクトル更新
-            rad = math.radians(current_angle)
-            self.dx = math.cos(rad) * self.speed
-            self.dy = math.sin(rad) * self.speed
 
-        self.rect.x += self.dx
-        self.rect.y += self.dy
+class PlayerBulletStore:
+    """
+    自機の弾 (ホーミング) をまとめて管理するストア (EnemyBulletStore と同じく配列で保持する)
+    向きは単位ベクトルで持ち、毎ティック全弾をまとめて PLAYER_BULLET_TURN 度ずつ目標の方へ回す
+    (角度と三角関数を行き来せず、回転は前もって計算した cos・sin を掛けるだけ)
+    位置は pg.Rect と同じ整数の左上座標で、動きは以前の1発ずつの Sprite と同じになる
+    """
+    COS_TURN = math.cos(math.radians(PLAYER_BULLET_TURN))
+    SIN_TURN = math.sin(math.radians(PLAYER_BULLET_TURN))
+    TIE_EPSILON = 1e-9  # これより sin(角度の差) が小さければ真後ろ
+    SCALAR_LIMIT = 24   # 弾の数がこれ未満なら numpy を使わずに進める (普段は10発前後)
+    ARRAY_NAMES = ("x", "y", "px", "py", "ux", "uy", "damage")
+
+    def __init__(self, capacity: int = 256):
+        self.n = 0  # 生きている弾の数
+        self._allocate(capacity)
+        self.image = ASSETS.image(*PLAYER_BULLET_IMAGE)
+
+    def _allocate(self, capacity: int):
+        self.capacity = capacity
+        self.x = np.zeros(capacity, np.float64)       # 左上の座標 (整数値)
+        self.y = np.zeros(capacity, np.float64)
+        self.px = np.zeros(capacity, np.float64)      # 前ティックの左上の座標 (描画の補間用)
+        self.py = np.zeros(capacity, np.float64)
+        self.ux = np.zeros(capacity, np.float64)      # 進む向き (単位ベクトル)
+        self.uy = np.zeros(capacity, np.float64)
+        self.damage = np.zeros(capacity, np.int32)
+
+    def _arrays(self) -> list[np.ndarray]:
+        return [getattr(self, name) for name in self.ARRAY_NAMES]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def spawn(self, pos: tuple[int, int], damage: int = 1):
+        """ pos を中心に真上へ1発撃つ """
+        if self.n >= self.capacity:
+            old = self._arrays()
+            self._allocate(self.capacity * 2)
+            for new, arr in zip(self._arrays(), old):
+                new[:self.n] = arr[:self.n]
+        i = self.n
+        self.n += 1
+        rect = self.image.get_rect(center=pos)
+        self.x[i] = self.px[i] = rect.x
+        self.y[i] = self.py[i] = rect.y
+        self.ux[i], self.uy[i] = 0.0, -1.0  # 初期ベクトル (とりあえず上)
+        self.damage[i] = damage
+
+    def update(self, target: pg.sprite.Sprite | None):
+        """
+        全弾を target の方へ曲げて進め、中心が画面外に出た弾を消去する
+        target が戦闘中 (is_active) か EXステージ中でなければ曲げずにまっすぐ進める
+        """
+        n = self.n
+        if n == 0:
+            return
+        self.px[:n] = self.x[:n]
+        self.py[:n] = self.y[:n]
+        # ターゲット参照は1ティックに1回だけ (target が None や属性を持たない場合を考慮)
+        homing = getattr(target, "is_active", False) or getattr(target, "is_ex_stage", False)
+        center = target.rect.center if homing else None
+        if n < self.SCALAR_LIMIT:
+            self._update_scalar(n, center)
+        else:
+            self._update_vector(n, center)
+
+    def _update_vector(self, n: int, center: tuple[int, int] | None):
+        """ 弾が多い時: numpy で全弾をまとめて進める """
+        x, y = self.x[:n], self.y[:n]
+        half_w, half_h = self.image.get_width() // 2, self.image.get_height() // 2
+        ux, uy = self.ux[:n], self.uy[:n]
+        if center is not None:
+            tx = center[0] - (x + half_w)
+            ty = center[1] - (y + half_h)
+            dist = np.sqrt(tx * tx + ty * ty)
+            same = dist == 0  # 目標と重なっている時は atan2(0, 0) = 0度 (右向き) を目標にする
+            if same.any():
+                tx[same], dist[same] = 1.0, 1.0
+            dot = ux * tx + uy * ty    # = dist * cos(目標との角度の差)
+            cross = ux * ty - uy * tx  # = dist * sin(目標との角度の差)、正なら時計回り (角度が増える向き) に曲がる
+            # 角度の差が PLAYER_BULLET_TURN 度以内ならちょうど目標の方を向き、それ以外は PLAYER_BULLET_TURN 度だけ回す
+            # 真後ろ (差が -180度) の時は反時計回り (目標を通り過ぎるとよく起きるので、丸め誤差程度の差は真後ろとみなす)
+            snap = dot >= dist * self.COS_TURN
+            sin_turn = np.where(cross > dist * self.TIE_EPSILON, self.SIN_TURN, -self.SIN_TURN)
+            new_ux = np.where(snap, tx / dist, ux * self.COS_TURN - uy * sin_turn)
+            new_uy = np.where(snap, ty / dist, ux * sin_turn + uy * self.COS_TURN)
+            ux[:] = new_ux
+            uy[:] = new_uy
+
+        x[:] = round_half_away(x + ux * PLAYER_BULLET_SPEED)
+        y[:] = round_half_away(y + uy * PLAYER_BULLET_SPEED)
 
         # 画面外に出たら消去
-        if not (0 < self.rect.centerx < SCREEN_WIDTH and 0 < self.rect.centery < SCREEN_HEIGHT):
-            self.kill()
+        cx, cy = x + half_w, y + half_h
+        self.remove((cx <= 0) | (cx >= SCREEN_WIDTH) | (cy <= 0) | (cy >= SCREEN_HEIGHT))
 
-
-class EnemyBullet(pg.sprite.Sprite):
+    def _update_scalar(self, n: int, center: tuple[int, int] | None):
+        """
+        弾が少ない時: numpy の呼び出しごとの固定コストの方が大きいので、float のループで進める
+        (計算の順番は _update_vector と同じなので、結果はビット単位で一致する)
+        """
+        half_w, half_h = self.image.get_width() // 2, self.image.get_height() // 2
+        cos_turn, sin_turn, tie = self.COS_TURN, self.SIN_TURN, self.TIE_EPSILON
+        speed = PLAYER_BULLET_SPEED
+        xs, ys = self.x[:n].tolist(), self.y[:n].tolist()
+        uxs, uys = self.ux[:n].tolist(), self.uy[:n].tolist()
+        out = False
+        for i in range(n):
+            x, y, ux, uy = xs[i], ys[i], uxs[i], uys[i]
+            if center is not None:
+                tx = center[0] - (x + half_w)
+                ty = center[1] - (y + half_h)
+                dist = math.sqrt(tx * tx + ty * ty)
+                if dist == 0:
+                    tx, dist = 1.0, 1.0
+                if ux * tx + uy * ty >= dist * cos_turn:
+                    ux, uy = tx / dist, ty / dist
+                else:
+                    s = sin_turn if ux * ty - uy * tx > dist * tie else -sin_turn
+                    ux, uy = ux * cos_turn - uy * s, ux * s + uy * cos_turn
+                uxs[i], uys[i] = ux, uy
+            v = x + ux * speed
+            x = xs[i] = float(int(v + math.copysign(0.5, v)))
+            v = y + uy * speed
+            y = ys[i] = float(int(v + math.copysign(0.5, v)))
+            cx, cy = x + half_w, y + half_h
+            if cx <= 0 or cx >= SCREEN_WIDTH or cy <= 0 or cy >= SCREEN_HEIGHT:
+                out = True
+        self.x[:n] = xs
+        self.y[:n] = ys
+        if center is not None:
+            self.ux[:n] = uxs
+            self.uy[:n] = uys
+        if out:
+            # 画面外に出たら消去
+            cx = self.x[:n] + half_w
+            cy = self.y[:n] + half_h
+            self.remove((cx <= 0) | (cx >= SCREEN_WIDTH) | (cy <= 0) | (cy >= SCREEN_HEIGHT))
+
+    def remove(self, mask: np.ndarray) -> int:
+        """ mask が True の弾を消去し、残りを先頭に詰める。消去した数を返す """
+        n = self.n
+        keep = ~mask[:n]
+        count = n - int(np.count_nonzero(keep))
+        if count:
+            for arr in self._arrays():
+                arr[:n - count] = arr[:n][keep]
+            self.n = n - count
+        return count
+
+    def collide(self, rect: pg.Rect) -> tuple[int, int]:
+        """
+        rect に当たっている弾を消去し、(当たった数, ダメージの合計) を返す (pg.Rect.colliderect と同じ判定)
+        """
+        n = self.n
+        if n == 0:
+            return 0, 0
+        x, y = self.x[:n], self.y[:n]
+        w, h = self.image.get_size()
+        hit = (x < rect.right) & (x + w > rect.left) & (y < rect.bottom) & (y + h > rect.top)
+        if not hit.any():
+            return 0, 0
+        damage = int(self.damage[:n][hit].sum())
+        return self.remove(hit), damage
+
+    def empty(self):
+        """ 全ての弾を消去する """
+        self.n = 0
+
+    def blit_items(self, alpha: float = 1.0) -> list[tuple[pg.Surface, tuple[float, float]]]:
+        """ 全弾の (Surface, 左上の位置) を返す (alpha: 前ティックから現在までの補間割合) """
+        n = self.n
+        if n == 0:
+            return []
+        x, y = self.x[:n], self.y[:n]
+        if alpha < 1.0:
+            x = self.px[:n] + (x - self.px[:n]) * alpha
+            y = self.py[:n] + (y - self.py[:n]) * alpha
+        image = self.image
+        return [(image, pos) for pos in zip(x.tolist(), y.tolist())]
+
+    def __getstate__(self) -> dict:
+        """ スナップショット用: 配列は生きている弾の分だけ保存し、画像は保存しない """
+        state = self.__dict__.copy()
+        for name in self.ARRAY_NAMES:
+            state[name] = state[name][:self.n]
+        del state["image"]
+        return state
+
+    def __setstate__(self, state: dict):
+        arrays = {name: state.pop(name) for name in self.ARRAY_NAMES}
+        self.__dict__.update(state)
+        self._allocate(self.capacity)
+        for name, arr in arrays.items():
+            getattr(self, name)[:self.n] = arr
+        self.image = ASSETS.image(*PLAYER_BULLET_IMAGE)
+
+
+# 敵弾の種類 (EnemyBulletStore.kind の値)
+KIND_SMALL = 0          # 小弾
+KIND_LARGE = 1          # 大弾
+KIND_LASER = 2          # 細レーザー (角度に合わせて回転)
+KIND_HUGE = 3           # 特大弾 (EX専用)
+KIND_DELAYED_LASER = 4  # 置きレーザー (予兆 -> 発射 -> 消滅)
+
+# 敵弾の画像 (パス, サイズ, 読み込み失敗時のサイズ, 色)
+ENEMY_BULLET_IMAGES = {
+    KIND_SMALL: ("data/bullet_enemy_small.png", (10, 10), (8, 8), (255, 100, 100)),
+    KIND_LARGE: ("data/bullet_enemy_large.png", (25, 25), (20, 20), (255, 50, 50)),
+    KIND_HUGE: ("data/bullet_enemy_huge.png", (40, 40), (35, 35), (100, 0, 255)),  # 大きくて目立つダミー
+}
+DELAYED_LASER_WARN_IMAGE = ("data/laser_warning.png", (30, 300), (30, 300), (100, 100, 0))
+DELAYED_LASER_ACTIVE_IMAGE = ("data/laser.png", (30, 300), (30, 300), (255, 255, 0))
+
+# 敵弾の状態 (EnemyBulletStore.state の値)
+STATE_MOVING = 0   # 通常の弾 (移動中)
+STATE_WARNING = 1  # 置きレーザーの予兆表示中 (当たり判定なし)
+STATE_ACTIVE = 2   # 置きレーザーの発射中
+
+# 敵弾の当たり判定の形 (EnemyBulletStore.shape の値)
+# どの形も画像の矩形の内側に収まるので、画像の矩形同士の判定を絞り込みに使える
+SHAPE_BOX = 0      # 画像の矩形そのまま (軸に平行)
+SHAPE_CIRCLE = 1   # 画像に内接する円
+SHAPE_CAPSULE = 2  # 画像の向きに回転した線分 + 太さ (端は丸い)
+
+# 弾の種類ごとの当たり判定の形
+BULLET_SHAPES = {
+    KIND_SMALL: SHAPE_CIRCLE,
+    KIND_LARGE: SHAPE_CIRCLE,
+    KIND_HUGE: SHAPE_CIRCLE,
+    KIND_LASER: SHAPE_CAPSULE,        # 斜めのレーザーでも見た目どおりの細い判定
+    KIND_DELAYED_LASER: SHAPE_BOX,    # 縦長の矩形で回転しないので矩形のまま
+}
+
+
+def _point_rect_dist2(px: np.ndarray, py: np.ndarray, rect: pg.Rect) -> np.ndarray:
+    """ 点から rect までの距離の2乗 (rect の内側なら 0) """
+    dx = px - np.clip(px, rect.left, rect.right)
+    dy = py - np.clip(py, rect.top, rect.bottom)
+    return dx * dx + dy * dy
+
+
+def circles_overlap_rect(x: np.ndarray, y: np.ndarray, r: np.ndarray, rect: pg.Rect) -> np.ndarray:
+    """ 中心 (x, y)、半径 r の円それぞれが rect と重なっているか """
+    return _point_rect_dist2(x, y, rect) < r * r
+
+
+def capsules_overlap_rect(x: np.ndarray, y: np.ndarray, ax: np.ndarray, ay: np.ndarray, r: np.ndarray,
+                          rect: pg.Rect) -> np.ndarray:
     """
-    敵の弾 (小弾)
+    線分 (x, y) ± (ax, ay) を太さ r で膨らませたカプセルそれぞれが rect と重なっているか
+    線分が rect を横切っていれば重なり、そうでなければ線分と rect の距離 (端点と rect、rect の角と線分の
+    距離の最小値、凸図形同士の最短距離はどちらかの頂点で決まる) が r より小さいかで判定する
     """
-    def __init__(self, pos: tuple[int, int], angle: float, speed: float):
-        super().__init__()
-        try:
-            self.image = pg.image.load("data/bullet_enemy_small.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (10, 10))
-        except pg.error:
-            self.image = pg.Surface((8, 8))
-            self.image.fill((255, 100, 100))
-        
-        self.rect = self.image.get_rect(center=pos)
-        
-        rad = math.radians(angle)
-        self.dx = math.cos(rad) * speed
-        self.dy = math.sin(rad) * speed
-        
-        self.grazed = False  # GRAZE判定用フラグ
-
-    def update(self):
-        self.rect.x += self.dx
-        self.rect.y += self.dy
-        # (画面外判定はmain関数側で行う)
-
-
-class EnemyLargeBullet(EnemyBullet):
+    # 分離軸判定: x軸・y軸・線分の法線のどれかで分かれていれば線分は rect を横切っていない
+    rhw, rhh = rect.width / 2, rect.height / 2
+    rcx, rcy = rect.left + rhw, rect.top + rhh
+    dx, dy = x - rcx, y - rcy
+    abs_ax, abs_ay = np.abs(ax), np.abs(ay)
+    crossing = ((np.abs(dx) <= rhw + abs_ax) & (np.abs(dy) <= rhh + abs_ay) &
+                (np.abs(ax * dy - ay * dx) <= abs_ay * rhw + abs_ax * rhh))
+
+    # 線分の両端と rect の距離
+    dist2 = np.minimum(_point_rect_dist2(x - ax, y - ay, rect), _point_rect_dist2(x + ax, y + ay, rect))
+    # rect の4つの角と線分の距離 (線分の向きに射影して両端の間に収める)
+    length2 = 4 * (ax * ax + ay * ay)
+    safe = np.where(length2 > 0, length2, 1.0)
+    for qx, qy in ((rect.left, rect.top), (rect.right, rect.top), (rect.left, rect.bottom), (rect.right, rect.bottom)):
+        wx, wy = qx - (x - ax), qy - (y - ay)
+        t = np.clip((wx * 2 * ax + wy * 2 * ay) / safe, 0.0, 1.0)
+        ex, ey = wx - t * 2 * ax, wy - t * 2 * ay
+        dist2 = np.minimum(dist2, ex * ex + ey * ey)
+    return crossing | (dist2 < r * r)
+
+
+def boxes_sweep_rect(x: np.ndarray, y: np.ndarray, dx: np.ndarray, dy: np.ndarray, hw: np.ndarray, hh: np.ndarray,
+                     rect: pg.Rect) -> np.ndarray:
     """
-    敵の弾 (大弾)
+    半幅 hw・半高さ hh の矩形それぞれが中心 (x - dx, y - dy) から (x, y) まで動く間に rect と重なるか
+    中心の線分と、rect を (hw, hh) だけ広げた矩形の分離軸判定 (動いていなければ pg.Rect.colliderect と同じ)
     """
-    def __init__(self, pos: tuple[int, int], angle: float, speed: float):
-        super().__init__(pos, angle, speed)
-        try:
-            self.image = pg.image.load("data/bullet_enemy_large.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (25, 25))
-        except pg.error:
-            self.image = pg.Surface((20, 20))
-            self.image.fill((255, 50, 50))
-        self.rect = self.image.get_rect(center=pos)
+    rhw, rhh = rect.width / 2 + hw, rect.height / 2 + hh
+    hx, hy = dx / 2, dy / 2
+    cx = x - hx - (rect.left + rect.width / 2)
+    cy = y - hy - (rect.top + rect.height / 2)
+    abs_hx, abs_hy = np.abs(hx), np.abs(hy)
+    return ((np.abs(cx) < rhw + abs_hx) & (np.abs(cy) < rhh + abs_hy) &
+            (np.abs(hx * cy - hy * cx) <= abs_hy * rhw + abs_hx * rhh))
 
 
-class EnemyLaser(EnemyBullet):
+class SpatialGrid:
     """
-    敵の弾 (細レーザー)
+    画面を一定サイズのセルに分割した一様グリッド (空間インデックス)
+    弾は中心のあるセルに1回だけ登録し、問い合わせた矩形をセルの半分だけ広げた範囲のセルにいる弾を返す
+    セルの半分より大きい弾 (置きレーザーなど) はセルに登録せず、どの問い合わせでも候補に含める
     """
-    def __init__(self, pos: tuple[int, int], angle: float, speed: float):
-        super().__init__(pos, angle, speed)
-        try:
-            self.original_image = pg.image.load("data/laser.png").convert_alpha()
-            self.original_image = pg.transform.scale(self.original_image, (100, 5))  # 細長い画像
-        except pg.error:
-            self.original_image = pg.Surface((100, 5))
-            self.original_image.fill((255, 200, 0))
-        
-        # 角度に合わせて画像を回転
-        self.image = pg.transform.rotate(self.original_image, -angle)
-        self.rect = self.image.get_rect(center=pos)
-        # 細レーザーは当たり判定が大きくなりがちなので、rectを少し小さくする
-
-
-class EnemyDelayedLaser(pg.sprite.Sprite):
+    def __init__(self, width: int = SCREEN_WIDTH, height: int = SCREEN_HEIGHT, cell_size: int = 40):
+        self.cell_size = cell_size
+        self.cols = -(-width // cell_size)
+        self.rows = -(-height // cell_size)
+        # セル c に登録された弾は entries[cell_start[c]:cell_start[c + 1]] (セルの中では番号順)
+        self.entries = np.zeros(0, np.int64)
+        self.cell_start = np.zeros(self.cols * self.rows + 1, np.int64)
+        self.large = np.zeros(0, np.int64)  # セルに登録しない大きな弾
+
+    def rebuild(self, x: np.ndarray, y: np.ndarray, hw: np.ndarray, hh: np.ndarray):
+        """ 全ての弾をセルに登録し直す (画面外の弾は端のセルに寄せる) """
+        half = self.cell_size / 2
+        large = (hw > half) | (hh > half)
+        small = None
+        if large.any():
+            self.large = np.flatnonzero(large)
+            small = np.flatnonzero(~large)
+            x, y = x[small], y[small]
+        else:
+            self.large = self.large[:0]
+        col = np.minimum(np.maximum(x // self.cell_size, 0), self.cols - 1)
+        row = np.minimum(np.maximum(y // self.cell_size, 0), self.rows - 1)
+        # セル番号は 16bit に収まるので、安定ソートは基数ソートになる
+        cells = (row * self.cols + col).astype(np.int16)
+        order = np.argsort(cells, kind="stable")
+        self.entries = order if small is None else small[order]
+        np.cumsum(np.bincount(cells, minlength=self.cols * self.rows), out=self.cell_start[1:])
+
+    def _cell_range(self, lo: float, hi: float, count: int) -> tuple[int, int]:
+        """ 座標の範囲 [lo, hi] をセル番号の範囲に変換する (画面外は端のセルに寄せる) """
+        c0 = min(max(int(lo // self.cell_size), 0), count - 1)
+        c1 = min(max(int(hi // self.cell_size), 0), count - 1)
+        return c0, c1
+
+    def query(self, rect: pg.Rect) -> np.ndarray:
+        """ rect と重なりうる弾のインデックス (重複なし、昇順) """
+        half = self.cell_size / 2
+        cx0, cx1 = self._cell_range(rect.left - half, rect.right + half, self.cols)
+        cy0, cy1 = self._cell_range(rect.top - half, rect.bottom + half, self.rows)
+        # 同じ行のセルは entries 上で連続しているので、行ごとに1回切り出せばよい
+        start, cols = self.cell_start, self.cols
+        chunks = [self.entries[start[row * cols + cx0]:start[row * cols + cx1 + 1]] for row in range(cy0, cy1 + 1)]
+        if len(self.large):
+            chunks.append(self.large)
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.sort(np.concatenate(chunks))
+
+
+class TimingWheel:
     """
-    敵の弾 (置きレーザー)
+    階層型のタイミングホイール (ティック単位の予定表)
+    1段目は 2**slot_bits 個のマスに1ティックずつ、2段目以降は1マスが下の段の1周分の予定を入れ、
+    下の段が1周するたびに上の段の次のマスの予定を下の段に移し替える
+    advance() の手間は期限が来た予定の数に比例し、登録されている予定の総数にはよらない
+    取り消しはできないので、受け取った側で古い予定を無視すること
     """
-    def __init__(self, pos: tuple[int, int], delay: int, duration: int):
-        super().__init__()
-        
-        self.pos = pos
-        self.delay = delay  # 発射までの待機フレーム
-        self.duration = duration  # 発射中のフレーム
-        self.timer = 0
-        
-        self.state = "warning"  # 'warning' -> 'active' -> 'finished'
-        
-        try:
-            self.warn_image = pg.image.load("data/laser_warning.png").convert_alpha()
-            self.warn_image = pg.transform.scale(self.warn_image, (30, 300))
-        except pg.error:
-            self.warn_image = pg.Surface((30, 300))
-            self.warn_image.fill((100, 100, 0))
-        
-        # 警告画像を半透明にする
-        self.warn_image.set_alpha(100) 
+    def __init__(self, now: int = 0, slot_bits: int = 6, levels: int = 3):
+        self.now = now  # 最後に進めたティック
+        self.bits = slot_bits
+        self.mask = (1 << slot_bits) - 1
+        self.levels: list[list[list[tuple[int, object]]]] = [
+            [[] for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self.overflow: list[tuple[int, object]] = []  # 一番上の段にも入らない遠い予定
+        self.late: list = []  # 期限を過ぎてから登録された予定 (次の advance で返す)
+
+    @property
+    def span(self) -> int:
+        """ 段に入れられる予定の先の長さ (ティック) """
+        return 1 << (self.bits * len(self.levels))
+
+    def schedule(self, tick: int, item):
+        """ tick のティックに item を返すように登録する """
+        if tick <= self.now:
+            self.late.append(item)
+        else:
+            self._insert(tick, item)
+
+    def _insert(self, tick: int, item):
+        # 今と同じ周にある一番下の段に入れる
+        for level, slots in enumerate(self.levels):
+            if tick >> (self.bits * (level + 1)) == self.now >> (self.bits * (level + 1)):
+                slots[(tick >> (self.bits * level)) & self.mask].append((tick, item))
+                return
+        self.overflow.append((tick, item))
+
+    def advance(self, tick: int) -> list:
+        """ tick まで進め、期限が来た予定を登録した順に返す """
+        fired, self.late = self.late, []
+        while self.now < tick:
+            self.now = t = self.now + 1
+            if t & self.mask == 0:
+                self._cascade(t)
+            slot = self.levels[0][t & self.mask]
+            if slot:
+                fired += [item for _, item in slot]
+                slot.clear()
+        return fired
+
+    def _cascade(self, t: int):
+        """ 1周した段の上の段から、次のマスの予定を下の段に移し替える (上の段から順に) """
+        level = 1
+        while level < len(self.levels) and t & ((1 << (self.bits * level)) - 1) == 0:
+            level += 1
+        if level == len(self.levels) and t & (self.span - 1) == 0 and self.overflow:
+            entries, self.overflow = self.overflow, []
+            for entry in entries:
+                self._insert(*entry)
+        for upper in range(level - 1, 0, -1):
+            slot = self.levels[upper][(t >> (self.bits * upper)) & self.mask]
+            entries = slot[:]
+            slot.clear()
+            for entry in entries:
+                self._insert(*entry)
+
+    def clear(self):
+        """ 全ての予定を捨てる (今のティックはそのまま) """
+        for slots in self.levels:
+            for slot in slots:
+                slot.clear()
+        self.overflow.clear()
+        self.late.clear()
+
+
+class EnemyBulletStore:
+    """
+    敵弾をまとめて管理するストア (NumPy の配列で位置・速度・種類などを保持する)
+    生きている弾は常に配列の先頭 [0:n] に詰めて格納し、移動・削除を
+    弾ごとのループではなく配列演算1回ずつで行う
+    画面外に出る・置きレーザーの状態が変わるティックは発射時に計算して TimingWheel に登録しておき、
+    毎ティックの処理では期限が来た弾だけを調べる
+    """
+    def __init__(self, capacity: int = 4096):
+        self.n = 0  # 生きている弾の数
+        self._allocate(capacity)
+
+        self.ticks = 0  # step を呼んだ回数 (弾の予定はこのティックで数える)
+        self.wheel = TimingWheel()  # ティック -> 弾の通し番号 (serial)
+        self.next_serial = 0
+        # 弾が1ティックに x・y 方向へ動く距離の最大 (GRAZE・被弾の候補を探す範囲を広げる量、empty まで減らさない)
+        self.max_step = 0.0
+
+        self.graze_count = 0  # GRAZE された弾の累計 (計測用)
+
+        # 近くの弾を探すための空間インデックス (弾が動いたら作り直す)
+        self.grid = SpatialGrid()
+        self._grid_dirty = True
+
+        # 描画用 Surface の表 (img 配列はこの表のインデックス)
+        # surface_keys は各 Surface の作り方 (スナップショットから表を作り直すのに使う)
+        self.surfaces: list[pg.Surface] = []
+        self.surface_keys: list[tuple] = []
+        self._surface_ids: dict[tuple, int] = {}
+        # 実際に描く Surface の表 (処理が重い時は一部を簡略化したものに差し替える、set_draw_quality)
+        self.draw_quality = (False, False)
+        self.draw_surfaces: list[pg.Surface] = []
+
+    def _allocate(self, capacity: int):
+        self.capacity = capacity
+        self.x = np.zeros(capacity, np.float64)       # 中心座標 (小数で保持)
+        self.y = np.zeros(capacity, np.float64)
+        self.px = np.zeros(capacity, np.float64)      # 前ティックの中心座標 (描画の補間と動いた範囲の判定用)
+        self.py = np.zeros(capacity, np.float64)
+        self.vx = np.zeros(capacity, np.float64)      # 1フレームあたりの移動量
+        self.vy = np.zeros(capacity, np.float64)
+        self.hw = np.zeros(capacity, np.float64)      # 当たり判定の半幅・半高さ
+        self.hh = np.zeros(capacity, np.float64)
+        self.kind = np.zeros(capacity, np.int8)
+        self.img = np.zeros(capacity, np.int32)
+        self.state = np.zeros(capacity, np.int8)
+        self.born = np.zeros(capacity, np.int64)      # 今の状態になったティック (発射・置きレーザーの発射開始)
+        self.due = np.zeros(capacity, np.int64)       # 次の予定のティック (画面外に出るか確かめる・状態が変わる、-1 は予定なし)
+        self.serial = np.zeros(capacity, np.int64)    # 発射した順の通し番号 (詰めても順番が変わらないので常に昇順)
+        self.duration = np.zeros(capacity, np.int32)  # 置きレーザー: 発射中のフレーム
+        self.grazed = np.zeros(capacity, np.bool_)    # GRAZE判定用フラグ
+        self.shape = np.zeros(capacity, np.int8)      # 当たり判定の形 (SHAPE_*)
+        self.radius = np.zeros(capacity, np.float64)  # 円の半径・カプセルの太さ (半分)
+        self.ax = np.zeros(capacity, np.float64)      # カプセルの芯の線分の半分 (中心 ± (ax, ay))
+        self.ay = np.zeros(capacity, np.float64)
+
+    ARRAY_NAMES = ("x", "y", "px", "py", "vx", "vy", "hw", "hh", "kind", "img",
+                   "state", "born", "due", "serial", "duration", "grazed", "shape", "radius", "ax", "ay")
+
+    def _arrays(self) -> list[np.ndarray]:
+        return [getattr(self, name) for name in self.ARRAY_NAMES]
+
+    def _grow(self):
+        """ 容量が足りなくなったら倍に広げる """
+        old = self._arrays()
+        self._allocate(self.capacity * 2)
+        for new, arr in zip(self._arrays(), old):
+            new[:self.n] = arr[:self.n]
+
+    def __len__(self) -> int:
+        return self.n
+
+    @staticmethod
+    def _make_surface(key: tuple) -> pg.Surface:
+        """
+        表のキーから Surface を得る
+        ("laser", 量子化した角度) は回転キャッシュ、("image", 画像の指定, 透明度) は共有アセット
+        """
+        if key[0] == "laser":
+            # 角度に合わせて回転済みの細長い画像をキャッシュから取得
+            return LASER_ROTATIONS.get(key[1] * LASER_ROTATIONS.resolution)
+        surface = ASSETS.image(*key[1])
+        if key[2] is not None:
+            # 共有 Surface だが同じ画像には常に同じ値を設定するので問題ない
+            surface.set_alpha(key[2])
+        return surface
+
+    def _surface_id(self, key: tuple) -> int:
+        sid = self._surface_ids.get(key)
+        if sid is None:
+            sid = len(self.surfaces)
+            self.surfaces.append(self._make_surface(key))
+            self.surface_keys.append(key)
+            self.draw_surfaces.append(self._draw_surface(key, self.surfaces[sid]))
+            self._surface_ids[key] = sid
+        return sid
+
+    # 簡略表示用の Surface (表のキー -> Surface、全ストアで共有)
+    _simplified: dict[tuple, pg.Surface] = {}
+
+    def _draw_surface(self, key: tuple, surface: pg.Surface) -> pg.Surface:
+        """ 今の描画品質で key の弾を描く Surface (簡略化しない弾は surface のまま) """
+        opaque_warnings, dot_bullets = self.draw_quality
+        if opaque_warnings and key == ("image", DELAYED_LASER_WARN_IMAGE, 100):
+            simplified = self._simplified.get(key)
+            if simplified is None:
+                # Surface 全体の透明度をなくした複製 (合成の計算がいらない)
+                simplified = surface.copy()
+                simplified.set_alpha(None)
+                self._simplified[key] = simplified
+            return simplified
+        if dot_bullets and key == ("image", ENEMY_BULLET_IMAGES[KIND_SMALL], None):
+            simplified = self._simplified.get(key)
+            if simplified is None:
+                # 同じ大きさの単色の丸 (色抜きなので、ピクセル単位のアルファより合成が速い)
+                width, height = surface.get_size()
+                simplified = pg.Surface((width, height)).convert()
+                simplified.fill(BLACK)
+                pg.draw.circle(simplified, key[1][3], (width // 2, height // 2), min(width, height) // 2)
+                simplified.set_colorkey(BLACK, pg.RLEACCEL)
+                self._simplified[key] = simplified
+            return simplified
+        return surface
+
+    def set_draw_quality(self, opaque_warnings: bool, dot_bullets: bool):
+        """
+        描画の簡略化を切り替える (見た目だけで、当たり判定などのゲームの進行には影響しない)
+        opaque_warnings: 置きレーザーの予兆を半透明にしない, dot_bullets: 小弾を単色の丸で描く
+        """
+        if (opaque_warnings, dot_bullets) == self.draw_quality:
+            return
+        self.draw_quality = (opaque_warnings, dot_bullets)
+        self.draw_surfaces = [self._draw_surface(key, surface) for key, surface in zip(self.surface_keys, self.surfaces)]
+
+    def _new_slot(self, key: tuple, pos: tuple[float, float], kind: int) -> int:
+        if self.n >= self.capacity:
+            self._grow()
+        i = self.n
+        self.n += 1
+        self._grid_dirty = True
+        sid = self._surface_id(key)
+        surface = self.surfaces[sid]
+        self.x[i], self.y[i] = pos
+        self.px[i], self.py[i] = pos
+        self.hw[i] = surface.get_width() / 2
+        self.hh[i] = surface.get_height() / 2
+        self.kind[i] = kind
+        self.img[i] = sid
+        self.born[i] = self.ticks
+        self.serial[i] = self.next_serial
+        self.next_serial += 1
+        self.grazed[i] = False
+        self.shape[i] = BULLET_SHAPES[kind]
+        self.radius[i] = min(surface.get_size()) / 2  # 円なら画像に内接する円
+        self.ax[i] = self.ay[i] = 0.0
+        return i
+
+    def spawn(self, kind: int, pos: tuple[float, float], angle: float, speed: float):
+        """
+        移動する弾を1つ発射する (angle は度、時計回り)
+        """
+        if kind == KIND_LASER:
+            key = ("laser", LASER_ROTATIONS.quantize(angle))
+        else:
+            key = ("image", ENEMY_BULLET_IMAGES[kind], None)
+        i = self._new_slot(key, pos, kind)
+        if kind == KIND_LASER:
+            # カプセルは回転前の画像の長さ・太さで、描画と同じ量子化した角度に向ける
+            width, height = LASER_ROTATIONS.base().get_size()
+            drawn = math.radians(key[1] * LASER_ROTATIONS.resolution)
+            half_length = max(width - height, 0) / 2
+            self.radius[i] = height / 2
+            self.ax[i] = math.cos(drawn) * half_length
+            self.ay[i] = math.sin(drawn) * half_length
+        rad = math.radians(angle)
+        vx, vy = math.cos(rad) * speed, math.sin(rad) * speed
+        self.vx[i] = vx
+        self.vy[i] = vy
+        self.max_step = max(self.max_step, abs(vx), abs(vy))
+        self.state[i] = STATE_MOVING
+        self._schedule(i, self._exit_tick(float(pos[0]), float(pos[1]), vx, vy, float(self.hw[i]), float(self.hh[i])))
+
+    def _exit_tick(self, x: float, y: float, vx: float, vy: float, hw: float, hh: float) -> int:
+        """
+        (x, y) から1ティックに (vx, vy) ずつ直線で進む弾が画面と重ならなくなるティック (止まっている弾は -1)
+        位置は毎ティック速度を足して求めるので計算と小数の誤差がある。ちょうど境目に着く時は1ティック早めに返し、
+        その時にまだ画面と重なっていれば step が予定を入れ直す
+        """
+        steps = math.inf
+        if vx > 0:
+            steps = (SCREEN_WIDTH + hw - x) / vx
+        elif vx < 0:
+            steps = (x + hw) / -vx
+        if vy > 0:
+            steps = min(steps, (SCREEN_HEIGHT + hh - y) / vy)
+        elif vy < 0:
+            steps = min(steps, (y + hh) / -vy)
+        if steps == math.inf:
+            return -1
+        return self.ticks + max(1, math.ceil(steps - 1e-6))
+
+    def _schedule(self, i: int, tick: int):
+        """ 弾 i の次の予定を tick にする (-1 なら予定なし) """
+        self.due[i] = tick
+        if tick >= 0:
+            self.wheel.schedule(tick, int(self.serial[i]))
+
+    # これより少ない数は spawn を繰り返した方が速い (配列演算1回ごとの手間の方が大きい)
+    BATCH_SPAWN_MIN = 6
+
+    def spawn_many(self, kind: int, pos: tuple[float, float], angles: list[float], speed: float):
+        """
+        同じ位置から同じ速さの弾を angles (度) の向きにまとめて発射する (全方位弾など)
+        """
+        k = len(angles)
+        if kind == KIND_LASER or k < self.BATCH_SPAWN_MIN:
+            # 細レーザーは角度ごとに画像が違うので1発ずつ
+            for angle in angles:
+                self.spawn(kind, pos, angle, speed)
+            return
+        while self.n + k > self.capacity:
+            self._grow()
+        sid = self._surface_id(("image", ENEMY_BULLET_IMAGES[kind], None))
+        surface = self.surfaces[sid]
+        s = slice(self.n, self.n + k)
+        self.x[s] = self.px[s] = pos[0]
+        self.y[s] = self.py[s] = pos[1]
+        rad = np.radians(np.asarray(angles, np.float64))
+        self.vx[s] = np.cos(rad) * speed
+        self.vy[s] = np.sin(rad) * speed
+        self.max_step = max(self.max_step, float(np.abs(self.vx[s]).max()), float(np.abs(self.vy[s]).max()))
+        self.hw[s] = surface.get_width() / 2
+        self.hh[s] = surface.get_height() / 2
+        self.kind[s] = kind
+        self.img[s] = sid
+        self.state[s] = STATE_MOVING
+        self.born[s] = self.ticks
+        self.serial[s] = np.arange(self.next_serial, self.next_serial + k)
+        self.next_serial += k
+        self.grazed[s] = False
+        self.shape[s] = BULLET_SHAPES[kind]
+        self.radius[s] = min(surface.get_size()) / 2
+        self.ax[s] = self.ay[s] = 0.0
+        x, y, hw, hh = float(pos[0]), float(pos[1]), float(self.hw[self.n]), float(self.hh[self.n])
+        dues = [self._exit_tick(x, y, vx, vy, hw, hh) for vx, vy in zip(self.vx[s].tolist(), self.vy[s].tolist())]
+        self.due[s] = dues
+        for serial, tick in zip(self.serial[s].tolist(), dues):
+            if tick >= 0:
+                self.wheel.schedule(tick, serial)
+        self.n += k
+        self._grid_dirty = True
+
+    def spawn_delayed_laser(self, pos: tuple[float, float], delay: int, duration: int):
+        """
+        置きレーザーを設置する (delay フレームの予兆の後、duration フレームの間だけ判定を持つ)
+        """
+        # 警告画像は半透明にする
+        i = self._new_slot(("image", DELAYED_LASER_WARN_IMAGE, 100), pos, KIND_DELAYED_LASER)
+        self.vx[i] = self.vy[i] = 0.0  # 置きレーザーは移動しない
+        self.state[i] = STATE_WARNING
+        self.duration[i] = duration
+        # delay ティック待った次のティックで発射する
+        self.due[i] = self.ticks + delay + 1
+        self.wheel.schedule(int(self.due[i]), int(self.serial[i]))
+
+    def step(self, grazebox: pg.Rect | None = None, hitbox: pg.Rect | None = None,
+             bomb: tuple[float, float, float] | None = None,
+             profiler: "FrameProfiler | None" = None) -> tuple[int, int, int, bool]:
+        """
+        1ティック分の敵弾の処理を、全弾に対する1回の配列演算にまとめて行う
+        移動・置きレーザーの状態更新・画面外の消去に加えて、
+        bomb (中心x, 中心y, 半径) の範囲内の弾の消去と、grazebox / hitbox との GRAZE・被弾判定もする
+        (GRAZE・被弾は弾がこのティックに動いた範囲で判定する: sweep_mask)
+        (grazebox は hitbox を含む大きさであること。None なら判定しない)
+        profiler を渡すと、ボムでの消去を "bomb"、GRAZE・被弾判定を "collision"、それ以外を "bullets" の区間として計測する
+        (避けきった数, ボムで消した数, 新たに GRAZE した数, 被弾したか) を返す
+        """
+        self.ticks += 1
+        serials = self.wheel.advance(self.ticks)
+        n = self.n
+        if n == 0:
+            return 0, 0, 0, False
+        self._grid_dirty = True
+        x, y = self.x[:n], self.y[:n]
+        self.px[:n] = x
+        self.py[:n] = y
+        x += self.vx[:n]
+        y += self.vy[:n]
+        state = self.state[:n]
+        removed = np.zeros(n, np.bool_)
+        avoided = 0
+
+        # 期限が来た弾だけを調べる
+        due = self._due_indices(serials)
+        if len(due):
+            due_state = state[due]
+            # 置きレーザー: 予兆 -> 発射 (実体画像に差し替えて判定を有効化し、消える予定を入れる)
+            to_active = due[due_state == STATE_WARNING]
+            if len(to_active):
+                sid = self._surface_id(("image", DELAYED_LASER_ACTIVE_IMAGE, None))
+                active_image = self.surfaces[sid]
+                state[to_active] = STATE_ACTIVE
+                self.born[to_active] = self.ticks
+                self.img[to_active] = sid
+                self.hw[to_active] = active_image.get_width() / 2
+                self.hh[to_active] = active_image.get_height() / 2
+                self.radius[to_active] = min(active_image.get_size()) / 2
+                self.due[to_active] = self.ticks + self.duration[to_active] + 1
+                for tick, serial in zip(self.due[to_active].tolist(), self.serial[to_active].tolist()):
+                    self.wheel.schedule(tick, serial)
+            # 置きレーザー: 発射 -> 消滅
+            removed[due[due_state == STATE_ACTIVE]] = True
+
+            # 画面外に出る予定の弾: 画面と重なっていなければ消す (まだ重なっていれば予定を入れ直す)
+            moving = due[due_state == STATE_MOVING]
+            if len(moving):
+                mx, my, hw, hh = self.x[moving], self.y[moving], self.hw[moving], self.hh[moving]
+                offscreen = (mx + hw <= 0) | (mx - hw >= SCREEN_WIDTH) | (my + hh <= 0) | (my - hh >= SCREEN_HEIGHT)
+                removed[moving[offscreen]] = True
+                avoided = int(np.count_nonzero(offscreen))
+                for i in moving[~offscreen].tolist():
+                    self._schedule(i, self._exit_tick(float(self.x[i]), float(self.y[i]), float(self.vx[i]),
+                                                      float(self.vy[i]), float(self.hw[i]), float(self.hh[i])))
+
+        if bomb is not None or grazebox is not None:
+            self._refresh_grid()  # 作り直しの時間は "bullets" に入れる
+        if profiler:
+            profiler.lap("bullets")
+
+        # ボム: 円を囲む正方形のセルにいる弾のうち、中心間の距離の2乗が半径の2乗より小さい弾を消す (平方根は使わない)
+        bombed = 0
+        if bomb is not None:
+            cx, cy, radius = bomb
+            size = math.ceil(radius) + 1
+            near = self.query(pg.Rect(int(cx) - size, int(cy) - size, 2 * size + 1, 2 * size + 1))
+            if len(near):
+                dx, dy = x[near] - cx, y[near] - cy
+                inside = near[(dx * dx + dy * dy < radius * radius) & ~removed[near]]
+                bombed = len(inside)
+                removed[inside] = True
+        if profiler:
+            profiler.lap("bomb")
+
+        # GRAZE と被弾: grazebox を max_step だけ広げた範囲 (このティックに動く間に grazebox に届きうる範囲) の
+        # セルにいる弾から、画像の矩形がその範囲と重なる弾だけを候補にして、予兆中の置きレーザーは除く
+        # (候補の中で弾の形が動く間に grazebox・hitbox と重なったかを調べる。速い弾もすり抜けない)
+        grazed, hit = 0, False
+        if grazebox is not None and hitbox is not None:
+            reach = self.max_step
+            margin = math.ceil(reach)
+            near = self.query(grazebox.inflate(2 * margin, 2 * margin))
+            if len(near):
+                nx, ny, hw, hh = x[near], y[near], self.hw[near], self.hh[near]
+                near = near[(nx - hw < grazebox.right + reach) & (nx + hw > grazebox.left - reach) &
+                            (ny - hh < grazebox.bottom + reach) & (ny + hh > grazebox.top - reach) &
+                            (state[near] != STATE_WARNING) & ~removed[near]]
+            if len(near):
+                near = near[self.sweep_mask(near, grazebox)]
+                touching = self.sweep_mask(near, hitbox)
+                hit = bool(touching.any())
+                grazing = near[~touching & ~self.grazed[near]]
+                self.grazed[grazing] = True
+                grazed = len(grazing)
+                self.graze_count += grazed
+        if profiler:
+            profiler.lap("collision")
+
+        if avoided or bombed or len(due):
+            self.remove(removed)
+        return avoided, bombed, grazed, hit
+
+    def _due_indices(self, serials: list[int]) -> np.ndarray:
+        """
+        期限が来た予定 (弾の通し番号) のうち、まだ生きていて予定が変わっていない弾のインデックスを返す
+        (消えた弾の予定は取り消さずにここで捨てる。1つの弾の予定は常に1つだけなので重複はない)
+        """
+        if not serials:
+            return np.zeros(0, np.intp)
+        n = self.n
+        serials = np.asarray(serials, np.int64)
+        index = np.minimum(np.searchsorted(self.serial[:n], serials), n - 1)
+        return index[(self.serial[index] == serials) & (self.due[index] == self.ticks)]
+
+    def remove(self, mask: np.ndarray) -> int:
+        """
+        mask が True の弾を消去し、残りを先頭に詰める。消去した数を返す
+        """
+        n = self.n
+        keep = ~mask[:n]
+        count = n - int(np.count_nonzero(keep))
+        if count == 0:
+            return 0
+        for arr in self._arrays():
+            arr[:n - count] = arr[:n][keep]
+        self.n = n - count
+        self._grid_dirty = True
+        return count
 
-        try:
-            self.active_image = pg.image.load("data/laser.png").convert_alpha()
-            self.active_image = pg.transform.scale(self.active_image, (30, 300))
-        except pg.error:
-            self.active_image = pg.Surface((30, 300))
-            self.active_image.fill((255, 255, 0))
-
-        self.image = self.warn_image
-        self.rect = self.image.get_rect(center=self.pos)
-        
-        self.grazed = False  # GRAZE判定用フラグ
+    def retire(self, count: int, target: tuple[float, float]) -> int:
+        """
+        移動中の弾のうち target (自機の位置) から離れていく弾を、古い (長く飛んでいる) 順に最大 count 個消す
+        自機に向かってくる弾と置きレーザーは消さない。消した数を返す
+        """
+        n = self.n
+        x, y = self.x[:n], self.y[:n]
+        away = (self.state[:n] == STATE_MOVING) & (
+            (target[0] - x) * self.vx[:n] + (target[1] - y) * self.vy[:n] <= 0)
+        candidates = np.flatnonzero(away)
+        if len(candidates) > count:
+            candidates = candidates[np.argsort(self.born[candidates], kind="stable")[:count]]
+        mask = np.zeros(n, np.bool_)
+        mask[candidates] = True
+        return self.remove(mask)
+
+    def empty(self):
+        """ 全ての弾を消去する """
+        self.n = 0
+        self.wheel.clear()
+        self.max_step = 0.0
+        self._grid_dirty = True
+
+    def __getstate__(self) -> dict:
+        """
+        スナップショット用: 配列は生きている弾の分だけ保存し、Surface は作り方 (キー) だけを残す
+        """
+        state = self.__dict__.copy()
+        for name in self.ARRAY_NAMES:
+            state[name] = state[name][:self.n]
+        del state["surfaces"], state["_surface_ids"], state["grid"]
+        del state["draw_quality"], state["draw_surfaces"]
+        return state
+
+    def __setstate__(self, state: dict):
+        arrays = {name: state.pop(name) for name in self.ARRAY_NAMES}
+        self.__dict__.update(state)
+        self._allocate(self.capacity)
+        for name, arr in arrays.items():
+            getattr(self, name)[:self.n] = arr
+        self.surfaces = [self._make_surface(key) for key in self.surface_keys]
+        self._surface_ids = {key: sid for sid, key in enumerate(self.surface_keys)}
+        self.draw_quality = (False, False)
+        self.draw_surfaces = list(self.surfaces)
+        self.grid = SpatialGrid()
+        self._grid_dirty = True
+
+    def query(self, rect: pg.Rect) -> np.ndarray:
+        """
+        rect が重なるセルに登録されている弾のインデックスを返す (近くにある弾の候補)
+        弾が動いた後の最初の問い合わせでグリッドを作り直す
+        """
+        self._refresh_grid()
+        return self.grid.query(rect)
 
-    def update(self):
-        self.timer += 1
-        
-        if self.state == "warning":
-            # 警告表示（半透明）
-            if self.timer > self.delay:
-                # 警告時間経過
-                self.state = "active"
-                self.image = self.active_image  # 実体画像に差し替え
-                self.rect = self.image.get_rect(center=self.pos)  # 判定を有効化
-                self.timer = 0
-        
-        elif self.state == "active":
-            # 実体（当たり判定あり）
-            if self.timer > self.duration:
-                self.state = "finished"
-                self.kill()  # 消滅
-        # 置きレーザーは移動しない
+    def _refresh_grid(self):
+        """ 弾が動いた・増えた・消えた後なら空間グリッドを作り直す """
+        if self._grid_dirty:
+            n = self.n
+            self.grid.rebuild(self.x[:n], self.y[:n], self.hw[:n], self.hh[:n])
+            self._grid_dirty = False
+
+    def overlap_mask(self, indices: np.ndarray, rect: pg.Rect) -> np.ndarray:
+        """
+        indices の弾のうち当たり判定の形が rect と重なっているもの
+        画像の矩形で絞り込み (SHAPE_BOX はこれで確定、pg.Rect.colliderect と同じ判定)、
+        残った円・カプセルだけを形ごとにまとめて判定する
+        """
+        x, y, hw, hh = self.x[indices], self.y[indices], self.hw[indices], self.hh[indices]
+        mask = ((x - hw < rect.right) & (x + hw > rect.left) &
+                (y - hh < rect.bottom) & (y + hh > rect.top))
+        shape = self.shape[indices]
+        refine = mask & (shape != SHAPE_BOX)
+        if not refine.any():
+            return mask
+        circle = np.flatnonzero(refine & (shape == SHAPE_CIRCLE))
+        if len(circle):
+            i = indices[circle]
+            mask[circle] = circles_overlap_rect(self.x[i], self.y[i], self.radius[i], rect)
+        capsule = np.flatnonzero(refine & (shape == SHAPE_CAPSULE))
+        if len(capsule):
+            i = indices[capsule]
+            mask[capsule] = capsules_overlap_rect(self.x[i], self.y[i], self.ax[i], self.ay[i],
+                                                  self.radius[i], rect)
+        return mask
+
+    def sweep_mask(self, indices: np.ndarray, rect: pg.Rect) -> np.ndarray:
+        """
+        indices の弾のうち、前のティックの位置 (px, py) から今の位置まで動く間に当たり判定の形が rect と重なったもの
+        1ティックで rect より大きく動く速い弾でも、すり抜けずに判定できる
+        今の位置で重なっている弾はそれで確定し (overlap_mask)、残りだけを動いた範囲の形で判定する
+        円が動いた範囲はカプセル、矩形は中心の線分と広げた rect で判定する (止まっていれば overlap_mask と同じ)
+        カプセル (細レーザー) は軸と平行な移動の分だけ長さを伸ばし、横にずれる分は太さに足す (少しだけ大きめの判定)
+        """
+        mask = self.overlap_mask(indices, rect)
+        rest = np.flatnonzero(~mask)
+        if len(rest) == 0:
+            return mask
+        i = indices[rest]
+        x, y, px, py = self.x[i], self.y[i], self.px[i], self.py[i]
+        hw, hh = self.hw[i], self.hh[i]
+        # 動いた範囲全体を囲む矩形で絞り込む
+        near = np.flatnonzero((np.minimum(x, px) - hw < rect.right) & (np.maximum(x, px) + hw > rect.left) &
+                              (np.minimum(y, py) - hh < rect.bottom) & (np.maximum(y, py) + hh > rect.top))
+        if len(near) == 0:
+            return mask
+        rest, i = rest[near], i[near]
+        x, y, hw, hh = x[near], y[near], hw[near], hh[near]
+        dx, dy = x - px[near], y - py[near]
+        swept = np.zeros(len(i), np.bool_)
+        box = self.shape[i] == SHAPE_BOX
+        if box.any():
+            swept[box] = boxes_sweep_rect(x[box], y[box], dx[box], dy[box], hw[box], hh[box], rect)
+        round_ = ~box
+        if round_.any():
+            j = i[round_]
+            x, y, dx, dy = x[round_], y[round_], dx[round_], dy[round_]
+            ax, ay = self.ax[j], self.ay[j]
+            # カプセルは移動を軸方向 (軸の along 倍) とそれに垂直な成分に分ける (円は軸の長さが 0)
+            length2 = ax * ax + ay * ay
+            line = length2 > 0
+            along = np.where(line, (dx * ax + dy * ay) / np.where(line, length2, 1.0), 0.0)
+            scale = 1.0 + np.abs(along) / 2
+            hx = np.where(line, ax * scale, dx / 2)
+            hy = np.where(line, ay * scale, dy / 2)
+            r = self.radius[j] + np.where(line, np.hypot(dx - along * ax, dy - along * ay) / 2, 0.0)
+            swept[round_] = capsules_overlap_rect(x - dx / 2, y - dy / 2, hx, hy, r, rect)
+        mask[rest] = swept
+        return mask
+
+    def blit_items(self, alpha: float = 1.0) -> list[tuple[pg.Surface, tuple[int, int]]]:
+        """
+        全弾の (Surface, 左上の位置) を画像ごとにまとめた順で返す (alpha: 前ティックから現在までの補間割合)
+        """
+        n = self.n
+        if n == 0:
+            return []
+        order = np.argsort(self.img[:n], kind="stable")
+        x, y = self.x[order], self.y[order]
+        if alpha < 1.0:
+            px, py = self.px[order], self.py[order]
+            x = px + (x - px) * alpha
+            y = py + (y - py) * alpha
+        left = np.rint(x - self.hw[order]).astype(np.int32).tolist()
+        top = np.rint(y - self.hh[order]).astype(np.int32).tolist()
+        surfaces = self.draw_surfaces
+        return [(surfaces[i], (lx, ty)) for i, lx, ty in zip(self.img[order].tolist(), left, top)]
 
 
 class BombArea:
@@ -254,40 +1508,42 @@ class BombArea:
         
     def update(self, player_center: tuple[int, int]):
         """
-        自機の位置を追従し、タイマーを更新する
+        自機の位置を追従し、タイマー (点滅の演出用) を更新する
+        終わるティックは GameWorld が発動時に予定表に登録し、その時に is_active を False にする
         """
         if self.is_active:
             self.center = player_center
             self.timer += 1
-            if self.timer >= self.duration_frames:
-                self.is_active = False
 
-    def check_collision_and_kill(self, enemy_bullets: pg.sprite.Group) -> int:
+    # 描画用の円 (半径, 透明度) -> Surface (全ボムで共有)
+    _overlay_cache: dict[tuple[int, int], pg.Surface] = {}
+    # 点滅時に使う透明度の段階 (この中で一番近いものを使う)
+    OVERLAY_ALPHA_LEVELS = (150, 175, 200, 225, 250)
+
+    @classmethod
+    def overlay(cls, radius: int, alpha: int) -> pg.Surface:
         """
-        敵弾との衝突判定を行い、範囲内の敵弾を消滅させる。
-        消滅させた弾の数を返す。
+        指定した透明度のオレンジの円を返す (初回だけ描画してキャッシュする)
         """
-        if not self.is_active:
-            return 0
-            
-        bullets_killed_count = 0
-        
-        # 敵弾リストを逆順にイテレートし、killしても安全にする
-        for bullet in list(enemy_bullets):
-            # 弾とボムエリアの中心間の距離を計算
-            dist = math.hypot(bullet.rect.centerx - self.center[0], bullet.rect.centery - self.center[1])
-            
-            # 距離が半径より小さければ衝突
-            if dist < self.radius:
-                bullet.kill()
-                bullets_killed_count += 1
-                
-        return bullets_killed_count
-
-    def draw(self, screen: pg.Surface):
+        level = min(cls.OVERLAY_ALPHA_LEVELS, key=lambda a: abs(a - alpha))
+        surface = cls._overlay_cache.get((radius, level))
+        if surface is None:
+            # 色抜き + Surface 全体の透明度で描く (ピクセル単位のアルファより合成が速い)
+            surface = pg.Surface((radius * 2, radius * 2)).convert()
+            surface.fill(BLACK)
+            pg.draw.circle(surface, (255, 165, 0), (radius, radius), radius, 0)  # オレンジ
+            surface.set_colorkey(BLACK, pg.RLEACCEL)
+            surface.set_alpha(level)
+            cls._overlay_cache[(radius, level)] = surface
+        return surface
+
+    def draw(self, screen: pg.Surface, translucent: bool = True) -> pg.Rect | None:
         """
-        ボムエリアの円を描画する (可視化用)
+        ボムエリアの円を描画する (可視化用)、描いた範囲を返す
+        translucent=False なら半透明で塗らずに輪郭だけ描く (処理が重い時の簡略表示)
         """
+        if self.is_active and not translucent:
+            return pg.draw.circle(screen, (255, 165, 0), self.center, self.radius, 4)
         if self.is_active:
             # 警告的な薄いオレンジ色で円を描画
             alpha = 150
@@ -295,48 +1551,298 @@ class BombArea:
             if self.timer < 30 or self.duration_frames - self.timer < 30: 
                 # abs(math.sin(self.timer * 0.5)) で0から1を周期的に変動
                 alpha = 150 + int(100 * abs(math.sin(self.timer * 0.5)))
-                
-            s = pg.Surface((self.radius * 2, self.radius * 2), pg.SRCALPHA)
-            s.fill((0, 0, 0, 0)) # 透明なサーフェス
-            
-            color = (255, 165, 0) # オレンジ
-            # 半透明の円を描画 (色 + alpha値)
-            pg.draw.circle(s, color + (min(255, alpha),), (self.radius, self.radius), self.radius, 0)
-            
+
             # 画面に描画
-            screen.blit(s, (self.center[0] - self.radius, self.center[1] - self.radius))
+            return screen.blit(self.overlay(self.radius, alpha), (self.center[0] - self.radius, self.center[1] - self.radius))
+        return None
+
+
+# 描画品質の段階 (処理が重い時に QualityGovernor が1段階ずつ上げる、各段階はそれより下の段階の簡略化も含む)
+QUALITY_FULL = 0            # 全て通常通り
+QUALITY_OUTLINE_BOMB = 1    # ボムの円を半透明で塗らず、輪郭だけ描く
+QUALITY_OPAQUE_WARNING = 2  # 置きレーザーの予兆を半透明にしない
+QUALITY_DOT_BULLETS = 3     # 小弾を単色の丸で描く
+QUALITY_SLOW_HUD = 4        # HUD の数値を QUALITY_HUD_INTERVAL フレームに1回だけ更新する
+QUALITY_BULLET_CAP = 5      # 敵弾の数に上限を設け、自機から離れていく古い弾から消す (最終手段)
+QUALITY_NAMES = ("通常", "ボムの輪郭表示", "予兆の不透明化", "小弾の簡略表示", "HUD の間引き", "敵弾数の上限")
+QUALITY_HUD_INTERVAL = 6
+FRAME_BUDGET_MS = 1000 / FPS  # 1フレームの処理時間の予算 (60fps を保てる時間)
+
+# 難易度ごとの設定 (残機・ボム・ボスHP・各弾幕パターンの頻度と密度)
+# バランス調整はこの表を書き換える (スイープ実行時は difficulty_settings の overrides で上書きする)
+# quality は描画品質の自動調整 (budget_ms: 1フレームの予算, max_level: 落とす段階の上限,
+#   bullet_cap / ex_bullet_cap: QUALITY_BULLET_CAP の段階での通常ステージ / EX の敵弾数の上限)
+DIFFICULTY_TABLE = {
+    "EASY": {
+        "lives": 15,
+        "bombs": 3,
+        "hp": [50, 75, 100],
+        "ex_hp": 500,
+        "ex_lives": 3,
+        "skill_pattern_1": {"large_bullet_freq": 80, "large_bullet_density": 6, "small_bullet_freq": 20},
+        "skill_pattern_2": {"delayed_laser_freq": 120, "delayed_laser_count": 1, "laser_freq": 30},
+        "skill_pattern_3": {"p1_freq": 100, "p1_density": 5, "p2_freq": 40, "p3_freq": 70},
+        "quality": {"budget_ms": FRAME_BUDGET_MS, "max_level": 4, "bullet_cap": 40, "ex_bullet_cap": 90},
+    },
+    "NORMAL": {
+        "lives": 10,
+        "bombs": 3,
+        "hp": [100, 150, 200],
+        "ex_hp": 1000,
+        "ex_lives": 3,
+        "skill_pattern_1": {"large_bullet_freq": 60, "large_bullet_density": 8, "small_bullet_freq": 12},
+        "skill_pattern_2": {"delayed_laser_freq": 90, "delayed_laser_count": 2, "laser_freq": 18},
+        "skill_pattern_3": {"p1_freq": 70, "p1_density": 6, "p2_freq": 25, "p3_freq": 50},
+        "quality": {"budget_ms": FRAME_BUDGET_MS, "max_level": 5, "bullet_cap": 60, "ex_bullet_cap": 90},
+    },
+    "HARD": {
+        "lives": 5,
+        "bombs": 3,
+        "hp": [200, 300, 400],
+        "ex_hp": 1500,
+        "ex_lives": 3,
+        "skill_pattern_1": {"large_bullet_freq": 40, "large_bullet_density": 10, "small_bullet_freq": 8},
+        "skill_pattern_2": {"delayed_laser_freq": 60, "delayed_laser_count": 3, "laser_freq": 12},
+        "skill_pattern_3": {"p1_freq": 50, "p1_density": 8, "p2_freq": 15, "p3_freq": 35},
+        "quality": {"budget_ms": FRAME_BUDGET_MS, "max_level": 5, "bullet_cap": 90, "ex_bullet_cap": 90},
+    },
+}
+# EXステージの弾幕は難易度によらず共通
+EX_PATTERN_SETTINGS = {
+    "large_freq": 40, "large_density": 10,   # 全方位（強化）
+    "small_freq": 8,                         # 自機狙い小弾（強化）
+    "laser_freq": 15,                        # 細レーザー（高頻度）
+    "delayed_laser_freq": 30,                # 置きレーザー（短めの遅延・頻度高め）
+    "huge_ring_freq": 150, "huge_ring_count": 4,  # 特大弾（円形に展開するもの）
+    "huge_aimed_freq": 90,                   # 特大弾（自機狙いでゆっくり発射）
+}
+for _settings in DIFFICULTY_TABLE.values():
+    _settings["ex_pattern_final"] = dict(EX_PATTERN_SETTINGS)
+
+# 弾幕パターンの定義 (パターン名 -> エミッターのリスト、上から順に発射する)
+# 数値の代わりに文字列を書くと、難易度の設定 (DIFFICULTY_TABLE[難易度][パターン名]) のその項目を使う
+#   kind: "small" / "large" / "laser" / "huge" / "delayed_laser"
+#   period: 発射間隔 (ティック), count: 1回に撃つ数 (既定 1)
+#   ring: True なら360度に等間隔, False なら spread 度ずつ並べる (中央が 0度)
+#   aim: "player" なら自機狙い, spin: 1ティックごとに回す角度, jitter: 1発ごとのばらつき (±度), speed: 速さ
+#   置きレーザーは area ((x の最小, 最大), (y の最小, 最大)) のランダムな位置に置き、delay の予兆の後 duration だけ判定を持つ
+# パターンの追加・調整はこの表と DIFFICULTY_TABLE を書き換えるだけでよい (ステージ開始時に PatternSchedule に変換する)
+BOSS_PATTERNS = {
+    # ステージ1: 小弾 (小弾と大弾の全方位弾)
+    "skill_pattern_1": [
+        {"kind": "large", "period": "large_bullet_freq", "count": "large_bullet_density", "ring": True,
+         "spin": 0.1, "jitter": 10, "speed": 2},
+        {"kind": "small", "period": "small_bullet_freq", "count": 3, "spread": 10, "aim": "player",
+         "jitter": 5, "speed": 4},
+    ],
+    # ステージ2: レーザー (細レーザーと置きレーザー)
+    "skill_pattern_2": [
+        {"kind": "delayed_laser", "period": "delayed_laser_freq", "count": "delayed_laser_count",
+         "area": ((50, SCREEN_WIDTH - 50), (SCREEN_HEIGHT // 2, SCREEN_HEIGHT - 50)), "delay": 30, "duration": 60},
+        {"kind": "laser", "period": "laser_freq", "aim": "player", "jitter": 15, "speed": 8},
+    ],
+    # ステージ3: 複合弾幕 (全種類使用)
+    "skill_pattern_3": [
+        {"kind": "large", "period": "p1_freq", "count": "p1_density", "ring": True, "spin": -0.05, "jitter": 5, "speed": 2},
+        {"kind": "small", "period": "p2_freq", "aim": "player", "jitter": 10, "speed": 4},
+        {"kind": "delayed_laser", "period": "p3_freq",
+         "area": ((50, SCREEN_WIDTH - 50), (SCREEN_HEIGHT // 2, SCREEN_HEIGHT - 50)), "delay": 30, "duration": 30},
+    ],
+    # EXステージ: 既存の全パターンを高頻度で組み合わせ、さらに特大弾を追加
+    "ex_pattern_final": [
+        {"kind": "large", "period": "large_freq", "count": "large_density", "ring": True, "spin": 0.2, "jitter": 8, "speed": 3},
+        {"kind": "small", "period": "small_freq", "count": 3, "spread": 15, "aim": "player", "jitter": 6, "speed": 5},
+        {"kind": "laser", "period": "laser_freq", "aim": "player", "jitter": 10, "speed": 9},
+        {"kind": "delayed_laser", "period": "delayed_laser_freq",
+         "area": ((50, SCREEN_WIDTH - 50), (SCREEN_HEIGHT // 3, SCREEN_HEIGHT - 50)), "delay": 20, "duration": 40},
+        {"kind": "huge", "period": "huge_ring_freq", "count": "huge_ring_count", "ring": True, "spin": 1, "speed": 1.5},
+        {"kind": "huge", "period": "huge_aimed_freq", "aim": "player", "jitter": 5, "speed": 2.5},
+    ],
+}
+
+
+def difficulty_settings(difficulty: str, overrides: dict | None = None) -> dict:
+    """
+    難易度の設定をコピーして返す (不明な難易度は NORMAL)
+    overrides は {"lives": 3, "skill_pattern_3.p1_freq": 30} のように "パターン名.項目" で指定できる
+    """
+    settings = copy.deepcopy(DIFFICULTY_TABLE.get(difficulty, DIFFICULTY_TABLE["NORMAL"]))
+    for key, value in (overrides or {}).items():
+        section, _, name = key.partition(".")
+        if name:
+            if not isinstance(settings.get(section), dict) or name not in settings[section]:
+                raise KeyError(f"不明な設定です: {key}")
+            settings[section][name] = value
+        else:
+            if section not in settings:
+                raise KeyError(f"不明な設定です: {key}")
+            settings[section] = value
+    return settings
+
+
+# モード (通常ステージ / EXステージ) ごとのルール
+# スコアの配点などはこの表を書き換える (GameWorld はモードによって処理を分けない)
+MODE_RULES = {
+    "normal": {
+        "avoid_score": 1,          # 弾を1つ避けきった (画面外に出た)
+        "graze_score": 20,         # GRAZE 1回
+        "bomb_score": 1,           # ボムで消した弾1つ
+        "power_damage": True,      # 自機弾のダメージにパワーアップを反映する
+        "items": True,             # パワーアップアイテムを出す
+        "graze_se": False,         # GRAZE の効果音を鳴らす
+        "hit_ends_bomb": False,    # 被弾したらボムも終わる
+    },
+    "ex": {
+        "avoid_score": 10,         # EXはスコア高め
+        "graze_score": 50,
+        "bomb_score": 1,
+        "power_damage": False,     # パワーアップ未対応 (1発 = 1ダメージ)
+        "items": False,
+        "graze_se": True,
+        "hit_ends_bomb": True,
+    },
+}
+
+
+EMITTER_KINDS = {"small": KIND_SMALL, "large": KIND_LARGE, "laser": KIND_LASER, "huge": KIND_HUGE,
+                 "delayed_laser": KIND_DELAYED_LASER}
+
+
+class Emitter:
+    """
+    BOSS_PATTERNS のエミッター1つを、難易度の設定の値を埋め込んで発射できる形にしたもの
+    """
+    def __init__(self, spec: dict, settings: dict):
+        def value(key: str, default=None):
+            v = spec.get(key, default)
+            if isinstance(v, str):
+                if v not in settings:
+                    raise KeyError(f"不明な設定です: {v}")
+                return settings[v]
+            return v
+
+        unknown = set(spec) - {"kind", "period", "count", "ring", "spread", "aim", "spin", "jitter", "speed",
+                               "area", "delay", "duration"}
+        if unknown:
+            raise KeyError(f"不明なエミッターの項目です: {sorted(unknown)}")
+        self.kind = EMITTER_KINDS[spec["kind"]]
+        self.period = max(1, int(value("period")))
+        self.count = max(0, int(value("count", 1)))
+        self.aimed = spec.get("aim") == "player"
+        self.spin = float(value("spin", 0))
+        self.jitter = float(value("jitter", 0))
+        self.speed = float(value("speed", 0))
+        self.area = spec.get("area")
+        self.delay = int(value("delay", 0))
+        self.duration = int(value("duration", 0))
+        # 1発ごとの基準の角度 (リングなら等間隔、そうでなければ中央を 0 として spread 度ずつ)
+        if value("ring", False):
+            self.offsets = [(360 / self.count) * i for i in range(self.count)]
+        else:
+            spread = float(value("spread", 0))
+            self.offsets = [(i - (self.count - 1) / 2) * spread for i in range(self.count)]
+
+    def fire(self, bullets: EnemyBulletStore, timer: int, origin: tuple[int, int], aim: float,
+             rng: random.Random):
+        """ 1回分を発射する (aim: 自機への角度、ばらつきは rng から1発ずつ引く) """
+        if self.kind == KIND_DELAYED_LASER:
+            (x0, x1), (y0, y1) = self.area
+            for _ in range(self.count):
+                x = rng.randint(x0, x1)
+                y = rng.randint(y0, y1)
+                bullets.spawn_delayed_laser((x, y), delay=self.delay, duration=self.duration)
+            return
+        base = timer * self.spin
+        if self.aimed:
+            base += aim
+        jitter = self.jitter
+        if jitter:
+            angles = [base + offset + rng.uniform(-jitter, jitter) for offset in self.offsets]
+        else:
+            angles = [base + offset for offset in self.offsets]
+        bullets.spawn_many(self.kind, origin, angles, self.speed)
+
 
+# 発射スケジュールの表の長さの上限 (これを超える周期の組み合わせは使える長さで割り切れるものだけ表にする)
+PATTERN_TABLE_LIMIT = 1 << 16
 
-class EnemyHugeBullet(EnemyBullet):
+
+class PatternSchedule:
     """
-    敵の弾 (特大弾) - EX専用
+    弾幕パターン (エミッターのリスト) をステージ開始時に発射スケジュールの表に変換したもの
+    全エミッターの発射間隔の最小公倍数を周期として、ティックごとに発射するエミッターを前もって並べておくので、
+    毎ティックの処理は表を1回引くだけになる
     """
-    def __init__(self, pos: tuple[int, int], angle: float, speed: float):
-        # 注意: EnemyBullet.__init__ で image を読み替えられるので、ここでは自前で上書きする
-        super().__init__(pos, angle, speed)
-        try:
-            self.image = pg.image.load("data/bullet_enemy_huge.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (40, 40))
-        except (pg.error, FileNotFoundError):
-            # 大きくて目立つダミー Surface
-            self.image = pg.Surface((35, 35))
-            self.image.fill((100, 0, 255))
-        self.rect = self.image.get_rect(center=pos)
-        # dx/dy は親クラスで設定済み
+    def __init__(self, specs: list[dict], settings: dict):
+        self.emitters = [Emitter(spec, settings) for spec in specs]
+        self.uses_laser = any(e.kind == KIND_LASER for e in self.emitters)
+        length = 1
+        for e in self.emitters:
+            if math.lcm(length, e.period) <= PATTERN_TABLE_LIMIT:
+                length = math.lcm(length, e.period)
+        self.length = length
+        table = [[] for _ in range(length)]
+        # 表の周期で割り切れない (最小公倍数が大きすぎる) エミッターは毎ティック割り算で判定する
+        self.unaligned = []
+        for e in self.emitters:
+            if length % e.period == 0:
+                for t in range(0, length, e.period):
+                    table[t].append(e)
+            else:
+                self.unaligned.append(e)
+        self.table = [tuple(entry) for entry in table]
+
+    def fire(self, bullets: EnemyBulletStore, timer: int, origin: tuple[int, int], target: tuple[int, int],
+             rng: random.Random):
+        """ timer ティック目に発射するものを発射する (target: 自機狙いの目標) """
+        emitters = self.table[timer % self.length]
+        if self.unaligned:
+            emitters = sorted(emitters + tuple(e for e in self.unaligned if timer % e.period == 0),
+                              key=self.emitters.index)
+        if not emitters:
+            return
+        # 自機への角度はこのティックで1回だけ計算する
+        aim = math.degrees(math.atan2(target[1] - origin[1], target[0] - origin[0]))
+        for e in emitters:
+            e.fire(bullets, timer, origin, aim, rng)
+
+
+_PATTERN_CACHE: dict[tuple[str, str], PatternSchedule] = {}
+
+
+def compile_pattern(name: str, settings: dict) -> PatternSchedule:
+    """
+    BOSS_PATTERNS[name] を難易度の設定 settings[name] で PatternSchedule に変換する
+    (同じ設定なら前に変換したものを使い回す)
+    """
+    section = settings.get(name, {})
+    key = (name, json.dumps(section, sort_keys=True))
+    schedule = _PATTERN_CACHE.get(key)
+    if schedule is None:
+        schedule = _PATTERN_CACHE[key] = PatternSchedule(BOSS_PATTERNS[name], section)
+    return schedule
+
+
+def rng_stream(seed: int, name: str) -> random.Random:
+    """
+    シードと用途名から独立した乱数列を作る
+    用途ごとに分けておくと、片方の乱数の使い方が変わってももう片方の並びはずれない
+    """
+    return random.Random(f"{seed}:{name}")
+
+
+PLAYER_IMAGE = ("data/player.png", (50, 50), (30, 40), (0, 128, 255))
+BOSS_IMAGE = ("data/boss.png", (150, 150), (100, 100), (255, 0, 128))
 
 
 class Player(pg.sprite.Sprite):
     """
     自機クラス
     """
-    def __init__(self, difficulty: str): # 難易度を受け取る
+    def __init__(self, difficulty: str, settings: dict | None = None): # 難易度を受け取る
         super().__init__()
-        try:
-            self.image = pg.image.load("data/player.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (50, 50))  # サイズ調整
-        except pg.error:
-            self.image = pg.Surface((30, 40))
-            self.image.fill((0, 128, 255))
+        # 点滅で透明度を書き換えるので、共有 Surface のコピーを持つ
+        self.image = self._load_image()
         
         self.rect = self.image.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT - 50))
         
@@ -350,20 +1856,18 @@ class Player(pg.sprite.Sprite):
         self.speed = 5
         
         # 難易度に応じて残機を変更
-        if difficulty == "EASY":
-            self.lives = 15
-        elif difficulty == "HARD":
-            self.lives = 5
-        else: # NORMAL (デフォルト)
-            self.lives = 10
+        settings = settings or difficulty_settings(difficulty)
+        self.lives = settings["lives"]
 
-        self.shoot_delay = 100  # ホーミング弾の発射間隔 (ms)
-        self.last_shot = pg.time.get_ticks()
+        # タイマーは全てティック (1/60秒) 単位
+        self.ticks = 0  # update が呼ばれた回数 (自機の時計)
+        self.shoot_delay = 6  # ホーミング弾の発射間隔 (6ティック = 100ms)
+        self.last_shot = 0
 
         # 復活関連  
         self.is_respawning = False
         self.respawn_timer = 0
-        self.respawn_duration = 10000  # 10秒
+        self.respawn_duration = 10 * FPS  # 10秒
         self.blink_timer = 0
         self.is_visible = True
 
@@ -374,15 +1878,31 @@ class Player(pg.sprite.Sprite):
         self.items_per_level = 5
         self.is_powered_up = False
 
-    def update(self, keys: pg.key.ScancodeWrapper, bullets_group: pg.sprite.Group, target_boss: pg.sprite.Sprite):
+    @staticmethod
+    def _load_image() -> pg.Surface:
+        return ASSETS.image(*PLAYER_IMAGE).copy()
+
+    def __getstate__(self) -> dict:
+        """ スナップショット用: 自分専用の画像は保存せず、復元時に作り直す """
+        state = self.__dict__.copy()
+        del state["image"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.image = self._load_image()
+        self.image.set_alpha(255 if self.is_visible else 0)
+
+    def update(self, keys: pg.key.ScancodeWrapper, bullets: PlayerBulletStore):
         """
         プレイヤーの更新
         """
         
+        self.ticks += 1
+
         if self.is_respawning:
             # 復活待機中 (10秒タイマー)
-            now = pg.time.get_ticks()
-            if now - self.respawn_timer > self.respawn_duration:
+            if self.ticks - self.respawn_timer >= self.respawn_duration:
                 self.respawn()
             
             # 点滅処理 (無敵中は操作不可)
@@ -418,17 +1938,16 @@ class Player(pg.sprite.Sprite):
         self.grazebox.center = self.rect.center
 
         # 射撃 (ホーミング)
-        self.shoot(bullets_group, target_boss)
+        self.shoot(bullets)
 
-    def shoot(self, bullets_group: pg.sprite.Group, target_boss: pg.sprite.Sprite):
+    def shoot(self, bullets: PlayerBulletStore):
         """
         ホーミング弾を発射する
         """
-        now = pg.time.get_ticks()
-        if now - self.last_shot > self.shoot_delay:
-            self.last_shot = now
+        if self.ticks - self.last_shot >= self.shoot_delay:
+            self.last_shot = self.ticks
             damage = self.power_level + 1
-            bullets_group.add(PlayerBullet(self.rect.center, target_boss, damage))
+            bullets.spawn(self.rect.center, damage)
 
     def hit(self):
         """
@@ -437,7 +1956,7 @@ class Player(pg.sprite.Sprite):
         if not self.is_respawning:
             self.lives -= 1
             self.is_respawning = True
-            self.respawn_timer = pg.time.get_ticks()
+            self.respawn_timer = self.ticks
             
     def respawn(self):
         """
@@ -447,6 +1966,7 @@ class Player(pg.sprite.Sprite):
         self.is_visible = True 
         self.image.set_alpha(255)  # 点滅終了
         self.rect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT - 50)
+        self.prev_pos = None  # 瞬間移動なので描画の補間はしない
         self.hitbox.center = self.rect.center
         self.grazebox.center = self.rect.center
 
@@ -466,47 +1986,40 @@ class Boss(pg.sprite.Sprite):
     """
     ボスクラス - EXステージ対応を追加
     """
-    def __init__(self, difficulty: str):  # 難易度を受け取る
+    def __init__(self, difficulty: str, settings: dict | None = None, rng: random.Random | None = None):  # 難易度を受け取る
         super().__init__()
-        try:
-            self.image = pg.image.load("data/boss.png").convert_alpha()
-            self.image = pg.transform.scale(self.image, (150, 150))
-        except pg.error:
-            self.image = pg.Surface((100, 100))
-            self.image.fill((255, 0, 128))
+        self.image = ASSETS.image(*BOSS_IMAGE)
+        # 移動先と弾幕のばらつきに使う乱数 (リプレイで同じ弾幕を再現するためボス専用)
+        self.rng = rng or random.Random()
             
         self.rect = self.image.get_rect(center=(SCREEN_WIDTH // 2, 200))
         self.difficulty = difficulty
+        # 難易度別の設定 (HP・弾幕の頻度と密度)
+        self.settings = settings or difficulty_settings(difficulty)
 
         # 難易度に応じてHPを設定
-        if difficulty == "EASY":
-            hp_list = [50, 75, 100]
-        elif difficulty == "HARD":
-            hp_list = [200, 300, 400]
-        else:  # NORMAL (デフォルト)
-            hp_list = [100, 150, 200]
-
-        # スキル情報 (名前, HP, 弾幕パターンメソッド)
+        hp_list = self.settings["hp"]
+
+        # スキル情報 (名前, HP, 弾幕パターン名 (BOSS_PATTERNS のキー))
         self.skill = [
-            ("STAGE1", hp_list[0], self.skill_pattern_1),
-            ("STAGE2", hp_list[1], self.skill_pattern_2),
-            ("STAGE3", hp_list[2], self.skill_pattern_3),
+            ("STAGE1", hp_list[0], "skill_pattern_1"),
+            ("STAGE2", hp_list[1], "skill_pattern_2"),
+            ("STAGE3", hp_list[2], "skill_pattern_3"),
         ]
         
         # EX用スキル（後で start_ex_stage で設定する）
         self.ex_skill = [
             # name, hp, pattern placeholder (hpは合計で設定する)
-            ("EX STAGE", 0, self.ex_pattern_final),
+            ("EX STAGE", 0, "ex_pattern_final"),
         ]
 
         self.is_ex_stage = False  # EX判定フラグ
         
         self.current_skill_index = -1
         self.hp = 0
-        self.skill_start_time = 0  # スキル開始時間 (ms)
         self.clear_times = []  # クリアタイム (秒) のリスト
         self.is_active = False
-        self.pattern_timer = 0
+        self.pattern_timer = 0  # スキル開始からのティック数 (経過時間もこれで計る)
         
         # ランダム移動用の変数
         self.move_timer = 0
@@ -525,11 +2038,15 @@ class Boss(pg.sprite.Sprite):
         current_skill_list = self.skill 
         
         if self.current_skill_index < len(current_skill_list):
-            name, max_hp, pattern_func = current_skill_list[self.current_skill_index]
+            name, max_hp, pattern_name = current_skill_list[self.current_skill_index]
             self.hp = max_hp
-            self.skill_start_time = pg.time.get_ticks() # 開始時間を記録
-            self.current_pattern = pattern_func
+            # 弾幕パターンを発射スケジュールに変換しておく (毎ティックは表を引くだけ)
+            self.current_pattern = pattern_name
+            self.schedule = compile_pattern(pattern_name, self.settings)
             self.is_active = True
+            # 細レーザーを使うスキルは回転画像を先に作っておく (発射時の回転処理をなくす)
+            if self.schedule.uses_laser:
+                LASER_ROTATIONS.prewarm()
             self.pattern_timer = 0  # パターンタイマーリセット
         else:
             # ボス撃破
@@ -538,7 +2055,7 @@ class Boss(pg.sprite.Sprite):
             if not self.is_ex_stage:
                 self.kill()
 
-    def update(self, bullets_group: pg.sprite.Group, player_pos: tuple[int, int]):
+    def update(self, bullets_group: EnemyBulletStore, player_pos: tuple[int, int]):
         if not self.is_active:
             return
 
@@ -548,8 +2065,8 @@ class Boss(pg.sprite.Sprite):
         self.move_timer += 1
         if self.move_timer > 90:
             self.move_timer = 0
-            target_x = random.randint(100, SCREEN_WIDTH - 100)
-            target_y = random.randint(100, 250)
+            target_x = self.rng.randint(100, SCREEN_WIDTH - 100)
+            target_y = self.rng.randint(100, 250)
             self.move_target_pos = (target_x, target_y)
 
         # ターゲットに向かって移動
@@ -561,9 +2078,19 @@ class Boss(pg.sprite.Sprite):
             self.rect.centerx += round((dx / dist) * self.move_speed) # roundで整数化
             self.rect.centery += round((dy / dist) * self.move_speed) # roundで整数化
 
-        # スキル実行（現在のパターン関数を呼ぶ）
-        # pattern 関数のシグネチャは (bullets_group, player_pos)
-        self.current_pattern(bullets_group, player_pos) # 重複削除
+        # スキル実行（現在のパターンの発射スケジュールで、このティックに撃つものを撃つ）
+        self.schedule.fire(bullets_group, self.pattern_timer, self.rect.center, player_pos, self.rng)
+
+    def __getstate__(self) -> dict:
+        """ スナップショット用: 発射スケジュールは保存せず、復元時にパターン名から作り直す """
+        state = self.__dict__.copy()
+        state.pop("schedule", None)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if "current_pattern" in state:
+            self.schedule = compile_pattern(self.current_pattern, self.settings)
 
     def check_skill_transition(self) -> bool:
         """
@@ -573,9 +2100,8 @@ class Boss(pg.sprite.Sprite):
             return False
 
         if self.hp <= 0:
-            # クリアタイムを記録
-            elapsed_time_ms = pg.time.get_ticks() - self.skill_start_time
-            self.clear_times.append(elapsed_time_ms / 1000.0)  # 秒に変換してリストに追加
+            # クリアタイムを記録 (ティック数を秒に変換してリストに追加)
+            self.clear_times.append(self.pattern_timer / FPS)
 
             self.next_skill()
             return True
@@ -601,179 +2127,19 @@ class Boss(pg.sprite.Sprite):
     def get_current_elapsed_time(self) -> float:
         """ 経過時間を返す """
         if self.is_active:
-            return (pg.time.get_ticks() - self.skill_start_time) / 1000.0
+            return self.pattern_timer / FPS
         return 0.0
 
-    def skill_pattern_1(self, bullets_group: pg.sprite.Group, player_pos: tuple[int, int]):
-        """
-        ステージ1: 小弾 (小弾と大弾の全方位弾)
-        """
-        # 難易度別設定
-        if self.difficulty == "EASY":
-            large_bullet_freq = 80
-            large_bullet_density = 6
-            small_bullet_freq = 20
-        elif self.difficulty == "HARD":
-            large_bullet_freq = 40
-            large_bullet_density = 10
-            small_bullet_freq = 8
-        else: # NORMAL
-            large_bullet_freq = 60
-            large_bullet_density = 8
-            small_bullet_freq = 12
-
-        # 大弾
-        if self.pattern_timer % large_bullet_freq == 0:
-            for i in range(large_bullet_density):
-                angle = (360 / large_bullet_density) * i + (self.pattern_timer / 10) + random.uniform(-10, 10)
-                speed = 2
-                bullets_group.add(EnemyLargeBullet(self.rect.center, angle, speed))
-        
-        # 小弾 (自機狙い)
-        if self.pattern_timer % small_bullet_freq == 0:
-            spread = 10
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery, 
-                                                     player_pos[0] - self.rect.centerx))
-            for i in range(-1, 2):
-                angle = angle_to_player + (i * spread) + random.uniform(-5, 5)
-                speed = 4
-                bullets_group.add(EnemyBullet(self.rect.center, angle, speed))
-
-    def skill_pattern_2(self, bullets_group: pg.sprite.Group, player_pos: tuple[int, int]):
-        """
-        ステージ2: レーザー (細レーザーと置きレーザー)
-        """
-        # 難易度別設定
-        if self.difficulty == "EASY":
-            delayed_laser_freq = 120
-            delayed_laser_count = 1
-            laser_freq = 30
-        elif self.difficulty == "HARD":
-            delayed_laser_freq = 60
-            delayed_laser_count = 3
-            laser_freq = 12
-        else: # NORMAL
-            delayed_laser_freq = 90
-            delayed_laser_count = 2
-            laser_freq = 18
-
-        # 置きレーザー
-        if self.pattern_timer % delayed_laser_freq == 0:
-            for _ in range(delayed_laser_count):
-                x = random.randint(50, SCREEN_WIDTH - 50)
-                y = random.randint(SCREEN_HEIGHT // 2, SCREEN_HEIGHT - 50)
-                bullets_group.add(EnemyDelayedLaser((x, y), delay=30, duration=60))
-
-        # 細レーザー (自機狙い)
-        if self.pattern_timer % laser_freq == 0:
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery, 
-                                                     player_pos[0] - self.rect.centerx))
-            bullets_group.add(EnemyLaser(self.rect.center, angle_to_player + random.uniform(-15, 15), 8))
-
-    def skill_pattern_3(self, bullets_group: pg.sprite.Group, player_pos: tuple[int, int]):
-        """
-        ステージ3: 複合弾幕 (全種類使用)
-        """
-        # 難易度別設定 (Normal基準)
-        if self.difficulty == "EASY":
-            p1_freq = 100
-            p1_density = 5
-            p2_freq = 40
-            p3_freq = 70
-        elif self.difficulty == "HARD":
-            p1_freq = 50
-            p1_density = 8
-            p2_freq = 15
-            p3_freq = 35
-        else: # NORMAL
-            p1_freq = 70
-            p1_density = 6
-            p2_freq = 25
-            p3_freq = 50
-
-        # 全方位弾
-        if self.pattern_timer % p1_freq == 0:
-            for i in range(p1_density):
-                angle = (360 / p1_density) * i - (self.pattern_timer / 20) + random.uniform(-5, 5)
-                bullets_group.add(EnemyLargeBullet(self.rect.center, angle, 2))
-        
-        # 自機狙い
-        if self.pattern_timer % p2_freq == 0:
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery, player_pos[0] - self.rect.centerx))
-            bullets_group.add(EnemyBullet(self.rect.center, angle_to_player + random.uniform(-10, 10), 4))
-            
-        # 置きレーザー
-        if self.pattern_timer % p3_freq == 0:
-            x = random.randint(50, SCREEN_WIDTH - 50)
-            y = random.randint(SCREEN_HEIGHT // 2, SCREEN_HEIGHT - 50)
-            bullets_group.add(EnemyDelayedLaser((x, y), delay=30, duration=30))
-
-
-    def ex_pattern_final(self, bullets_group: pg.sprite.Group, player_pos: tuple[int, int]):
-        """
-        EXステージ最終パターン:
-        - 既存の全パターンを高頻度で組み合わせる
-        - さらに特大弾 (EnemyHugeBullet) を追加で発射する
-        """
-        # 全方位（強化）
-        if self.pattern_timer % 40 == 0:
-            density = 10
-            for i in range(density):
-                angle = (360 / density) * i + (self.pattern_timer / 5) + random.uniform(-8, 8)
-                speed = 3
-                bullets_group.add(EnemyLargeBullet(self.rect.center, angle, speed))
-
-        # 自機狙い小弾（強化）
-        if self.pattern_timer % 8 == 0:
-            spread = 15
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery,
-                                                     player_pos[0] - self.rect.centerx))
-            for i in range(-1, 2):
-                angle = angle_to_player + (i * spread) + random.uniform(-6, 6)
-                speed = 5
-                bullets_group.add(EnemyBullet(self.rect.center, angle, speed))
-
-        # 細レーザー（高頻度）
-        if self.pattern_timer % 15 == 0:
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery,
-                                                     player_pos[0] - self.rect.centerx))
-            bullets_group.add(EnemyLaser(self.rect.center, angle_to_player + random.uniform(-10, 10), 9))
-
-        # 置きレーザー（短めの遅延・頻度高め）
-        if self.pattern_timer % 30 == 0:
-            x = random.randint(50, SCREEN_WIDTH - 50)
-            y = random.randint(SCREEN_HEIGHT // 3, SCREEN_HEIGHT - 50)
-            bullets_group.add(EnemyDelayedLaser((x, y), delay=20, duration=40))
-
-        # 特大弾（円形に展開するもの）
-        if self.pattern_timer % 150 == 0:
-            count = 4
-            for i in range(count):
-                angle = (360 / count) * i + self.pattern_timer
-                speed = 1.5
-                bullets_group.add(EnemyHugeBullet(self.rect.center, angle, speed))
-
-        # 特大弾（自機狙いでゆっくり発射）
-        if self.pattern_timer % 90 == 0:
-            angle_to_player = math.degrees(math.atan2(player_pos[1] - self.rect.centery,
-                                                     player_pos[0] - self.rect.centerx))
-            bullets_group.add(EnemyHugeBullet(self.rect.center, angle_to_player + random.uniform(-5, 5), 2.5))
-
     def start_ex_stage(self):
         """ EXステージを開始するための設定を行う """
         self.is_ex_stage = True
         self.current_skill_index = -1 # ex_skillリストのインデックス
         
         # EX用HP設定 (難易度別)
-        if self.difficulty == "EASY":
-            ex_hp = 500
-        elif self.difficulty == "HARD":
-            ex_hp = 1500
-        else: # NORMAL
-            ex_hp = 1000
+        ex_hp = self.settings["ex_hp"]
             
         # スキルリストをEX用に差し替え
-        # (self.ex_skill[0][0] は "EX STAGE", [0][2] は ex_pattern_final メソッド)
+        # (self.ex_skill[0][0] は "EX STAGE", [0][2] は "ex_pattern_final")
         self.ex_skill[0] = (self.ex_skill[0][0], ex_hp, self.ex_skill[0][2])
         self.skill = self.ex_skill 
         
@@ -848,42 +2214,167 @@ class LevelChange:
         pg.display.flip()
 
 
-def draw_ui(screen: pg.Surface, score: int, lives: int, boss: Boss, bomb: int): # bomb を BombArea から int に修正
+class TextCache:
     """
-    UI（スコア、残機、ボスHP、ボム数など）を描画する
+    描画済み文字列のキャッシュ
+    同じ (文字列, 色) は一度だけ font.render し、以降は同じ Surface を返す
     """
-    font = pg.font.Font(None, 36)
-    
-    # スコア
-    score_text = font.render(f"Score: {score}", True, WHITE)
-    screen.blit(score_text, (10, 10))
+    def __init__(self, font: pg.font.Font, max_entries: int = 128):
+        self.font = font
+        self.max_entries = max_entries
+        self.surfaces: OrderedDict[tuple[str, tuple[int, int, int]], pg.Surface] = OrderedDict()
+
+    def render(self, text: str, color: tuple[int, int, int]) -> pg.Surface:
+        key = (text, color)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.font.render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.max_entries:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+
+class DigitAtlas:
+    """
+    数字グリフのアトラス
+    スコアやタイマーのように毎フレーム変わる数値を、描画済みの1文字ずつの画像を並べて作る
+    """
+    CHARS = "0123456789.-"
+
+    def __init__(self, font: pg.font.Font, color: tuple[int, int, int]):
+        self.glyphs = {c: font.render(c, True, color) for c in self.CHARS}
+        self.height = max(g.get_height() for g in self.glyphs.values())
+
+    def render(self, text: str) -> pg.Surface:
+        glyphs = [self.glyphs[c] for c in text]
+        surface = pg.Surface((sum(g.get_width() for g in glyphs), self.height), pg.SRCALPHA)
+        x = 0
+        for glyph in glyphs:
+            surface.blit(glyph, (x, 0))
+            x += glyph.get_width()
+        return surface
 
-    # 残機
-    lives_text = font.render(f"Lives: {lives}", True, WHITE)
-    screen.blit(lives_text, (10, 40))
-    
-    # ボム数
-    bomb_text = font.render(f"Bomb: {bomb}", True, (255, 165, 0))
-    screen.blit(bomb_text, (120, 40)) 
-
-    # ボスHP
-    if boss and getattr(boss, "is_active", False): # bossがNoneでないことも確認
-        skill_name = boss.get_current_skill_name()
-        skill_text = font.render(skill_name, True, WHITE)
-        screen.blit(skill_text, (SCREEN_WIDTH // 2 - skill_text.get_width() // 2, 10))
-
-        # HPバー（EX中は色を変える）
-        max_hp = boss.get_current_skill_max_hp()
-        hp_ratio = boss.hp / max_hp if max_hp > 0 else 0
-        hp_bar_width = max(0, (SCREEN_WIDTH - 40) * hp_ratio)
-        pg.draw.rect(screen, (100, 100, 100), (20,  70, SCREEN_WIDTH - 40, 20))
-        hp_color = (255, 0, 255) if getattr(boss, "is_ex_stage", False) else (255, 0, 0)
-        pg.draw.rect(screen, hp_color, (20, 70, hp_bar_width, 20))
-
-        # 経過時間
-        elapsed_time = boss.get_current_elapsed_time()
-        time_text = font.render(f"Time: {elapsed_time:.2f}", True, WHITE)  # 小数点以下2桁
-        screen.blit(time_text, (SCREEN_WIDTH - time_text.get_width() - 10, 10))
+
+class HudWidget:
+    """
+    HUD の1項目 (ラベル + 数値)
+    値が変わった時だけ画像を作り直し、それ以外は前回の画像をそのまま使う
+    """
+    def __init__(self, label: pg.Surface, atlas: DigitAtlas, pos: tuple[int, int], align: str = "left"):
+        self.label = label
+        self.atlas = atlas
+        self.pos = pos
+        self.align = align  # "left" または "right" (pos を右端として右寄せ)
+        self.value: str | None = None
+        self.surface: pg.Surface | None = None
+        self.rect = pg.Rect(pos, (0, 0))
+        self.previous_rect = self.rect  # 幅が縮んだ時に前回の範囲も描き直せるように残す
+        self.dirty = False  # 前回の描画から見た目が変わったか
+
+    def set(self, value: str):
+        if value == self.value:
+            self.dirty = False
+            return
+        self.value = value
+        self.previous_rect = self.rect
+        digits = self.atlas.render(value)
+        self.surface = pg.Surface((self.label.get_width() + digits.get_width(),
+                                   max(self.label.get_height(), digits.get_height())), pg.SRCALPHA)
+        self.surface.blit(self.label, (0, 0))
+        self.surface.blit(digits, (self.label.get_width(), 0))
+
+        self.rect = self.surface.get_rect(topleft=self.pos)
+        if self.align == "right":
+            self.rect.topright = self.pos
+        self.dirty = True
+
+    def draw(self, screen: pg.Surface) -> pg.Rect:
+        if self.surface is not None:
+            return screen.blit(self.surface, self.rect)
+        return pg.Rect(self.rect.topleft, (0, 0))
+
+
+class Hud:
+    """
+    UI（スコア、残機、ボスHP、ボム数など）の描画を担当するクラス
+    フォントと描画済みの文字画像を保持し、毎フレームの font.render をなくす
+    """
+    def __init__(self):
+        self.font = pg.font.Font(None, 36)
+        self.font_prompt = pg.font.Font(None, 40)
+        self.text = TextCache(self.font)
+        self.prompt_text = TextCache(self.font_prompt)
+
+        white_digits = DigitAtlas(self.font, WHITE)
+        orange = (255, 165, 0)
+        self.score = HudWidget(self.text.render("Score: ", WHITE), white_digits, (10, 10))
+        self.lives = HudWidget(self.text.render("Lives: ", WHITE), white_digits, (10, 40))
+        self.bomb = HudWidget(self.text.render("Bomb: ", orange), DigitAtlas(self.font, orange), (120, 40))
+        self.time = HudWidget(self.text.render("Time: ", WHITE), white_digits, (SCREEN_WIDTH - 10, 10), align="right")
+        self.widgets = [self.score, self.lives, self.bomb, self.time]
+        self.frames = 0  # draw を呼んだ回数 (数値の更新の間引き用)
+
+    def draw(self, screen: pg.Surface, score: int, lives: int, boss: Boss, bomb: int,
+             interval: int = 1) -> list[pg.Rect]:
+        """
+        HUD を描画し、描いた範囲のリストを返す (差分描画用)
+        interval: 数値を更新する間隔 (フレーム)。間の回は前回の画像をそのまま描く
+        """
+        self.frames += 1
+        refresh = self.frames % interval == 0 or self.score.value is None
+        # スコア・残機・ボム数
+        if refresh:
+            self.score.set(str(score))
+            self.lives.set(str(lives))
+            self.bomb.set(str(bomb))
+        drawn = [self.score.draw(screen), self.lives.draw(screen), self.bomb.draw(screen)]
+
+        # ボスHP
+        if boss and getattr(boss, "is_active", False): # bossがNoneでないことも確認
+            skill_text = self.text.render(boss.get_current_skill_name(), WHITE)
+            drawn.append(screen.blit(skill_text, (SCREEN_WIDTH // 2 - skill_text.get_width() // 2, 10)))
+
+            # HPバー（EX中は色を変える）
+            max_hp = boss.get_current_skill_max_hp()
+            hp_ratio = boss.hp / max_hp if max_hp > 0 else 0
+            hp_bar_width = max(0, (SCREEN_WIDTH - 40) * hp_ratio)
+            drawn.append(pg.draw.rect(screen, (100, 100, 100), (20,  70, SCREEN_WIDTH - 40, 20)))
+            hp_color = (255, 0, 255) if getattr(boss, "is_ex_stage", False) else (255, 0, 0)
+            pg.draw.rect(screen, hp_color, (20, 70, hp_bar_width, 20))
+
+            # 経過時間 (小数点以下2桁)
+            if refresh or self.time.value is None:
+                self.time.set(f"{boss.get_current_elapsed_time():.2f}")
+            drawn.append(self.time.draw(screen))
+        return drawn
+
+    def draw_respawn_prompt(self, screen: pg.Surface) -> pg.Rect:
+        """ 復活待機中の表示 """
+        text = self.prompt_text.render("Press SPACE to Respawn", WHITE)
+        return screen.blit(text, (SCREEN_WIDTH // 2 - text.get_width() // 2, SCREEN_HEIGHT // 2 + 100))
+
+
+# HUD は最初に描画する時に作る (フォントの初期化後である必要があるため)
+_hud: Hud | None = None
+
+
+def get_hud() -> Hud:
+    global _hud
+    if _hud is None:
+        _hud = Hud()
+    return _hud
+
+
+def draw_ui(screen: pg.Surface, score: int, lives: int, boss: Boss, bomb: int, # bomb を BombArea から int に修正
+            interval: int = 1) -> list[pg.Rect]:
+    """
+    UI（スコア、残機、ボスHP、ボム数など）を描画し、描いた範囲のリストを返す
+    interval: 数値を更新する間隔 (フレーム)
+    """
+    return get_hud().draw(screen, score, lives, boss, bomb, interval)
 
 
 def draw_game_over(screen: pg.Surface):
@@ -978,41 +2469,899 @@ def draw_ex_results(screen: pg.Surface, time: float):
     screen.blit(continue_text, (SCREEN_WIDTH // 2 - continue_text.get_width() // 2, y_offset))
 
 
+class FixedTimestep:
+    """
+    固定タイムステップ (1ティック = 1/60秒)
+    実際の経過時間をためておき、1ティック分たまるごとにゲームを1ティック進める
+    描画は残りの端数 (alpha) で前後のティックの間を補間する
+    処理が重い時は描画フレームが間引かれるだけで、ティックごとのゲームの動きは変わらない
+    """
+    def __init__(self, tick_rate: float = FPS, max_ticks_per_frame: int = 8):
+        self.tick_seconds = 1.0 / tick_rate
+        self.max_ticks_per_frame = max_ticks_per_frame  # これを超えて遅れた分は諦める (処理落ち)
+        self.reset()
+
+    def reset(self):
+        """ ステージ開始時などに呼び、たまった時間を捨てる """
+        self.accumulator = 0.0
+        self.last_time = time.perf_counter()
+        self.alpha = 1.0
+
+    def advance(self) -> int:
+        """ 前回からの経過時間を加算し、このフレームで進めるティック数を返す """
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+        ticks = int(self.accumulator / self.tick_seconds)
+        if ticks > self.max_ticks_per_frame:
+            ticks = self.max_ticks_per_frame
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= ticks * self.tick_seconds
+        self.alpha = self.accumulator / self.tick_seconds
+        return ticks
+
+
+class GcPolicy:
+    """
+    プレイ中に GC (循環参照の回収) でフレームが止まらないようにする
+    プレイが始まったら、それまでに作ったオブジェクトを gc.freeze() で回収の対象外にして自動の GC を止め、
+    演出・リザルトなどプレイ以外の画面になったらまとめて回収する
+    プレイ中でも回収されていないオブジェクトが emergency_threshold を超えたら、若い世代だけ回収する (メモリの保険)
+    """
+    def __init__(self, enabled: bool = True, emergency_threshold: int = 200_000):
+        self.enabled = enabled
+        self.emergency_threshold = emergency_threshold
+        self.playing = False
+        self.emergency_collections = 0  # プレイ中に保険で回収した回数
+
+    def update(self, playing: bool):
+        """ 毎フレーム呼ぶ (playing: 今プレイ中か) """
+        if not self.enabled:
+            return
+        if playing != self.playing:
+            self.playing = playing
+            if playing:
+                # ここで回収すると最初のフレームが止まるので、今あるものはゴミも含めて対象外にするだけ
+                # (プレイが終わった時に unfreeze してまとめて回収する)
+                gc.freeze()
+                gc.disable()
+            else:
+                gc.unfreeze()
+                gc.enable()
+                gc.collect()
+        elif playing and gc.get_count()[0] > self.emergency_threshold:
+            gc.collect(0)
+            self.emergency_collections += 1
+
+
+class QualityGovernor:
+    """
+    フレームの処理時間に合わせて描画品質の段階 (QUALITY_*) を自動で上げ下げする
+    直近 window フレームの平均が予算 (難易度の設定の quality.budget_ms) を超えたら1段階軽くし、
+    予算の headroom 倍を下回る状態が recover_frames フレーム続いたら1段階戻す (行ったり来たりしないように戻す方を慎重にする)
+    段階を変えた後の hold_frames フレームは、変えた効果が平均に出るまで次の変更をしない
+    """
+    def __init__(self, window: int = 30, headroom: float = 0.6, recover_frames: int = 180, hold_frames: int = 60):
+        self.window = window
+        self.headroom = headroom
+        self.recover_frames = recover_frames
+        self.hold_frames = hold_frames
+        self.samples: deque[float] = deque(maxlen=window)  # 直近のフレームの処理時間 (ミリ秒)
+        self.config = DIFFICULTY_TABLE["NORMAL"]["quality"]
+        self.ex = False
+        self.decisions: list[tuple[int, int, float]] = []  # 段階を変えた記録 (フレーム, 新しい段階, その時の平均ミリ秒)
+        self.reset()
+
+    def configure(self, config: dict, ex: bool = False):
+        """ ステージ開始時に呼び、難易度の設定 (quality) を使うようにして通常の品質に戻す """
+        self.config = config
+        self.ex = ex
+        self.reset()
+
+    def reset(self):
+        self.level = QUALITY_FULL
+        self.samples.clear()
+        self.frame = 0
+        self.hold = self.hold_frames  # 開始直後は読み込みなどで重くなりやすいので様子を見る
+        self.calm_frames = 0
+
+    @property
+    def bullet_cap(self) -> int | None:
+        """ 今の段階での敵弾数の上限 (上限を設けない段階なら None) """
+        if self.level < QUALITY_BULLET_CAP:
+            return None
+        return self.config["ex_bullet_cap" if self.ex else "bullet_cap"]
+
+    def record(self, ms: float) -> int:
+        """ プレイ中の1フレームの処理時間 (ミリ秒、待ち時間を除く) を記録し、品質の段階を返す """
+        self.samples.append(ms)
+        self.frame += 1
+        if self.hold > 0:
+            self.hold -= 1
+            return self.level
+        if len(self.samples) < self.window:
+            return self.level
+        average = sum(self.samples) / len(self.samples)
+        budget = self.config["budget_ms"]
+        if average > budget:
+            self.calm_frames = 0
+            if self.level < self.config["max_level"]:
+                self._change(self.level + 1, average)
+        elif average < budget * self.headroom and self.level > QUALITY_FULL:
+            self.calm_frames += 1
+            if self.calm_frames >= self.recover_frames:
+                self._change(self.level - 1, average)
+        else:
+            self.calm_frames = 0
+        return self.level
+
+    def _change(self, level: int, average: float):
+        direction = "下げます" if level > self.level else "戻します"
+        print(f"描画品質を{direction}: {QUALITY_NAMES[level]} (段階 {level}, "
+              f"直近の平均 {average:.1f} ms / 予算 {self.config['budget_ms']:.1f} ms)")
+        self.level = level
+        self.hold = self.hold_frames
+        self.calm_frames = 0
+        self.decisions.append((self.frame, level, round(average, 2)))
+
+    def apply(self, world: "GameWorld"):
+        """ 今の段階を world の描画と敵弾数の上限に反映する (毎フレーム呼ぶ) """
+        level = self.level
+        world.quality = level
+        world.bullet_cap = self.bullet_cap
+        world.enemy_bullets.set_draw_quality(level >= QUALITY_OPAQUE_WARNING, level >= QUALITY_DOT_BULLETS)
+
+
+# 効果音の設定 (同じファイルを使う効果音は1回だけ読み込む)
+# volume: 1回だけ鳴らす時の音量, channels: この効果音専用に確保するチャンネルの数,
+# interval: 鳴らし直すまでの最短の間隔 (ミリ秒), priority: 1フレームに鳴らせる数を超えた時に優先する順 (大きいほど優先)
+SOUND_EFFECTS = {
+    "hit": {"path": "data/se_hit.wav", "volume": 1.0, "channels": 1, "interval": 0, "priority": 3},
+    "bomb": {"path": "data/8bit_read2.mp3", "volume": 0.5, "channels": 1, "interval": 0, "priority": 2},
+    "powerup": {"path": "data/8bit_read2.mp3", "volume": 1.0, "channels": 2, "interval": 50, "priority": 1},
+    "graze": {"path": "data/se_graze.wav", "volume": 0.6, "channels": 2, "interval": 50, "priority": 0},
+}
+MAX_SOUNDS_PER_FRAME = 3  # 1フレームに鳴らし始める効果音の数の上限
+
+
+class SoundManager:
+    """
+    効果音の管理
+    全ての効果音を最初に1回だけ読み込み、種類ごとに専用のチャンネルを確保しておく
+    ゲームの処理中は trigger で鳴らす回数を数えるだけにして、フレームの最後の flush でまとめて鳴らす
+    (同じフレームの同じ効果音は回数に関係なく1回の再生にまとめ、回数が多いほど音量を上げる)
+    """
+    def __init__(self, effects: dict = SOUND_EFFECTS, max_per_frame: int = MAX_SOUNDS_PER_FRAME):
+        self.effects = effects
+        self.max_per_frame = max_per_frame
+        self.sounds: dict[str, pg.mixer.Sound] = {}           # 読み込めた効果音だけ
+        self.channels: dict[str, list[pg.mixer.Channel]] = {}
+        self.turn: dict[str, int] = {}         # 次に使うチャンネル (順番に使うので、一番前に鳴らし始めたもの)
+        self.last_played: dict[str, int] = {}  # 最後に鳴らした時刻 (ミリ秒)
+        self.pending: dict[str, int] = {}      # このフレームで鳴らす回数
+        self.played = 0   # 鳴らした回数 (計測用)
+        self.dropped = 0  # 間隔・上限のために鳴らさなかった回数 (計測用)
+
+        if not pg.mixer.get_init():
+            return  # サウンドが使えない環境では何も鳴らさない
+
+        # チャンネルを種類ごとに確保し、Sound.play() の自動割り当てには使わせない
+        total = sum(effect["channels"] for effect in effects.values())
+        pg.mixer.set_num_channels(max(pg.mixer.get_num_channels(), total))
+        pg.mixer.set_reserved(total)
+        loaded: dict[str, pg.mixer.Sound | None] = {}
+        first = 0
+        for name, effect in effects.items():
+            path = effect["path"]
+            if path not in loaded:
+                try:
+                    loaded[path] = pg.mixer.Sound(path)
+                except (pg.error, FileNotFoundError):
+                    print(f"Warning: 効果音ファイルが見つかりません: {path}")
+                    loaded[path] = None
+            if loaded[path] is not None:
+                self.sounds[name] = loaded[path]
+            self.channels[name] = [pg.mixer.Channel(first + i) for i in range(effect["channels"])]
+            self.turn[name] = 0
+            first += effect["channels"]
+
+    def trigger(self, name: str, count: int = 1):
+        """ 効果音を count 回鳴らす予約をする (実際に鳴らすのは flush) """
+        if name in self.sounds:
+            self.pending[name] = self.pending.get(name, 0) + count
+
+    def flush(self, now: int | None = None) -> int:
+        """
+        予約された効果音を優先度の高い順に1回ずつ鳴らす (1フレームに1回呼ぶ)、鳴らした数を返す
+        前回から interval ミリ秒たっていない効果音と、max_per_frame を超えた分は鳴らさない
+        """
+        if not self.pending:
+            return 0
+        now = pg.time.get_ticks() if now is None else now
+        started = 0
+        for name in sorted(self.pending, key=lambda n: -self.effects[n]["priority"]):
+            count = self.pending[name]
+            effect = self.effects[name]
+            last = self.last_played.get(name)
+            if started >= self.max_per_frame or (last is not None and now - last < effect["interval"]):
+                self.dropped += count
+                continue
+            channels = self.channels[name]
+            channel = channels[self.turn[name]]
+            self.turn[name] = (self.turn[name] + 1) % len(channels)
+            # 2倍の回数ごとに音量を 1/4 ずつ上げる (上限は 1.0)
+            channel.set_volume(min(1.0, effect["volume"] * (1 + 0.25 * math.log2(count))))
+            channel.play(self.sounds[name])  # 使用中なら前の音を止めて鳴らし直す
+            self.last_played[name] = now
+            started += 1
+        self.pending.clear()
+        self.played += started
+        return started
+
+
+class FrameProfiler:
+    """
+    1フレームの処理時間を区間ごとに計測するクラス
+    区間の始めに start()、終わりに lap(名前) を呼ぶ (同じ名前は1フレームの中で合計される)
+    計測しない時は profiler を None にしておけば、呼び出し側の if 1つ分しかかからない
+    """
+    def __init__(self):
+        self.current: dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def lap(self, name: str):
+        now = time.perf_counter()
+        self.current[name] = self.current.get(name, 0.0) + (now - self._last)
+        self._last = now
+
+    def end_frame(self) -> dict[str, float]:
+        """ このフレームの計測結果 (区間名 -> 秒) を返し、次のフレームの計測に備える """
+        frame, self.current = self.current, {}
+        return frame
+
+
+# プロファイラで計測するメインループの区間 (グラフでは下からこの順に積み上げる)
+PROFILE_PHASES = ("events", "player", "boss", "bullets", "collision", "bomb", "draw", "hud", "flip")
+PROFILE_COLORS = ((150, 150, 150), (0, 160, 255), (255, 0, 128), (255, 200, 0), (255, 80, 0),
+                  (255, 165, 0), (0, 220, 120), (180, 120, 255), (90, 90, 255))
+
+
+class ProfilerOverlay:
+    """
+    区間ごとのフレーム時間をゲーム画面に重ねて表示するオーバーレイ
+    F3 で表示の切り替え、F4 で記録中のサンプルを CSV に保存する
+    表示していない間は profiler が None なので、計測のコストはほぼかからない
+    """
+    GRAPH_HEIGHT = 100
+    MS_PER_GRAPH = 100 / 3  # グラフの高さ = 33.3ms (30fps 相当)
+
+    def __init__(self, capacity: int = 240):
+        self.capacity = capacity
+        self.enabled = False
+        self.profiler: FrameProfiler | None = None
+
+        # 固定長のリングバッファ (index が次に書き込む位置)
+        self.samples = np.zeros((capacity, len(PROFILE_PHASES)), np.float32)  # ミリ秒
+        self.bullets = np.zeros(capacity, np.int32)
+        self.index = 0
+        self.count = 0
+        self.frames = 0  # 記録したフレームの累計 (凡例の更新間隔に使う)
+
+        # 表示用 (最初に表示する時に作る)
+        self.graph: pg.Surface | None = None
+        self.panel: pg.Surface | None = None  # 凡例の下に敷く半透明の板
+        self.text: TextCache | None = None
+        self.legend: list[pg.Surface] = []
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.profiler = FrameProfiler() if self.enabled else None
+        if self.enabled and self.graph is None:
+            self.graph = pg.Surface((self.capacity, self.GRAPH_HEIGHT))
+            self.graph.set_alpha(200)
+            self.panel = pg.Surface((170, 14 * (len(PROFILE_PHASES) + 2) + 6))
+            self.panel.set_alpha(160)
+            self.text = TextCache(pg.font.Font(None, 20))
+        if self.graph is not None:
+            self.graph.fill(BLACK)
+        self.index = self.count = self.frames = 0
+        self.legend = []
+
+    def end_frame(self, bullet_count: int):
+        """ 1フレーム分の計測結果をリングバッファに入れ、グラフに1列描き足す """
+        if self.profiler is None:
+            return
+        frame = self.profiler.end_frame()
+        row = self.samples[self.index]
+        for i, phase in enumerate(PROFILE_PHASES):
+            row[i] = frame.get(phase, 0.0) * 1000
+        self.bullets[self.index] = bullet_count
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.frames += 1
+
+        # グラフを1ピクセル左に流し、右端に今回のフレームを積み上げて描く
+        graph = self.graph
+        width, height = graph.get_size()
+        graph.scroll(-1, 0)
+        graph.fill(BLACK, (width - 1, 0, 1, height))
+        scale = height / self.MS_PER_GRAPH
+        y = float(height)
+        for ms, color in zip(row, PROFILE_COLORS):
+            top = max(0.0, y - ms * scale)
+            if int(y) > int(top):
+                graph.fill(color, (width - 1, int(top), 1, int(y) - int(top)))
+            y = top
+
+        # 凡例 (直近1秒の平均) は0.5秒ごとに作り直す
+        if self.frames % (FPS // 2) == 1 or not self.legend:
+            self.legend = self._render_legend()
+
+    def _recent(self, frames: int) -> np.ndarray:
+        """ 直近 frames フレーム分のサンプルのインデックス (古い順) """
+        frames = min(frames, self.count)
+        return (np.arange(self.index - frames, self.index)) % self.capacity
+
+    def _render_legend(self) -> list[pg.Surface]:
+        recent = self._recent(FPS)
+        if len(recent) == 0:
+            return []
+        means = self.samples[recent].mean(axis=0)
+        lines = [self.text.render(f"{phase:<9} {ms:6.2f} ms", color)
+                 for phase, ms, color in zip(PROFILE_PHASES, means, PROFILE_COLORS)]
+        lines.append(self.text.render(f"total     {means.sum():6.2f} ms", WHITE))
+        lines.append(self.text.render(f"bullets   {int(self.bullets[recent[-1]])}", WHITE))
+        return lines
+
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
+        """ オーバーレイを描画し、描いた範囲のリストを返す """
+        if not self.enabled:
+            return []
+        left, top = 10, SCREEN_HEIGHT - self.GRAPH_HEIGHT - 20
+        drawn = [screen.blit(self.graph, (left, top))]
+        # 16.7ms (60fps) の目安線
+        y = top + self.GRAPH_HEIGHT - int(1000 / FPS * self.GRAPH_HEIGHT / self.MS_PER_GRAPH)
+        pg.draw.line(screen, WHITE, (left, y), (left + self.capacity - 1, y))
+        x = left + self.capacity + 10
+        y = SCREEN_HEIGHT - 20 - 14 * len(self.legend)
+        drawn.append(screen.blit(self.panel, (x - 4, y - 3)))
+        for line in self.legend:
+            screen.blit(line, (x, y))
+            y += 14
+        return drawn
+
+    def dump_csv(self, path: str | None = None) -> str | None:
+        """ リングバッファの中身を古い順に CSV に保存し、保存先を返す """
+        if self.count == 0:
+            return None
+        path = path or time.strftime("profile_%Y%m%d_%H%M%S.csv")
+        recent = self._recent(self.count)
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", *(f"{phase}_ms" for phase in PROFILE_PHASES), "total_ms", "bullets"])
+            for frame, i in enumerate(recent):
+                row = self.samples[i]
+                writer.writerow([frame, *(f"{ms:.4f}" for ms in row), f"{row.sum():.4f}", int(self.bullets[i])])
+        return path
+
+
+class DirtyRenderer:
+    """
+    差分描画 (ダーティ矩形)
+    前のフレームで描いた範囲だけを背景で塗り直してから描画し、前回と今回に描いた範囲だけを
+    pg.display.update(rects) で画面に送る
+    描き直す範囲が画面の full_ratio を超えた時や、別の画面を全体に描いた後は、
+    背景全体の描画と pg.display.flip() に自動で切り替える
+    """
+    def __init__(self, full_ratio: float = 0.5, enabled: bool = True):
+        self.enabled = enabled  # False なら毎フレーム画面全体を描き直す (従来の描画)
+        self.full_area = SCREEN_WIDTH * SCREEN_HEIGHT * full_ratio
+        self.previous: list[pg.Rect] = []  # 前のフレームで描いた範囲
+        self.full_redraw = True  # 次のフレームは画面全体を描き直す
+        self._full = True
+
+    @staticmethod
+    def _area(rects: list[pg.Rect]) -> int:
+        """ 範囲の面積の合計 (重なりは重複して数える) """
+        return sum(rect.w * rect.h for rect in rects)
+
+    def invalidate(self):
+        """ 画面全体を別の内容で描いた後などに呼び、次のフレームを全体の描き直しにする """
+        self.full_redraw = True
+
+    def begin(self, screen: pg.Surface, background: pg.Surface | None):
+        """ フレームの描画前に、前のフレームで描いた範囲を背景に戻す (広すぎれば背景全体を描く) """
+        self._full = not self.enabled or self.full_redraw or self._area(self.previous) > self.full_area
+        if self._full:
+            if background:
+                screen.blit(background, (0, 0))
+            else:
+                screen.fill(BLACK)
+        elif background:
+            screen.blits([(background, rect, rect) for rect in self.previous], False)
+        else:
+            for rect in self.previous:
+                screen.fill(BLACK, rect)
+
+    def present(self, drawn: list[pg.Rect] | None):
+        """
+        前回と今回に描いた範囲を画面に送る (drawn: このフレームで描いた範囲)
+        drawn が None なら画面全体を別の内容で描いたものとして flip する
+        """
+        if drawn is None:
+            pg.display.flip()
+            self.previous = []
+            self.full_redraw = True
+            return
+        if self._full or self._area(self.previous) + self._area(drawn) > self.full_area:
+            pg.display.flip()
+        else:
+            pg.display.update(self.previous + drawn)
+        self.previous = drawn
+        self.full_redraw = False
+
+
+def remember_positions(*groups):
+    """ 描画の補間用に、ティック開始時点の位置を覚えておく """
+    for group in groups:
+        for sprite in group:
+            sprite.prev_pos = sprite.rect.topleft
+
+
+# RenderQueue の描画レイヤー (小さい順に奥から描く)
+LAYER_SPRITES = 0         # プレイヤー・ボス
+LAYER_PLAYER_BULLETS = 1  # 自機の弾
+LAYER_ENEMY_BULLETS = 2   # 敵弾
+LAYER_ITEMS = 3           # パワーアップアイテム
+RENDER_LAYERS = 4
+
+
+def _texture_key(item: tuple[pg.Surface, tuple[float, float]]) -> int:
+    return id(item[0])
+
+
+class RenderQueue:
+    """
+    1フレーム分の (Surface, 位置) を集めて、レイヤー順・画像ごとに並べ替えてまとめて描くキュー
+    Python からの blit 呼び出しを 1フレームに 1回 (blits / fblits) にする
+    """
+    def __init__(self, layers: int = RENDER_LAYERS):
+        self.layers = [[] for _ in range(layers)]
+        self.unsorted = [False] * layers  # 並べ替えが必要なレイヤー
+        self.has_fblits = hasattr(pg.Surface, "fblits")  # pygame-ce にしかない
+        self.last_count = 0  # 直前の flush で描いた数
+
+    def add(self, surface: pg.Surface, pos: tuple[float, float], layer: int):
+        """ 1枚追加する """
+        items = self.layers[layer]
+        if items and items[-1][0] is not surface:
+            self.unsorted[layer] = True
+        items.append((surface, pos))
+
+    def add_sprites(self, sprites, alpha: float, layer: int):
+        """
+        スプライトをまとめて追加する (alpha: 前ティックから現在までの補間割合)
+        is_visible が False のスプライト (点滅中のプレイヤー) は描かない
+        """
+        items = self.layers[layer]
+        append = items.append
+        last = items[-1][0] if items else None
+        mixed = self.unsorted[layer]  # 別の画像が混ざったら flush で並べ替える
+        interpolate = alpha < 1.0
+        for sprite in sprites:
+            if not getattr(sprite, "is_visible", True):
+                continue
+            x, y = sprite.rect.topleft
+            prev = getattr(sprite, "prev_pos", None)
+            if interpolate and prev is not None:  # 前ティックの位置と現在の位置の間を alpha で補間
+                px, py = prev
+                x, y = px + (x - px) * alpha, py + (y - py) * alpha
+            image = sprite.image
+            if image is not last:
+                mixed = mixed or last is not None
+                last = image
+            append((image, (x, y)))
+        self.unsorted[layer] = mixed
+
+    def extend(self, items: list[tuple[pg.Surface, tuple[float, float]]], layer: int, grouped: bool = False):
+        """ まとめて追加する (grouped=True なら items は既に画像ごとに並んでいる) """
+        target = self.layers[layer]
+        if not target and grouped:
+            self.layers[layer] = items
+            return
+        if items:
+            target.extend(items)
+            self.unsorted[layer] = True
+
+    def flush(self, screen: pg.Surface, doreturn: bool = False) -> list[pg.Rect] | None:
+        """
+        溜めたものを描いてキューを空にする
+        doreturn=True なら描いた範囲の Rect のリストを返す (差分描画用)
+        """
+        sequence = []
+        for layer, items in enumerate(self.layers):
+            if self.unsorted[layer] and len(items) > 1:
+                items.sort(key=_texture_key)  # 安定ソートなので同じ画像の中では追加順を保つ
+            sequence += items
+            self.layers[layer] = []
+            self.unsorted[layer] = False
+        self.last_count = len(sequence)
+        if doreturn:
+            return screen.blits(sequence, True)
+        if self.has_fblits:
+            screen.fblits(sequence)
+        else:
+            screen.blits(sequence, False)
+        return None
+
+
+RENDER_QUEUE = RenderQueue()
+
+
+class SnapshotPickler(pickle.Pickler):
+    """
+    スナップショット用の pickler
+    Surface はピクセルを保存せず、共有アセットの読み込み方 (ASSETS.recipe) として保存する
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, pg.Surface):
+            return ("asset", ASSETS.recipe(obj))
+        return None
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """
+    SnapshotPickler で保存したものを読み込む (画像は共有アセットから取り直す)
+    pickle なので、自分で記録したスナップショット以外は読み込まないこと
+    """
+    def persistent_load(self, pid):
+        kind, recipe = pid
+        if kind != "asset":
+            raise pickle.UnpicklingError(f"不明な persistent id: {kind}")
+        return ASSETS.image(*recipe)
+
+
+class GameWorld:
+    """
+    ステージ (通常の STAGE1～3 と EXステージ) のゲーム進行を管理するクラス
+    tick() で1ティック (1/60秒) 分だけ進め、draw() で補間して描画する
+    通常ステージと EX の違い (スコアの配点など) は MODE_RULES[mode] だけで決まる
+    同じ seed と同じ入力の列を与えれば、毎回同じ展開になる (リプレイ用)
+    """
+    # スナップショットに含めない表示・音声・計測用の属性 (復元したら今のものを付け直す)
+    PRESENTATION_ATTRS = ("sounds", "background_image", "profiler", "quality")
+
+    def __init__(self, difficulty: str, overrides: dict | None = None, seed: int | None = None,
+                 sounds: SoundManager | None = None):
+        self.difficulty = difficulty
+        # 難易度別の設定 (overrides でバランス調整用に一部を上書きできる)
+        self.overrides = dict(overrides or {})
+        self.settings = difficulty_settings(difficulty, overrides)
+
+        # 乱数は全てこのシードから用途別に作る (グローバルの random は使わない)
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.item_rng = rng_stream(self.seed, "items")
+
+        # インスタンスを生成 (難易度を渡す)
+        self.player = Player(difficulty, self.settings)
+        self.boss = Boss(difficulty, self.settings, rng_stream(self.seed, "boss"))
+        self.all_sprites = pg.sprite.Group(self.player, self.boss) # PlayerとBossもGroupに追加
+        self.player_bullets = PlayerBulletStore()
+        self.enemy_bullets = EnemyBulletStore()
+        self.items = pg.sprite.Group()
+
+        # 効果音 (None なら鳴らさない)
+        self.sounds = sounds
+
+        self.background_image: pg.Surface | None = None
+        self.profiler: FrameProfiler | None = None  # 処理時間の区間計測 (計測する時だけ設定する)
+        self.quality = QUALITY_FULL  # 描画品質の段階 (QualityGovernor が設定する、None は QUALITY_FULL)
+
+        # ゲーム変数
+        self.mode = "normal"  # MODE_RULES のキー (start_ex で "ex" になる)
+        self.state = "playing"  # "playing" -> "game_over" or "results"
+        self.score = 0
+        self.ticks = 0
+
+        # アイテム生成タイマー
+        self.item_spawn_interval = 5 * FPS  # 5秒
+        self.last_item_spawn = 0
+
+        # ステージの予定表 (アイテムの生成・ボムの終了を、そのティックが来た時だけ処理する)
+        self.timers = TimingWheel()
+        self.timers.schedule(self.item_spawn_interval + 1, ("item", None))
+
+        # ボム関連の変数
+        self.bombs = self.settings["bombs"] # 残りボム数
+        self.bomb_active_area: BombArea | None = None # 現在アクティブなボムエリア
+
+        # 敵弾数の上限 (None なら無制限、処理が重い時に QualityGovernor が設定する)
+        # ゲームの進行が変わるので、リプレイには設定したティックと値を記録する
+        self.bullet_cap: int | None = None
+
+    def start_ex(self):
+        """
+        EXステージを始める (自機を中央に戻して残機とスコアを EX 用にし、ボスを EX モードにする)
+        """
+        self.mode = "ex"
+        self.state = "playing"
+        self.player.respawn() # プレイヤーを中央に配置
+        self.player.lives = self.boss.settings["ex_lives"] # EXステージは残機固定 (通常3)
+        self.score = 0 # スコアリセット (EX専用スコア)
+        self.boss.start_ex_stage()
+
+        # 既存の弾・アイテム・ボムをクリア
+        self.player_bullets.empty()
+        self.items.empty()
+        self.enemy_bullets.empty()
+        self.bomb_active_area = None
+
+    def tick(self, keys: pg.key.ScancodeWrapper, pressed: set[int]) -> str:
+        """
+        1ティック分ゲームを進め、次の状態 ("playing", "game_over", "results") を返す
+        keys: 押されているキー, pressed: このティックで押された (KEYDOWN) キー
+        """
+        player, boss = self.player, self.boss
+        enemy_bullets = self.enemy_bullets
+        rules = MODE_RULES[self.mode]
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+        self.ticks += 1
+        remember_positions(self.all_sprites, self.items)
+
+        # プレイヤー復活処理
+        if player.is_respawning and pg.K_SPACE in pressed:
+            player.respawn()
+
+        # Tabキーでボム使用
+        # ボムが残っていて、かつ、現在アクティブなボムがない時のみ発動
+        if pg.K_TAB in pressed and self.bombs > 0 and self.bomb_active_area is None:
+            self.bombs -= 1
+            self.bomb_active_area = BombArea(player.rect.center)
+            # 発動したティックも数えて duration_frames ティックで終わる
+            self.timers.schedule(self.ticks + self.bomb_active_area.duration_frames - 1,
+                                 ("bomb_end", self.bomb_active_area))
+            if self.sounds:
+                self.sounds.trigger("bomb")
+
+        for event, target in self.timers.advance(self.ticks):
+            if event == "item" and rules["items"]:
+                self.last_item_spawn = self.ticks
+                # 画面上部のランダムな位置に生成
+                spawn_x = self.item_rng.randint(50, SCREEN_WIDTH - 50)
+                spawn_y = -20
+                self.items.add(PowerItem((spawn_x, spawn_y)))
+                self.timers.schedule(self.ticks + self.item_spawn_interval + 1, ("item", None))
+            elif event == "bomb_end" and target is self.bomb_active_area:
+                # 被弾などで先に消えたボムの予定は無視する
+                target.is_active = False
+
+        # 更新処理
+        # player.update は引数が特殊なので個別に呼ぶ
+        player.update(keys, self.player_bullets)
+        if profiler:
+            profiler.lap("player")
+        # boss.update も引数が特殊なので個別に呼ぶ
+        if boss.is_active:
+            boss.update(enemy_bullets, player.rect.center)
+        if profiler:
+            profiler.lap("boss")
+
+        self.player_bullets.update(boss)  # ホーミングの目標はボス
+        self.items.update()
+        if profiler:
+            profiler.lap("player")
+
+        # アイテム取得判定
+        collected_items = pg.sprite.spritecollide(player, self.items, True)
+        if collected_items:
+            for item in collected_items:
+                player.add_power_item()
+            if self.sounds:
+                self.sounds.trigger("powerup", len(collected_items))
+        if profiler:
+            profiler.lap("collision")
+        
+        # ボムは自機に追従する
+        bomb = self.bomb_active_area
+        if bomb is not None:
+            bomb.update(player.rect.center)
+        if profiler:
+            profiler.lap("bomb")
+
+        # 敵弾: 移動・画面外の消去・ボムでの消去・GRAZE・被弾を1回でまとめて判定
+        # (復活待機中は GRAZE と被弾を判定しない、予兆中の置きレーザーは当たらない)
+        vulnerable = not player.is_respawning
+        avoided, bombed, grazed, hit = enemy_bullets.step(
+            player.grazebox if vulnerable else None,
+            player.hitbox if vulnerable else None,
+            (bomb.center[0], bomb.center[1], bomb.radius) if bomb is not None and bomb.is_active else None,
+            profiler)
+        self.score += (avoided * rules["avoid_score"]     # 弾を1つ避けきったらスコアUP
+                       + bombed * rules["bomb_score"]     # ボムで消した弾
+                       + grazed * rules["graze_score"])   # GRAZE (かすり)
+        if grazed and rules["graze_se"] and self.sounds:
+            self.sounds.trigger("graze", grazed)  # 何発 GRAZE しても再生は1回にまとまる
+        if bomb is not None and not bomb.is_active:
+            self.bomb_active_area = None # ボム終了
+        # 敵弾数の上限を超えた分は、自機から離れていく古い弾から消す (スコアは入らない)
+        if self.bullet_cap is not None and len(enemy_bullets) > self.bullet_cap:
+            enemy_bullets.retire(len(enemy_bullets) - self.bullet_cap, player.rect.center)
+        if profiler:
+            profiler.lap("bullets")
+
+        # 当たり判定
+
+        # 自機弾 vs ボス
+        if boss.is_active:
+            hits, damage = self.player_bullets.collide(boss.rect)
+            if hits:
+                # 1ダメージ = 1ヒットとして処理
+                total_damage = damage if rules["power_damage"] else hits
+                boss.hit(total_damage)
+                # 1ダメージにつきスコア1UP
+                self.score += total_damage
+
+        # 敵弾 vs 自機 (被弾)
+        if hit:
+            if self.sounds:
+                self.sounds.trigger("hit")
+            
+            player.hit() # 残機を減らし、無敵状態へ
+            
+            # 画面上の敵弾を全消去
+            enemy_bullets.empty()
+            if rules["hit_ends_bomb"]:
+                self.bomb_active_area = None
+            
+            if player.lives <= 0:
+                self.state = "game_over"
+
+        # ステージ移行判定
+        if boss.check_skill_transition():
+            # 移行時に弾幕を消去
+            enemy_bullets.empty()
+            
+            # ステージ移行時にボムエリアを強制終了
+            self.bomb_active_area = None 
+            
+            if not boss.is_active:
+                self.state = "results"  # リザルト画面に移行
+
+        if profiler:
+            profiler.lap("collision")
+        return self.state
+
+    def checksum(self) -> int:
+        """
+        ゲーム状態のチェックサム (リプレイの再生がずれていないか (デシンク) を毎ティック確かめる)
+        """
+        player, boss, bullets = self.player, self.boss, self.enemy_bullets
+        n = bullets.n
+        crc = zlib.crc32(struct.pack(
+            "<14i", self.ticks, self.score, self.bombs, player.rect.x, player.rect.y, player.lives,
+            int(player.is_respawning), boss.rect.x, boss.rect.y, boss.hp, boss.current_skill_index,
+            boss.pattern_timer, len(self.player_bullets), n))
+        crc = zlib.crc32(bullets.x[:n].tobytes(), crc)
+        return zlib.crc32(bullets.y[:n].tobytes(), crc)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for name in self.PRESENTATION_ATTRS:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        # 表示用の属性が違う古いスナップショットも読めるようにする
+        for name in self.PRESENTATION_ATTRS:
+            state.setdefault(name, None)
+        state.setdefault("bullet_cap", None)
+        self.__dict__.update(state)
+
+    def snapshot(self) -> bytes:
+        """
+        ゲーム状態全体を圧縮したバイト列にする (リプレイのキーフレーム用)
+        共有アセットの画像は中身ではなく読み込み方だけを保存する
+        """
+        buffer = io.BytesIO()
+        SnapshotPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(self)
+        return zlib.compress(buffer.getvalue())
+
+    @staticmethod
+    def from_snapshot(data: bytes, like: "GameWorld | None" = None) -> "GameWorld":
+        """
+        snapshot() のバイト列から GameWorld を復元する
+        like を渡すと、その効果音と背景を引き継ぐ
+        """
+        world = SnapshotUnpickler(io.BytesIO(zlib.decompress(data))).load()
+        if like is not None:
+            for name in GameWorld.PRESENTATION_ATTRS:
+                setattr(world, name, getattr(like, name))
+        return world
+
+    def draw(self, screen: pg.Surface, alpha: float = 1.0, renderer: DirtyRenderer | None = None) -> list[pg.Rect]:
+        """
+        描画処理 (alpha: 前ティックから現在までの補間割合)
+        renderer を渡すと背景は前のフレームで描いた範囲だけ塗り直す (差分描画)
+        描いた範囲のリストを返す
+        """
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+        if renderer is not None:
+            renderer.begin(screen, self.background_image)
+        elif self.background_image:
+            screen.blit(self.background_image, (0, 0)) # 背景画像を描画
+        else:
+            screen.fill(BLACK) # 背景画像がなければ黒で塗りつぶす
+        
+        quality = self.quality or QUALITY_FULL
+
+        # Player, Boss (点滅中のプレイヤーはキュー側で除く), 弾, アイテムをまとめて描画
+        queue = RENDER_QUEUE
+        queue.add_sprites(self.all_sprites, alpha, LAYER_SPRITES)
+        queue.extend(self.player_bullets.blit_items(alpha), LAYER_PLAYER_BULLETS, grouped=True)
+        queue.extend(self.enemy_bullets.blit_items(alpha), LAYER_ENEMY_BULLETS, grouped=True)
+        queue.add_sprites(self.items, alpha, LAYER_ITEMS)
+        drawn = queue.flush(screen, doreturn=renderer is not None and renderer.enabled) or []
+        
+        # ボムエリアの描画
+        if self.bomb_active_area is not None:
+            rect = self.bomb_active_area.draw(screen, translucent=quality < QUALITY_OUTLINE_BOMB)
+            if rect is not None:
+                drawn.append(rect)
+        if profiler:
+            profiler.lap("draw")
+
+        # UIの描画
+        drawn += draw_ui(screen, self.score, self.player.lives, self.boss, self.bombs, # bombsを渡す
+                         QUALITY_HUD_INTERVAL if quality >= QUALITY_SLOW_HUD else 1)
+
+        # 復活待機中の表示
+        if self.player.is_respawning:
+            drawn.append(get_hud().draw_respawn_prompt(screen))
+        if profiler:
+            profiler.lap("hud")
+        return drawn
+
+
 # EXステージ管理クラス
 class EX_STAGE:
     """
     EXTRA STAGE全体の進行（演出、プレイ、リザルト）を管理するクラス
+    プレイ中の処理は通常ステージと同じ GameWorld に任せる (ルールは MODE_RULES["ex"])
     """
-    def __init__(self, screen: pg.Surface, player: Player, boss: Boss, all_sprites: pg.sprite.Group, player_bullets: pg.sprite.Group, enemy_bullets: pg.sprite.Group, se_hit, se_graze, se_bomb, bombs: int ,background_image: pg.Surface = None): # se_bomb, bombs を追加
+    def __init__(self, screen: pg.Surface, world: GameWorld, background_image: pg.Surface = None):
         
         # 必要なオブジェクト参照
         self.screen = screen
-        self.player = player
-        self.boss = boss
-        self.all_sprites = all_sprites
-        self.player_bullets = player_bullets
-        self.enemy_bullets = enemy_bullets
-        
-        # 効果音
-        self.se_hit = se_hit
-        self.se_graze = se_graze
-        self.se_bomb = se_bomb # ボム効果音を保持
-
-        # 背景画像
-        self.background_image = background_image
+        self.world = world
+        self.player = world.player
+        self.boss = world.boss
+        self.all_sprites = world.all_sprites
+        self.enemy_bullets = world.enemy_bullets
+
+        # 背景画像は EX 用のものに差し替える (GRAZE の効果音は MODE_RULES["ex"] で鳴るようになる)
+        world.background_image = background_image
         
         # 内部状態管理
         # "transition_start" -> "playing" -> "transition_clear" or "transition_failed" -> "results"
         self.internal_state = "transition_start"
         
-        # タイマー
+        # タイマー (ティック単位)
         self.transition_timer = 0
-        self.transition_duration = 60  # 1秒 (FPS依存)
-        
-        # EX専用スコア
-        self.score = 0
-        self.bombs = bombs # ★修正: ボム数を保持
-        self.bomb_active_area: BombArea | None = None # EX用ボムエリア
+        self.transition_duration = FPS  # 1秒
+
+    @property
+    def score(self) -> int:
+        """ EX専用スコア (EX開始時に 0 に戻る) """
+        return self.world.score
 
     def start(self):
         """
@@ -1030,7 +3379,7 @@ class EX_STAGE:
 
     def update(self, keys: pg.key.ScancodeWrapper, events: list[pg.event.Event]) -> str:
         """
-        EXステージのフレーム更新処理
+        EXステージの1ティック分の更新処理
         mainのgame_stateを返す ("ex_stage", "game_over", "quit")
         """
         
@@ -1041,106 +3390,19 @@ class EX_STAGE:
                 # EXステージのセットアップ
                 self.internal_state = "playing"
                 self.all_sprites.add(self.player, self.boss) # プレイヤーとボスを再追加
-                self.player.respawn() # プレイヤーを中央に配置
-                self.player.lives = 3 # EXステージは残機3で固定
-                self.score = 0 # スコアリセット
-                
-                # ボスをEXモードに設定
-                self.boss.start_ex_stage() 
-                
-                # 既存の弾をクリア
-                self.player_bullets.empty()
-                self.enemy_bullets.empty()
+                self.world.start_ex()
 
         # EXステージプレイ中
         elif self.internal_state == "playing":
-            
-            # イベント処理 (復活・ボム)
-            for event in events:
-                if self.player.is_respawning and event.type == pg.KEYDOWN:
-                    if event.key == pg.K_SPACE:
-                        self.player.respawn()
-
-                # EXステージ中のボム使用
-                if event.type == pg.KEYDOWN and event.key == pg.K_TAB:
-                    if self.bombs > 0 and self.bomb_active_area is None:
-                        self.bombs -= 1
-                        self.bomb_active_area = BombArea(self.player.rect.center)
-                        if self.se_bomb:
-                            self.se_bomb.set_volume(0.5)
-                            self.se_bomb.play()
-
-            # 更新処理
-            self.player.update(keys, self.player_bullets, self.boss)
-            if self.boss.is_active:
-                self.boss.update(self.enemy_bullets, self.player.rect.center)
-            self.player_bullets.update()
-
-            # ボムエリアの更新
-            if self.bomb_active_area is not None:
-                self.bomb_active_area.update(self.player.rect.center)
-                killed_bullets = self.bomb_active_area.check_collision_and_kill(self.enemy_bullets)
-                self.score += killed_bullets * 1 # ボムで消した弾は1点
-                if not self.bomb_active_area.is_active:
-                    self.bomb_active_area = None
-
-            # 敵弾の更新 (画面外消去とスコア)
-            avoided_bullets_score = 0
-            for bullet in list(self.enemy_bullets):
-                bullet.update()
-                if not self.screen.get_rect().colliderect(bullet.rect):
-                    bullet.kill()
-                    avoided_bullets_score += 10 # EXはスコア高め
-            self.score += avoided_bullets_score
-
-            # 当たり判定
-            # 自機弾 vs ボス
-            if self.boss.is_active:
-                hits = pg.sprite.spritecollide(self.boss, self.player_bullets, True)
-                if hits:
-                    damage = len(hits) # ★修正: パワーアップ未対応（元コード通り）
-                    self.boss.hit(damage)
-                    self.score += damage
-            
-            # 敵弾 vs 自機
-            if not self.player.is_respawning:
-                # GRAZE判定
-                graze_list = pg.sprite.spritecollide(self.player, self.enemy_bullets, False, lambda p, b: p.grazebox.colliderect(b.rect))
-                for bullet in graze_list:
-                    if isinstance(bullet, EnemyDelayedLaser) and bullet.state != "active":
-                        continue
-                    if not bullet.grazed:
-                        if not self.player.hitbox.colliderect(bullet.rect):
-                            self.score += 50 # EXはGRAZEスコア高め
-                            bullet.grazed = True
-                            if self.se_graze: self.se_graze.play()
-
-                # 被弾判定
-                hit_bullets = pg.sprite.spritecollide(self.player, self.enemy_bullets, False, lambda p, b: p.hitbox.colliderect(b.rect))
-                active_hit_bullets = []
-                for bullet in hit_bullets:
-                    if isinstance(bullet, EnemyDelayedLaser) and bullet.state != "active":
-                        continue
-                    active_hit_bullets.append(bullet)
-
-                # 被弾処理
-                if active_hit_bullets:
-                    if self.se_hit: self.se_hit.play()
-                    self.player.hit()
-                    self.enemy_bullets.empty() # 弾幕全消去
-                    self.bomb_active_area = None # 被弾時にボム消去
-                    
-                    if self.player.lives <= 0:
-                        self.internal_state = "transition_failed" # EX失敗
-                        self.transition_timer = 0
-            
-            # ステージ移行判定 (ボス撃破)
-            if self.boss.check_skill_transition():
-                self.enemy_bullets.empty()
-                self.bomb_active_area = None # ステージ移行時にボム消去
-                if not self.boss.is_active:
-                    self.internal_state = "transition_clear" # EXクリア
-                    self.transition_timer = 0
+            # 復活 (SPACE) とボム (TAB) はこのティックで押されたキーとして渡す
+            pressed = {event.key for event in events if event.type == pg.KEYDOWN}
+            state = self.world.tick(keys, pressed)
+            if state == "game_over":
+                self.internal_state = "transition_failed" # EX失敗
+                self.transition_timer = 0
+            elif state == "results":
+                self.internal_state = "transition_clear" # EXクリア
+                self.transition_timer = 0
         
         # クリア演出中
         elif self.internal_state == "transition_clear":
@@ -1162,47 +3424,20 @@ class EX_STAGE:
 
         return "ex_stage" # EXステージ継続
 
-    def draw(self):
+    def draw(self, alpha: float = 1.0, renderer: DirtyRenderer | None = None) -> list[pg.Rect] | None:
         """
-        EXステージの描画処理
+        EXステージの描画処理 (alpha: 前ティックから現在までの補間割合)
+        プレイ中は描いた範囲のリストを返す (演出・リザルトで画面全体を描いた時は None)
+        renderer を渡すとプレイ中の背景は前のフレームで描いた範囲だけ塗り直す (差分描画)
         """
         
         # 突入演出
         if self.internal_state == "transition_start":
             draw_ex_transition(self.screen, "EXTRA STAGE START", (255, 0, 100))
         
-        # プレイ中
+        # プレイ中 (通常ステージと同じ描画)
         elif self.internal_state == "playing":
-            #self.screen.fill(BLACK)
-
-            # 背景画像を描画
-            if self.background_image:
-                self.screen.blit(self.background_image, (0, 0))
-            else:
-                self.screen.fill(BLACK) # 画像がない場合のフォールバック
-
-            # all_sprites の描画 (点滅考慮)
-            for sprite in self.all_sprites:
-                 if isinstance(sprite, Player) and not sprite.is_visible:
-                     pass # 点滅中は描画しない
-                 else:
-                     self.screen.blit(sprite.image, sprite.rect)
-            
-            self.player_bullets.draw(self.screen)
-            self.enemy_bullets.draw(self.screen)
-            
-            # ボムエリアの描画
-            if self.bomb_active_area is not None:
-                self.bomb_active_area.draw(self.screen)
-
-            # UI描画 (EX専用スコアを使用)
-            draw_ui(self.screen, self.score, self.player.lives, self.boss, self.bombs) # self.bombs を渡す
-            
-            # 復活待機中の表示
-            if self.player.is_respawning:
-                font = pg.font.Font(None, 40)
-                text = font.render("Press SPACE to Respawn", True, WHITE)
-                self.screen.blit(text, (SCREEN_WIDTH // 2 - text.get_width() // 2, SCREEN_HEIGHT // 2 + 100))
+            return self.world.draw(self.screen, alpha, renderer)
         
         # クリア演出
         elif self.internal_state == "transition_clear":
@@ -1221,9 +3456,715 @@ class EX_STAGE:
                 draw_ex_results(self.screen, 0.0) # 念のため
 
 
-def main():
+class InputKeys:
+    """
+    pg.key.get_pressed() の代わりに使うキー入力 (ヘッドレス実行・自動操作用)
+    keys[pg.K_w] のように参照できる
+    """
+    def __init__(self, held=()):
+        self.held = set(held)
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.held
+
+
+class RandomPolicy:
+    """
+    ヘッドレス実行用の入力方針
+    hold_ticks ごとにランダムな移動方向を選び直す (stationary=True なら動かない)
+    被弾したらすぐに SPACE で復活する。bomb=True ならボムが切れるたびに TAB で使い直す
+    """
+    MOVES = [(), (pg.K_w,), (pg.K_s,), (pg.K_a,), (pg.K_d,),
+             (pg.K_w, pg.K_a), (pg.K_w, pg.K_d), (pg.K_s, pg.K_a), (pg.K_s, pg.K_d)]
+
+    def __init__(self, seed: int | None = None, hold_ticks: int = 20, stationary: bool = False, bomb: bool = False):
+        self.rng = random.Random(seed)
+        self.hold_ticks = hold_ticks
+        self.stationary = stationary
+        self.bomb = bomb
+        self.timer = 0
+        self.keys = InputKeys()
+
+    def __call__(self, world) -> tuple[InputKeys, set[int]]:
+        pressed = set()
+        if world.player.is_respawning:
+            pressed.add(pg.K_SPACE)
+        if self.bomb and world.bomb_active_area is None:
+            pressed.add(pg.K_TAB)
+        if not self.stationary:
+            self.timer -= 1
+            if self.timer <= 0:
+                self.timer = self.hold_ticks
+                held = set(self.rng.choice(self.MOVES))
+                if self.rng.random() < 0.3:
+                    held.add(pg.K_LSHIFT)
+                self.keys = InputKeys(held)
+        return self.keys, pressed
+
+
+class DodgeBot:
+    """
+    敵弾を避ける自動操作の入力方針 (長時間の負荷試験・バランス調整用)
+    毎ティック、移動の候補 (8方向 × 通常/低速 + 停止) ごとに同じ入力を horizon ティック続けた時の
+    自機の位置と、敵弾の直線の軌道を先読みし、一番長く当たらずにいられて弾との距離に余裕のある候補を選ぶ
+    調べる弾は自機の近くの max_bullets 個までなので、1ティックの計算量は弾の数によらず一定以下
+    """
+    MOVES = [(), *[(*move, shift) for move in RandomPolicy.MOVES[1:] for shift in ((), (pg.K_LSHIFT,))]]
+
+    def __init__(self, seed: int | None = None, horizon: int = 15, max_bullets: int = 48, margin: float = 3.0,
+                 bomb: bool = True, wander_ticks: int = 120):
+        self.rng = random.Random(seed)
+        self.horizon = horizon
+        self.max_bullets = max_bullets
+        self.margin = margin  # 自機の当たり判定に足す安全のための余白 (ピクセル)
+        self.bomb = bomb  # どの候補でもすぐ当たる時にボムを使う
+        self.wander_ticks = wander_ticks  # 待機する横位置を選び直す間隔 (ティック)
+        self.timer = 0
+        self.home_x = SCREEN_WIDTH / 2
+        self.previous = 0  # 前のティックで選んだ候補 (同じ点数なら続けて選び、細かく揺れないようにする)
+        self.candidates = [InputKeys(keys) for keys in self.MOVES]
+        self.steps = np.arange(1, horizon + 1, dtype=np.float64)[None, :, None]  # (1, ティック, 1)
+
+    def __call__(self, world) -> tuple[InputKeys, set[int]]:
+        player = world.player
+        if world.state != "playing":
+            return InputKeys(), set()
+        if player.is_respawning:
+            return InputKeys(), {pg.K_SPACE}
+        self.timer -= 1
+        if self.timer <= 0:
+            self.timer = self.wander_ticks
+            self.home_x = self.rng.uniform(SCREEN_WIDTH * 0.25, SCREEN_WIDTH * 0.75)
+
+        first_hit, clearance, px, py = self.look_ahead(world)
+        score = (first_hit * 1000.0 + np.minimum(clearance, 80.0)
+                 - 0.05 * np.abs(py - SCREEN_HEIGHT * 0.8) - 0.02 * np.abs(px - self.home_x))
+        score[self.previous] += 5.0
+        choice = int(np.argmax(score))
+        self.previous = choice
+
+        pressed = set()
+        if (self.bomb and first_hit[choice] < 4 and world.bombs > 0 and world.bomb_active_area is None):
+            pressed.add(pg.K_TAB)
+        return self.candidates[choice], pressed
+
+    def look_ahead(self, world) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        候補ごとに (最初に当たるティック (当たらなければ horizon), 先読み中の弾との最小距離, 最後の x, 最後の y) を返す
+        """
+        player, bullets = world.player, world.enemy_bullets
+        horizon = self.horizon
+        cx, cy = player.rect.center
+
+        # 候補ごとの1ティックの移動量 (Player.update と同じ計算を Rect の複製で行う) から先読み中の中心座標を作る
+        half_w, half_h = player.rect.width / 2, player.rect.height / 2
+        deltas = np.empty((len(self.candidates), 2))
+        bounds = pg.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        for c, keys in enumerate(self.candidates):
+            rect = player.rect.copy()
+            speed = player.speed * (0.5 if keys[pg.K_LSHIFT] else 1)
+            if keys[pg.K_w]:
+                rect.y -= speed
+            if keys[pg.K_s]:
+                rect.y += speed
+            if keys[pg.K_a]:
+                rect.x -= speed
+            if keys[pg.K_d]:
+                rect.x += speed
+            rect.clamp_ip(bounds)
+            deltas[c] = (rect.centerx - cx, rect.centery - cy)
+        steps = self.steps
+        px = np.clip(cx + deltas[:, 0, None, None] * steps, half_w, SCREEN_WIDTH - half_w)  # (候補, ティック, 1)
+        py = np.clip(cy + deltas[:, 1, None, None] * steps, half_h, SCREEN_HEIGHT - half_h)
+
+        no_hit = np.full(len(self.candidates), float(horizon))
+        far = np.full(len(self.candidates), np.inf)
+        n = bullets.n
+        if n == 0:
+            return no_hit, far, px[:, -1, 0], py[:, -1, 0]
+
+        # 先読みの間に届きうる近くの弾だけを、近い順に max_bullets 個まで調べる
+        # (候補は一番速い弾でも届く範囲の正方形で空間グリッドから取り出す)
+        limit = math.ceil((bullets.max_step * math.sqrt(2) + player.speed) * horizon + self.margin + 8)
+        near = bullets.query(pg.Rect(cx - limit, cy - limit, 2 * limit, 2 * limit))
+        if len(near) == 0:
+            return no_hit, far, px[:, -1, 0], py[:, -1, 0]
+        x, y = bullets.x[near], bullets.y[near]
+        vx, vy = bullets.vx[near], bullets.vy[near]
+        extent = np.maximum(bullets.hw[near], bullets.hh[near])
+        gap = np.hypot(x - cx, y - cy) - extent
+        reach = (np.hypot(vx, vy) + player.speed) * horizon + self.margin + 8
+        close = np.flatnonzero(gap < reach)
+        if len(close) == 0:
+            return no_hit, far, px[:, -1, 0], py[:, -1, 0]
+        if len(close) > self.max_bullets:
+            close = close[np.argpartition(gap[close], self.max_bullets)[:self.max_bullets]]
+        near = near[close]
+
+        # 弾の先読み位置 (1, ティック, 弾) と、自機から見た相対位置 (候補, ティック, 弾)
+        bx = x[close] + vx[close] * steps
+        by = y[close] + vy[close] * steps
+        dx, dy = px - bx, py - by
+
+        # 弾の形ごとの距離 (円はカプセルの芯の長さが 0 のもの、負なら中に入っている)
+        ax, ay = bullets.ax[near], bullets.ay[near]
+        length2 = np.maximum(ax * ax + ay * ay, 1e-9)
+        t = np.clip((dx * ax + dy * ay) / length2, -1.0, 1.0)
+        distance = np.hypot(dx - t * ax, dy - t * ay) - bullets.radius[near]
+        box = bullets.shape[near] == SHAPE_BOX
+        if box.any():
+            box_distance = np.maximum(np.abs(dx) - bullets.hw[near], np.abs(dy) - bullets.hh[near])
+            distance = np.where(box, box_distance, distance)
+
+        # 当たり判定があるティックだけを見る (予兆中の置きレーザーは発射後、発射中のものは消えるまで)
+        # (due は予兆中なら発射するティック、発射中なら消えるティック)
+        state, due = bullets.state[near], bullets.due[near]
+        future = bullets.ticks + steps[0]  # (ティック, 1)
+        live = ((state == STATE_MOVING) |
+                ((state == STATE_WARNING) & (future >= due)) |
+                ((state == STATE_ACTIVE) & (future < due)))
+        distance = np.where(live[None], distance, np.inf)
+
+        closest = distance.min(axis=2)  # (候補, ティック)
+        hit = closest < player.hitbox.width / 2 + self.margin
+        first_hit = np.where(hit.any(axis=1), hit.argmax(axis=1), horizon).astype(np.float64)
+        return first_hit, closest.min(axis=1), px[:, -1, 0], py[:, -1, 0]
+
+
+# ヘッドレス実行で選べる入力方針
+POLICIES = {
+    "random": lambda seed: RandomPolicy(seed),
+    "idle": lambda seed: RandomPolicy(seed, stationary=True),
+    "bomb": lambda seed: RandomPolicy(seed, stationary=True, bomb=True),
+    "dodge": lambda seed: DodgeBot(seed),
+}
+
+
+def init_headless():
+    """
+    ウィンドウと音声なしで pygame を初期化する (SDL の dummy ドライバを使う)
+    画像の convert() に画面が必要なので、見えない画面だけは作っておく
+    SDL が SIGTERM を QUIT イベントに変えるとプロセスプールのワーカーが終了できないので無効にする
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+    pg.display.init()
+    pg.font.init()
+    if pg.display.get_surface() is None:
+        pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+
+
+class HeadlessRunner:
+    """
+    ウィンドウなしでボス戦を CPU の許す限りの速さで回すクラス
+    policy (world を受け取り (keys, pressed) を返す関数) で自機を操作し、
+    弾数・GRAZE・クリアタイムなどの集計を返す
+    """
+    def __init__(self, difficulty: str = "NORMAL", overrides: dict | None = None, policy=None,
+                 ex: bool = False, seed: int | None = None, max_ticks: int = 5 * 60 * FPS):
+        self.difficulty = difficulty
+        self.overrides = overrides
+        self.policy = policy or RandomPolicy(seed)
+        self.ex = ex
+        self.seed = seed
+        self.max_ticks = max_ticks
+
+    def run(self) -> dict:
+        init_headless()
+        world = GameWorld(self.difficulty, overrides=self.overrides, seed=self.seed)
+        if self.ex:
+            # EXステージ: 突入演出を飛ばしてすぐにプレイ状態にする
+            world.start_ex()
+        start_lives = world.player.lives
+
+        bullets = world.enemy_bullets
+        ticks = 0
+        bullet_sum = 0
+        peak_bullets = 0
+        outcome = "timeout"
+        while ticks < self.max_ticks:
+            keys, pressed = self.policy(world)
+            state = world.tick(keys, pressed)
+            finished = state != "playing"
+            if finished:
+                outcome = "clear" if state == "results" else "game_over"
+
+            ticks += 1
+            count = len(bullets)
+            bullet_sum += count
+            peak_bullets = max(peak_bullets, count)
+            if finished:
+                break
+
+        seconds = ticks / FPS
+        clear_times = list(world.boss.clear_times)
+        return {
+            "difficulty": self.difficulty,
+            "ex": self.ex,
+            "seed": self.seed,
+            "outcome": outcome,
+            "seconds": round(seconds, 2),
+            "stage": world.boss.current_skill_index + 1,
+            "clear_times": " ".join(f"{t:.2f}" for t in clear_times),
+            "total_clear_time": round(sum(clear_times), 2) if outcome == "clear" else None,
+            "score": world.score,
+            "lives_lost": start_lives - world.player.lives,
+            "mean_bullets": round(bullet_sum / max(1, ticks), 1),
+            "peak_bullets": peak_bullets,
+            "grazes": bullets.graze_count,
+            "graze_rate": round(bullets.graze_count / max(seconds, 1e-9), 2),
+        }
+
+
+def run_sweep_job(job: dict) -> dict:
+    """ スイープの1条件を実行する (プロセスプールのワーカーで呼ばれる) """
+    runner = HeadlessRunner(job["difficulty"], job["overrides"], POLICIES[job["policy"]](job["seed"]),
+                            ex=job["ex"], seed=job["seed"], max_ticks=job["max_ticks"])
+    result = runner.run()
+    result.update(job["overrides"])
+    return result
+
+
+def run_sweep(grid: dict[str, list], difficulties=("NORMAL",), seeds=(0,), ex: bool = False,
+              policy: str = "random", max_ticks: int = 5 * 60 * FPS, processes: int | None = None) -> list[dict]:
+    """
+    難易度設定の組み合わせ (grid の直積) × 難易度 × シード をプロセスプールで並列に実行し、結果の表を返す
+    grid の例: {"skill_pattern_3.p1_freq": [30, 50, 70], "lives": [5, 10]}
+    """
+    names = list(grid)
+    jobs = [{"difficulty": difficulty, "seed": seed, "ex": ex, "policy": policy, "max_ticks": max_ticks,
+             "overrides": dict(zip(names, values))}
+            for values in itertools.product(*(grid[name] for name in names))
+            for difficulty in difficulties
+            for seed in seeds]
+    with multiprocessing.Pool(processes, initializer=init_headless) as pool:
+        return pool.map(run_sweep_job, jobs)
+
+
+def print_table(rows: list[dict]):
+    """ 結果の表を整形して表示する """
+    if not rows:
+        return
+    columns = list(rows[0])
+    widths = [max(len(str(c)), *(len(str(row.get(c, ""))) for row in rows)) for c in columns]
+    print("  ".join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(c, "")).ljust(w) for c, w in zip(columns, widths)))
+
+
+def write_csv(rows: list[dict], path: str):
+    """ 結果の表を CSV に保存する """
+    columns = []
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# ベンチマークのシナリオ (シード固定で毎回同じ弾幕になる)
+# skill: 開始するスキルの番号 (0 = STAGE1), ex: EXステージのパターン, policy: POLICIES の名前
+BENCH_SCENARIOS = {
+    "easy_pattern1": {"difficulty": "EASY", "skill": 0, "policy": "random"},
+    "normal_pattern3": {"difficulty": "NORMAL", "skill": 2, "policy": "random"},
+    "hard_pattern3": {"difficulty": "HARD", "skill": 2, "policy": "random"},
+    "ex_stationary": {"difficulty": "NORMAL", "ex": True, "policy": "idle"},
+    "bomb_storm": {"difficulty": "HARD", "skill": 2, "policy": "bomb"},
+    "respawn_cycle": {"difficulty": "HARD", "skill": 0, "policy": "idle"},
+}
+# 計測区間 (FrameProfiler の lap 名) をまとめた集計項目
+BENCH_GROUPS = {
+    "update": ("player", "boss", "bullets", "bomb"),
+    "collision": ("collision",),
+    "draw": ("draw", "hud", "flip"),
+}
+BENCH_PERCENTILES = (50, 95, 99)
+
+
+def bench_world(name: str, seed: int = 0) -> GameWorld:
+    """
+    シナリオの開始状態を作る
+    途中で終わらないように、自機の残機・ボム数とボスのHPを十分大きくしておく
+    """
+    scenario = BENCH_SCENARIOS[name]
+    world = GameWorld(scenario["difficulty"], overrides={"lives": 10 ** 6, "bombs": 10 ** 6}, seed=seed)
+    boss = world.boss
+    if scenario.get("ex"):
+        world.start_ex()
+        world.player.lives = 10 ** 6
+    index = scenario.get("skill", 0)
+    skill_name, _, pattern = boss.skill[index]
+    boss.skill[index] = (skill_name, 10 ** 9, pattern)
+    boss.current_skill_index = index - 1
+    boss.next_skill()
+    return world
+
+
+def run_benchmark(name: str, seconds: float = 20.0, seed: int = 0, warmup_seconds: float = 1.0,
+                  dirty: bool = True, gc_control: bool = True) -> dict:
+    """
+    シナリオをヘッドレスで実行し、1フレーム (1ティック + 描画 + 画面への転送) の処理時間を計測する
+    最初の warmup_seconds は画像の読み込みなどを含むので集計しない
+    dirty=False なら差分描画を使わず毎フレーム画面全体を描き直す
+    gc_control=False なら GcPolicy を使わず Python の自動 GC のままにする
+    """
+    init_headless()
+    screen = pg.display.get_surface()
+    world = bench_world(name, seed)
+    world.background_image = ASSETS.background(STAGE_BACKGROUNDS.get(world.difficulty, ""))
+    renderer = DirtyRenderer(enabled=dirty)
+    policy = POLICIES[BENCH_SCENARIOS[name]["policy"]](seed)
+    profiler = FrameProfiler()
+    world.profiler = profiler
+
+    warmup = int(warmup_seconds * FPS)
+    gc_policy = GcPolicy(gc_control)
+    frames = []
+    bullet_ticks = 0
+    peak_bullets = 0
+    try:
+        for i in range(warmup + int(seconds * FPS)):
+            gc_policy.update(i >= warmup)
+            world.tick(*policy(world))
+            drawn = world.draw(screen, 1.0, renderer)
+            profiler.start()
+            renderer.present(drawn)
+            profiler.lap("flip")
+            frame = profiler.end_frame()
+            if i < warmup:
+                continue
+            frames.append(frame)
+            count = len(world.enemy_bullets)
+            bullet_ticks += count
+            peak_bullets = max(peak_bullets, count)
+    finally:
+        gc_policy.update(False)
+
+    # 集計項目ごとのフレーム時間 (ミリ秒)
+    totals = {"frame": np.array([sum(frame.values()) for frame in frames]) * 1000}
+    for group, phases in BENCH_GROUPS.items():
+        totals[group] = np.array([sum(frame.get(p, 0.0) for p in phases) for frame in frames]) * 1000
+
+    result = {group: {f"p{q}": round(float(np.percentile(values, q)), 3) for q in BENCH_PERCENTILES}
+              for group, values in totals.items()}
+    result["peak_bullets"] = peak_bullets
+    # 1秒の処理時間で何発分の弾を処理できるか (弾数 × ティック数 / 合計フレーム時間)
+    result["bullets_per_second"] = round(bullet_ticks / max(totals["frame"].sum() / 1000, 1e-9))
+    return result
+
+
+def compare_benchmarks(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    基準の結果と比べ、p50・p95 が threshold (割合) より遅くなった項目を返す
+    基準が 0.05ms 未満の項目は誤差が大きいので比べない
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for group in ("frame", *BENCH_GROUPS):
+            for key in ("p50", "p95"):
+                before, after = base[group][key], result[group][key]
+                if before >= 0.05 and after > before * (1 + threshold):
+                    regressions.append(f"{name} {group} {key}: {before:.3f}ms -> {after:.3f}ms "
+                                       f"(+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def print_benchmarks(results: dict):
+    """ ベンチマーク結果を表にして表示する """
+    rows = []
+    for name, result in results.items():
+        row = {"scenario": name}
+        for q in BENCH_PERCENTILES:
+            row[f"frame_p{q}"] = result["frame"][f"p{q}"]
+        for group in BENCH_GROUPS:
+            row[f"{group}_p95"] = result[group]["p95"]
+        row["peak_bullets"] = result["peak_bullets"]
+        row["bullets/s"] = result["bullets_per_second"]
+        rows.append(row)
+    print_table(rows)
+
+
+# リプレイに記録するキー (1ティック1バイトのビット)
+# 移動と低速は押しっぱなしの状態、ボムと復活はそのティックで押されたか
+REPLAY_HELD_BITS = ((pg.K_w, 0x01), (pg.K_a, 0x02), (pg.K_s, 0x04), (pg.K_d, 0x08), (pg.K_LSHIFT, 0x10))
+REPLAY_PRESSED_BITS = ((pg.K_TAB, 0x20), (pg.K_SPACE, 0x40))
+REPLAY_KEYFRAME_INTERVAL = 5 * FPS  # キーフレーム (状態全体のスナップショット) を保存する間隔
+
+
+def encode_input(keys, pressed: set[int]) -> int:
+    """ 1ティック分の入力をビットに詰める """
+    mask = 0
+    for key, bit in REPLAY_HELD_BITS:
+        if keys[key]:
+            mask |= bit
+    for key, bit in REPLAY_PRESSED_BITS:
+        if key in pressed:
+            mask |= bit
+    return mask
+
+
+def decode_input(mask: int) -> tuple[InputKeys, set[int]]:
+    """ encode_input のビットを (keys, pressed) に戻す """
+    keys = InputKeys(key for key, bit in REPLAY_HELD_BITS if mask & bit)
+    pressed = {key for key, bit in REPLAY_PRESSED_BITS if mask & bit}
+    return keys, pressed
+
+
+class Replay:
+    """
+    通常ステージ1回分のリプレイ
+    難易度・シード・設定の上書きと、ティックごとの入力ビット・チェックサム、
+    keyframe_interval ティックごとのキーフレームと、敵弾数の上限 (GameWorld.bullet_cap) を変えたティックと値を持つ
+    ファイルの中身: MAGIC, ヘッダ長, ヘッダ (JSON), 入力 (zlib), チェックサム (zlib), キーフレーム...
+    """
+    MAGIC = b"KOKAREPLAY6"
+
+    def __init__(self, difficulty: str, seed: int, overrides: dict | None = None,
+                 keyframe_interval: int = REPLAY_KEYFRAME_INTERVAL):
+        self.difficulty = difficulty
+        self.seed = seed
+        self.overrides = dict(overrides or {})
+        self.keyframe_interval = keyframe_interval
+        self.inputs = bytearray()             # ティックごとの入力ビット
+        self.checksums: list[int] = []        # ティックを進めた後の GameWorld.checksum()
+        self.keyframes: dict[int, bytes] = {} # ティック -> そのティックを進める前の GameWorld.snapshot()
+        self.bullet_caps: dict[int, int | None] = {}  # ティック -> そのティックから使う敵弾数の上限
+
+    def __len__(self) -> int:
+        return len(self.inputs)
+
+    def save(self, path: str):
+        inputs = zlib.compress(bytes(self.inputs))
+        checksums = zlib.compress(np.asarray(self.checksums, np.uint32).tobytes())
+        keyframe_ticks = sorted(self.keyframes)
+        header = json.dumps({
+            "difficulty": self.difficulty,
+            "seed": self.seed,
+            "overrides": self.overrides,
+            "keyframe_interval": self.keyframe_interval,
+            "sizes": [len(inputs), len(checksums)],
+            "keyframes": [[tick, len(self.keyframes[tick])] for tick in keyframe_ticks],
+            "bullet_caps": [[tick, cap] for tick, cap in sorted(self.bullet_caps.items())],
+        }).encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.write(inputs)
+            f.write(checksums)
+            for tick in keyframe_ticks:
+                f.write(self.keyframes[tick])
+
+    @classmethod
+    def load(cls, path: str) -> "Replay":
+        """ リプレイファイルを読み込む (キーフレームは pickle なので、信頼できるファイルだけを読むこと) """
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError(f"リプレイファイルではありません: {path}")
+        offset = len(cls.MAGIC)
+        (header_size,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_size])
+        offset += header_size
+
+        replay = cls(header["difficulty"], header["seed"], header["overrides"], header["keyframe_interval"])
+        replay.bullet_caps = {tick: cap for tick, cap in header.get("bullet_caps", [])}
+        inputs_size, checksums_size = header["sizes"]
+        replay.inputs = bytearray(zlib.decompress(data[offset:offset + inputs_size]))
+        offset += inputs_size
+        replay.checksums = np.frombuffer(zlib.decompress(data[offset:offset + checksums_size]), np.uint32).tolist()
+        offset += checksums_size
+        for tick, size in header["keyframes"]:
+            replay.keyframes[tick] = data[offset:offset + size]
+            offset += size
+        return replay
+
+
+class ReplayRecorder:
+    """
+    GameWorld の進行をリプレイに記録するクラス
+    world.tick の代わりに tick を呼ぶ。入力はビットに詰めてから戻したものを world に渡すので、
+    記録に残らない入力でゲームが変わることはない
+    """
+    def __init__(self, world: GameWorld, keyframe_interval: int = REPLAY_KEYFRAME_INTERVAL):
+        if world.ticks != 0:
+            raise ValueError("リプレイはステージの最初から記録する必要があります")
+        self.world = world
+        self.replay = Replay(world.difficulty, world.seed, world.overrides, keyframe_interval)
+        self.bullet_cap: int | None = None  # 最後に記録した敵弾数の上限
+
+    def tick(self, keys, pressed: set[int]) -> str:
+        world, replay = self.world, self.replay
+        if world.bullet_cap != self.bullet_cap:
+            replay.bullet_caps[world.ticks] = self.bullet_cap = world.bullet_cap
+        if world.ticks % replay.keyframe_interval == 0:
+            replay.keyframes[world.ticks] = world.snapshot()
+        mask = encode_input(keys, pressed)
+        replay.inputs.append(mask)
+        state = world.tick(*decode_input(mask))
+        replay.checksums.append(world.checksum())
+        return state
+
+
+class ReplayPlayer:
+    """
+    リプレイを再生するクラス
+    seek() は目的のティック以前で一番近いキーフレームから復元し、残り (keyframe_interval 未満) だけ進める
+    step() ごとに記録時のチェックサムと比べ、最初にずれたティックを desync_tick に残す
+    """
+    def __init__(self, replay: Replay):
+        self.replay = replay
+        self.world = GameWorld(replay.difficulty, overrides=replay.overrides, seed=replay.seed)
+        self.desync_tick: int | None = None
+
+    @property
+    def tick(self) -> int:
+        return self.world.ticks
+
+    def seek(self, tick: int):
+        """ tick まで進めた状態にする (戻る方向にも移動できる) """
+        replay = self.replay
+        tick = max(0, min(tick, len(replay)))
+        interval = replay.keyframe_interval
+        base = tick // interval * interval
+        while base > 0 and base not in replay.keyframes:
+            base -= interval
+        # 今の位置から進めた方がキーフレームより近ければ復元しない
+        if not (base <= self.world.ticks <= tick):
+            if base in replay.keyframes:
+                self.world = GameWorld.from_snapshot(replay.keyframes[base], like=self.world)
+            else:
+                world = GameWorld(replay.difficulty, overrides=replay.overrides, seed=replay.seed)
+                for name in GameWorld.PRESENTATION_ATTRS:
+                    setattr(world, name, getattr(self.world, name))
+                self.world = world
+        while self.world.ticks < tick and self.step():
+            pass
+
+    def step(self) -> bool:
+        """ 1ティック進める (リプレイの最後かステージ終了なら False) """
+        world = self.world
+        i = world.ticks
+        if i >= len(self.replay) or world.state != "playing":
+            return False
+        if i in self.replay.bullet_caps:
+            world.bullet_cap = self.replay.bullet_caps[i]
+        world.tick(*decode_input(self.replay.inputs[i]))
+        if self.desync_tick is None and world.checksum() != self.replay.checksums[i]:
+            self.desync_tick = i
+        return True
+
+    def verify(self) -> int | None:
+        """
+        描画せずに最初から最後まで再生し、各キーフレームからの復元も確かめる
+        ずれが見つかったティック (なければ None) を返す
+        """
+        self.seek(0)
+        while self.step():
+            pass
+        first_desync = self.desync_tick
+        for tick in sorted(self.replay.keyframes):
+            if tick >= len(self.replay):
+                continue
+            self.world = GameWorld.from_snapshot(self.replay.keyframes[tick], like=self.world)
+            self.desync_tick = None
+            self.step()
+            if self.desync_tick is not None and (first_desync is None or self.desync_tick < first_desync):
+                first_desync = self.desync_tick
+        self.desync_tick = first_desync
+        return first_desync
+
+
+def play_replay(path: str, speed: float = 1.0, start: float = 0.0):
+    """
+    リプレイをウィンドウで再生する
+    ←/→: 5秒戻る/進む  ↑/↓: 再生速度を2倍/半分  SPACE: 一時停止  ESC: 終了
+    早送り中も描画は1フレームに1回だけで、間のティックは描画せずに進める
+    """
+    pg.init()
+    screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pg.display.set_caption(f"リプレイ: {os.path.basename(path)}")
+    clock = pg.time.Clock()
+
+    replay = Replay.load(path)
+    player = ReplayPlayer(replay)
+    player.world.background_image = ASSETS.background(STAGE_BACKGROUNDS.get(replay.difficulty, ""))
+    player.seek(int(start * FPS))
+
+    # 再生速度に合わせてティックの間隔を変える (早送りでは1フレームに進めるティック数の上限も上げる)
+    timestep = FixedTimestep(FPS * speed, max(8, int(8 * speed)))
+    paused = False
+    running = True
+    hud = get_hud()
+    while running:
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                running = False
+            elif event.type == pg.KEYDOWN:
+                if event.key == pg.K_ESCAPE:
+                    running = False
+                elif event.key == pg.K_SPACE:
+                    paused = not paused
+                elif event.key == pg.K_RIGHT:
+                    player.seek(player.tick + 5 * FPS)
+                elif event.key == pg.K_LEFT:
+                    player.seek(player.tick - 5 * FPS)
+                elif event.key in (pg.K_UP, pg.K_DOWN):
+                    speed = min(64.0, speed * 2) if event.key == pg.K_UP else max(0.25, speed / 2)
+                    timestep = FixedTimestep(FPS * speed, max(8, int(8 * speed)))
+
+        ticks = timestep.advance()
+        if not paused:
+            for _ in range(ticks):
+                if not player.step():
+                    break
+
+        player.world.draw(screen, 1.0 if paused else timestep.alpha)
+        status = f"REPLAY {player.tick / FPS:.1f}/{len(replay) / FPS:.1f}s  x{speed:g}" + ("  PAUSE" if paused else "")
+        screen.blit(hud.text.render(status, YELLOW), (10, SCREEN_HEIGHT - 30))
+        if player.desync_tick is not None:
+            screen.blit(hud.text.render(f"DESYNC at {player.desync_tick / FPS:.2f}s", RED), (10, SCREEN_HEIGHT - 60))
+        pg.display.flip()
+        clock.tick(MAX_RENDER_FPS)
+    pg.quit()
+
+
+def save_recording(recorder: ReplayRecorder, path: str):
+    """ 記録したリプレイを保存する """
+    recorder.replay.save(path)
+    print(f"リプレイを保存しました: {path} ({len(recorder.replay) / FPS:.1f}秒, シード {recorder.replay.seed})")
+
+
+# 難易度ごとの背景画像
+STAGE_BACKGROUNDS = {
+    "NORMAL": "data/HAIKEI1.png",  # ノマ
+    "EASY": "data/HAIKEI2.jpg",    # イージー
+    "HARD": "data/HAIKEI3.jpg",    # ハード
+}
+STAGE_BGM = {
+    "NORMAL": "data/BGM1.mp3",
+    "HARD": "data/BGM2.mp3",
+    "EASY": "data/BGM3.mp3",
+}
+# ステージ開始時に GameWorld が読み込む画像 (難易度選択中に先読みする)
+STAGE_IMAGES = (PLAYER_IMAGE, BOSS_IMAGE, ITEM_IMAGE, PLAYER_BULLET_IMAGE, LASER_IMAGE,
+                *ENEMY_BULLET_IMAGES.values(), DELAYED_LASER_WARN_IMAGE, DELAYED_LASER_ACTIVE_IMAGE)
+EX_BACKGROUND = "data/HAIKEI4.jpg"
+EX_BGM = "data/BGM4.mp3"
+
+
+def main(seed: int | None = None, record_path: str | None = None, autopilot: bool = False):
     """
     ゲームのメイン関数
+    seed: 弾幕の乱数のシード (None ならランダム)
+    record_path: 指定すると通常ステージのプレイをリプレイとして保存する
+    autopilot: True なら自機を DodgeBot で自動操作する (F6 で切り替え)
     """
     pg.init()
     # mixer 初期化は環境によって失敗する可能性があるため try/except 推奨
@@ -1236,16 +4177,12 @@ def main():
     screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     pg.display.set_caption("某弾幕シューティング風ボスステージ (EX Stage 追加)")
     clock = pg.time.Clock()
+    # ゲームは60Hz固定で進め、描画だけ高リフレッシュレートのディスプレイに合わせる
+    timestep = FixedTimestep()
 
 
-    try:
-        # 効果音の読み込みs
-        se_hit = pg.mixer.Sound("data/se_hit.wav") #
-        se_graze = pg.mixer.Sound("data/se_graze.wav")
-        se_bomb = pg.mixer.Sound("data/8bit_read2.mp3")
-        se_powerup = pg.mixer.Sound("data/8bit_read2.mp3")
-    except (pg.error, FileNotFoundError):
-        print("Warning: BGMまたは効果音ファイルが見つかりません。")
+    # 効果音は起動時に1回だけ読み込み、全てのステージで使い回す
+    sounds = SoundManager()
 
     # ゲーム変数
     # 難易度管理クラスをインスタンス化
@@ -1254,339 +4191,194 @@ def main():
     game_state = "difficulty_select"  # 起動時に難易度選択から開始
     running = True
 
-    # スプライトグループの作成
-    all_sprites = pg.sprite.Group()
-    player_bullets = pg.sprite.Group()
-    enemy_bullets = pg.sprite.Group()
-    items = pg.sprite.Group()
-
-    # ゲーム変数
-    score = 0
     current_difficulty = "NORMAL" # デフォルト難易度
-    player = None # player が未定義の可能性があるため None で初期化
-    boss = None # boss が未定義の可能性があるため None で初期化
+    start_difficulty: str | None = None  # 決定した難易度 (先読みが終わるまで開始を待つ)
+    start_ex = False  # EX 突入の指示 (先読みが終わるまで突入を待つ)
+    world: GameWorld | None = None # 通常ステージの進行 (難易度決定時に生成)
+    background_image = None
 
     ex_background_image = None #EX背景画像をここで初期化
-
-    # EX 関連タイマー
-    transition_timer = 0 # EX_STAGE クラスが管理
-    transition_duration = 60  # EX_STAGE クラスが管理
-
     ex_stage_manager = None
+    recorder: ReplayRecorder | None = None  # リプレイ記録 (record_path 指定時のみ)
+    overlay = ProfilerOverlay()  # F3: 処理時間のオーバーレイ, F4: CSV 保存
+    renderer = DirtyRenderer()  # プレイ中の差分描画 (F5 で全体描画と切り替え)
+    gc_policy = GcPolicy()  # プレイ中は GC を止め、演出・リザルト画面で回収する
+    governor = QualityGovernor()  # 処理が重い時は描画品質を落とす (難易度の設定の quality)
+    bot = DodgeBot(seed) if autopilot else None  # 自動操作 (None ならキーボードで操作)
 
-    # アイテム生成タイマー
-    item_spawn_interval = 5000  # 5秒
-    last_item_spawn = pg.time.get_ticks()
-
-    # ボム関連の変数
-    bombs = 3 # 残りボム数
-    bomb_active_area: BombArea | None = None # 現在アクティブなボムエリア
-    
+    # 次のティックで処理するキー入力 (描画フレームとティックがずれても取りこぼさない)
+    pending_pressed: set[int] = set()
+    pending_events: list[pg.event.Event] = []
 
     # メインループ
     while running:
+        frame_start = time.perf_counter()
+        profiler = overlay.profiler  # オーバーレイを表示していない時は None
+        if profiler:
+            profiler.start()
         events = pg.event.get()
         
         # イベント処理
         for event in events:
             if event.type == pg.QUIT:
                 running = False
+
+            # プロファイラ (どの画面でも使える)
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                overlay.toggle()
+                profiler = overlay.profiler
+                continue
+            if event.type == pg.KEYDOWN and event.key == pg.K_F4:
+                path = overlay.dump_csv()
+                if path:
+                    print(f"プロファイルを保存しました: {path}")
+                continue
+            if event.type == pg.KEYDOWN and event.key == pg.K_F5:
+                renderer.enabled = not renderer.enabled
+                renderer.invalidate()
+                continue
+            if event.type == pg.KEYDOWN and event.key == pg.K_F6:
+                bot = None if bot is not None else DodgeBot(seed)
+                continue
             
             # 難易度変更関連のイベント処理
             next_state, selected_diff = level_manager.handle_event(event, game_state)
             
             # "playing_start" シグナルを受け取った場合
+            # (背景と BGM の先読みが終わったフレームでステージを始める)
             if next_state == "playing_start" and game_state == "difficulty_select":
-                current_difficulty = selected_diff
-                
-                # スプライトグループを初期化
-                all_sprites = pg.sprite.Group()
-                player_bullets = pg.sprite.Group()
-                enemy_bullets = pg.sprite.Group()
-                items.empty() # アイテムもクリア
-                
-                # インスタンスを生成 (難易度を渡す)
-                player = Player(current_difficulty)
-                boss = Boss(current_difficulty)
-                all_sprites.add(player, boss) # PlayerとBossもGroupに追加
-
-                try:
-                    if current_difficulty == "NORMAL":
-                        background_image = pg.image.load("data/HAIKEI1.png").convert()
-                        # 画面サイズに合わせて背景画像をスケール (必要に応じて)ノマ
-                        # self.imageはSpriteの属性なので、ここでは直接screenに描画する
-                        background_image = pg.transform.scale(background_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
-
-                    elif current_difficulty == "EASY":
-                        background_image = pg.image.load("data/HAIKEI2.jpg").convert()
-                        # 画面サイズに合わせて背景画像をスケール (必要に応じて)イージー
-                        # self.imageはSpriteの属性なので、ここでは直接screenに描画する
-                        background_image = pg.transform.scale(background_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
-
-                    elif current_difficulty == "HARD":
-                        background_image = pg.image.load("data/HAIKEI3.jpg").convert()
-                        # 画面サイズに合わせて背景画像をスケール (必要に応じて)ハード
-                        # self.imageはSpriteの属性なので、ここでは直接screenに描画する
-                        background_image = pg.transform.scale(background_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
-
-                    
-                except pg.error as e:
-                    print(f"背景画像の読み込みに失敗しました: {e}")
-                    # 失敗した場合、黒い背景を使用
-                    background_image = None
-
-                # BGMと効果音を None で初期化
-                se_hit = None
-                se_graze = None
-                se_bomb = None #Noneで初期化
-                se_powerup = None #Noneで初期化
-
-                try:
-                    if current_difficulty == "NORMAL":
-                        # BGM の読み込みと再生 (無限ループ)ノマ
-                        pg.mixer.music.load("data/BGM1.mp3")
-                        pg.mixer.music.play(loops=-1) 
-
-                    elif current_difficulty == "HARD":
-                        # BGM の読み込みと再生 (無限ループ)ハード
-                        pg.mixer.music.load("data/BGM2.mp3")
-                        pg.mixer.music.play(loops=-1) 
-
-                    elif current_difficulty == "EASY":
-                        # BGM の読み込みと再生 (無限ループ)イージー
-                        pg.mixer.music.load("data/BGM3.mp3")
-                        pg.mixer.music.play(loops=-1) 
-
-                except pg.error as e:
-                    print(f"bgmの読み込みに失敗しました: {e}")
-                    # 失敗した場合、黒い背景を使用
-                    background_image = None
-                
-                score = 0
-                bombs = 3 # ボム数をリセット
-                bomb_active_area = None # ボムエリアをリセット
-                game_state = "playing"  # 状態を "playing" に確定
+                start_difficulty = selected_diff
                 continue  # 次のイベント処理をスキップ
             
             game_state = next_state # 状態を更新
             
             # その他のイベント処理
             if game_state == "playing":
-                # プレイヤー復活処理
-                if player and player.is_respawning and event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
-                    player.respawn()
-
-                # Tabキーでボム使用 (resultsから移動)
-                if event.type == pg.KEYDOWN and event.key == pg.K_TAB:
-                    # ボムが残っていて、かつ、現在アクティブなボムがない時のみ発動
-                    if player and bombs > 0 and bomb_active_area is None:
-                        bombs -= 1
-                        bomb_active_area = BombArea(player.rect.center)
-                        if se_bomb:
-                            # 効果音は音量が大きくなりがちなので、適宜音量調整を入れる
-                            se_bomb.set_volume(0.5) 
-                            se_bomb.play()
+                # 復活 (SPACE) とボム (TAB) は次のティックで処理する
+                if event.type == pg.KEYDOWN and event.key in (pg.K_SPACE, pg.K_TAB):
+                    pending_pressed.add(event.key)
 
             elif game_state == "results":
-                # クリア画面での操作: SPACE で終了、CTRL で EX 突入
+                # クリア画面での操作: SPACE で終了、CTRL で EX 突入 (突入を待っている間は SPACE で終了しない)
                 if event.type == pg.KEYDOWN:
-                    if event.key == pg.K_SPACE:
+                    if event.key == pg.K_SPACE and not start_ex:
                         running = False
                     if event.key == pg.K_LCTRL or event.key == pg.K_RCTRL:
-                        # EX 突入準備
-                        # (各オブジェクトが None でないことを確認)
-                        if screen and player and boss and all_sprites is not None and \
-                           player_bullets is not None and enemy_bullets is not None:
-                            
-                            ex_stage_manager = EX_STAGE(screen, player, boss, all_sprites, player_bullets, enemy_bullets, se_hit, se_graze, se_bomb, bombs, ex_background_image) # se_bomb, bombs を渡す
-                            ex_stage_manager.start()
-                            game_state = "ex_stage" # メインの状態を EX に移行
-
-                            
-                            try:
-                                if game_state == "ex_stage":
-                                    pg.mixer.music.load("data/BGM4.mp3")
-                                    pg.mixer.music.play(loops=-1)
-                            except pg.error:
-                                    print("Warning: EXステージBGMが見つかりません。")
-
-                                # 追加: EXステージ背景の設定
-                            try:
-                                # メイン関数の描画ループで使用する background_image 変数を上書き
-                                ex_background_image = pg.image.load("data/HAIKEI4.jpg").convert()
-                                ex_background_image = pg.transform.scale(ex_background_image, (SCREEN_WIDTH, SCREEN_HEIGHT))
-                       
-                            except pg.error as e:
-                                    print(f"EX背景画像の読み込みに失敗しました: {e}")
-
-                            ex_stage_manager = EX_STAGE(screen, player, boss, all_sprites, player_bullets, enemy_bullets, se_hit, se_graze, se_bomb, bombs, ex_background_image) 
-                            ex_stage_manager.start()
-                            game_state = "ex_stage"
+                        # EX 突入準備 (EX の背景と BGM の先読みが終わったフレームで突入する)
+                        start_ex = True
 
             elif game_state == "game_over":
                 # ゲームオーバー画面でSPACEキーを押したら終了
                 if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
                     running = False
 
+            elif game_state == "ex_stage":
+                pending_events.append(event)
+
+        # 難易度決定後: 背景・BGM・画像が揃ったらステージを生成して開始する
+        if start_difficulty is not None and game_state == "difficulty_select" and ASSETS.prefetch(
+                [STAGE_BACKGROUNDS[start_difficulty]], [STAGE_BGM[start_difficulty]], STAGE_IMAGES):
+            current_difficulty = start_difficulty
+            start_difficulty = None
+
+            # 背景画像 (画面サイズにスケール済み、失敗した場合は None で黒い背景を使用)
+            # self.imageはSpriteの属性なので、ここでは直接screenに描画する
+            background_image = ASSETS.background(STAGE_BACKGROUNDS[current_difficulty])
+
+            try:
+                # BGM の読み込みと再生 (無限ループ)
+                ASSETS.load_music(STAGE_BGM[current_difficulty])
+                pg.mixer.music.play(loops=-1)
+            except pg.error as e:
+                print(f"bgmの読み込みに失敗しました: {e}")
+                # 失敗した場合、黒い背景を使用
+                background_image = None
+
+            # ステージを生成 (自機・ボス・弾・スコア・ボムを初期化)
+            world = GameWorld(current_difficulty, seed=seed, sounds=sounds)
+            world.background_image = background_image
+            recorder = ReplayRecorder(world) if record_path else None
+            # 選ばなかった難易度の背景・BGM など、先読みしたが使わなかった分を片付ける
+            ASSETS.settle_prefetch()
+            governor.configure(world.settings["quality"])
+            renderer.invalidate()
+            pending_pressed.clear()
+            timestep.reset()
+            game_state = "playing"  # 状態を "playing" に確定
+
+        # クリア後: EX の背景と BGM が揃ったら EX に突入する
+        if start_ex and game_state == "results" and ASSETS.prefetch([EX_BACKGROUND], [EX_BGM]):
+            start_ex = False
+            # (各オブジェクトが None でないことを確認)
+            if screen and world is not None:
+                try:
+                    ASSETS.load_music(EX_BGM)
+                    pg.mixer.music.play(loops=-1)
+                except pg.error:
+                    print("Warning: EXステージBGMが見つかりません。")
+
+                # 追加: EXステージ背景の設定
+                ex_background_image = ASSETS.background(EX_BACKGROUND)
+
+                ex_stage_manager = EX_STAGE(screen, world, ex_background_image) # 通常ステージの world (残りボム数なども) を引き継ぐ
+                ex_stage_manager.start()
+                ASSETS.settle_prefetch()
+                governor.configure(world.settings["quality"], ex=True)
+                pending_events.clear()
+                timestep.reset()
+                game_state = "ex_stage" # メインの状態を EX に移行
+
+        # 通常ステージ・EXステージのプレイ中だけ GC を止める
+        playing = game_state == "playing" or (
+            game_state == "ex_stage" and ex_stage_manager is not None and ex_stage_manager.internal_state == "playing")
+        gc_policy.update(playing)
+
         if game_state == "playing":
-            # Player や Boss が None の可能性 (初期化前) があるのでチェック
-            if player is None or boss is None:
+            # world が None の可能性 (初期化前) があるのでチェック
+            if world is None:
                  game_state = "difficulty_select" # 初期化されてないなら選択画面に戻る
                  continue
-            now = pg.time.get_ticks()
-            if now - last_item_spawn > item_spawn_interval:
-                last_item_spawn = now
-                # 画面上部のランダムな位置に生成
-                spawn_x = random.randint(50, SCREEN_WIDTH - 50)
-                spawn_y = -20
-                new_item = PowerItem((spawn_x, spawn_y))
-                items.add(new_item)
-
-            # 更新処理
-            keys = pg.key.get_pressed()
-            
-            # player.update は引数が特殊なので個別に呼ぶ
-            player.update(keys, player_bullets, boss) 
-            # boss.update も引数が特殊なので個別に呼ぶ
-            if boss.is_active:
-                boss.update(enemy_bullets, player.rect.center) # 引数を enemy_bullets に修正
-
-            # all_sprites.update() # PlayerとBossは個別Updateしたので不要
-            player_bullets.update()
-            items.update()
-
-            # アイテム取得判定
-            collected_items = pg.sprite.spritecollide(player, items, True)
-            if collected_items:
-                for item in collected_items:
-                    player.add_power_item()
-                if se_powerup:
-                    se_powerup.play()
-            
-            # ボムの更新と敵弾消去
-            if bomb_active_area is not None:
-                bomb_active_area.update(player.rect.center)
-                # 範囲内の弾を消去し、スコア加算
-                killed_bullets = bomb_active_area.check_collision_and_kill(enemy_bullets)
-                score += killed_bullets * 1 # ボムで消した弾は1点
-                
-                if not bomb_active_area.is_active:
-                    bomb_active_area = None # ボム終了
-
-            # 敵弾の更新 (画面外に出た弾を消去し、スコア加算)
-            avoided_bullets_score = 0
-            for bullet in list(enemy_bullets): # list() でコピーを作成してイテレート
-                bullet.update() # 敵弾のupdateを呼び出す
-                if not screen.get_rect().colliderect(bullet.rect):
-                    bullet.kill()
-                    # 弾を1つ避けきったらスコア1UP
-                    avoided_bullets_score += 1
-            score += avoided_bullets_score
-
-            # 当たり判定
-
-            # 自機弾 vs ボス
-            hits = pg.sprite.spritecollide(boss, player_bullets, True)
-            if hits:
-                # 1ダメージ = 1ヒットとして処理
-                total_damage = sum(bullet.damage for bullet in hits)
-                boss.hit(total_damage)
-                # 1ダメージにつきスコア1UP
-                score += total_damage
-
-            # 敵弾 vs 自機 (被弾 & GRAZE)
-            if not player.is_respawning:
-                
-                # GRAZE (かすり) 判定 (grazebox との衝突)
-                graze_list = pg.sprite.spritecollide(player, enemy_bullets, False, lambda p, b: p.grazebox.colliderect(b.rect))
-                
-                for bullet in graze_list:
-                    # 置きレーザーが 'warning' 状態なら判定しない
-                    if isinstance(bullet, EnemyDelayedLaser) and bullet.state != "active":
-                        continue
-
-                    if not bullet.grazed:
-                        # hitbox とは当たっていないことを確認
-                        if not player.hitbox.colliderect(bullet.rect):
-                            score += 20 # GRAZEスコア20
-                            bullet.grazed = True
-
-                # 被弾判定 (hitbox)
-                hit_bullets = pg.sprite.spritecollide(player, enemy_bullets, False, lambda p, b: p.hitbox.colliderect(b.rect))
-
-                # 置きレーザーの 'warning' 状態を除外
-                active_hit_bullets = []
-                for bullet in hit_bullets:
-                    if isinstance(bullet, EnemyDelayedLaser) and bullet.state != "active":
-                        continue
-                    active_hit_bullets.append(bullet)
-
-                if active_hit_bullets:
-                    if se_hit:
-                        se_hit.play()
-                    
-                    player.hit() # 残機を減らし、無敵状態へ
-                    
-                    # 画面上の敵弾を全消去
-                    for bullet in list(enemy_bullets):
-                        bullet.kill()
-                    
-                    if player.lives <= 0:
-                        game_state = "game_over"
-
-            # ステージ移行判定
-            if boss.check_skill_transition():
-                # 移行時に弾幕を消去
-                for bullet in list(enemy_bullets):
-                    bullet.kill()
-                
-                # ステージ移行時にボムエリアを強制終了
-                bomb_active_area = None 
-                
-                if not boss.is_active:
-                    game_state = "results"  # リザルト画面に移行
-
-            # 描画処理
-            
-            if background_image:
-                screen.blit(background_image, (0, 0)) # 背景画像を描画
-            else:
-                screen.fill(BLACK) # 背景画像がなければ黒で塗りつぶす
-            
-            # all_sprites.draw(screen) # PlayerとBossも描画
-            # Player, Boss を all_sprites に入れた場合の描画
-            for sprite in all_sprites:
-                 if isinstance(sprite, Player) and not sprite.is_visible:
-                     pass # 点滅中は描画しない
-                 else:
-                     screen.blit(sprite.image, sprite.rect)
-
-            player_bullets.draw(screen)
-            enemy_bullets.draw(screen)
-            items.draw(screen)
-            
-            # ボムエリアの描画
-            if bomb_active_area is not None:
-                bomb_active_area.draw(screen)
-
-            # UIの描画
-            draw_ui(screen, score, player.lives, boss, bombs) # bombsを渡す
 
-            # 復活待機中の表示
-            if player.is_respawning:
-                font = pg.font.Font(None, 40)
-                text = font.render("Press SPACE to Respawn", True, WHITE)
-                screen.blit(text, (SCREEN_WIDTH // 2 - text.get_width() // 2, SCREEN_HEIGHT // 2 + 100))
+            if profiler:
+                profiler.lap("events")
+            world.profiler = profiler
 
-            pg.display.flip()
+            # 経過時間分だけ60Hzのティックを進める
+            keys = pg.key.get_pressed()
+            for _ in range(timestep.advance()):
+                if bot is not None:
+                    # 自動操作: キーボードの代わりに DodgeBot の入力を Player.update に渡す
+                    keys, bot_pressed = bot(world)
+                    pending_pressed |= bot_pressed
+                if recorder is not None:
+                    game_state = recorder.tick(keys, pending_pressed)
+                else:
+                    game_state = world.tick(keys, pending_pressed)
+                pending_pressed.clear()
+                if game_state != "playing":
+                    break
+
+            # 描画処理 (前後のティックの間を補間、背景は前のフレームで描いた範囲だけ塗り直す)
+            drawn = world.draw(screen, timestep.alpha, renderer)
+            drawn += overlay.draw(screen)
+            if profiler:
+                profiler.start()
+            renderer.present(drawn)
+            if profiler:
+                profiler.lap("flip")
+            overlay.end_frame(len(world.enemy_bullets))
 
         elif game_state == "results":
+            # EX に突入するかもしれないので EX の背景と BGM を先読みしておく
+            ASSETS.prefetch([EX_BACKGROUND], [EX_BGM])
             # リザルト画面描画
-            if boss: # bossがNoneでないことを確認
-                draw_results(screen, boss.clear_times)
+            if world is not None: # worldがNoneでないことを確認
+                draw_results(screen, world.boss.clear_times)
             pg.display.flip() 
         
         elif game_state == "difficulty_select":
+            # どの難易度を選んでもすぐ始められるように、全ステージの背景・BGM・画像を先読みしておく
+            ASSETS.prefetch(STAGE_BACKGROUNDS.values(), STAGE_BGM.values(), STAGE_IMAGES)
             # 難易度選択画面描画 (内部でflip)
             level_manager.draw(screen)
         
@@ -1600,28 +4392,182 @@ def main():
                 game_state = "difficulty_select"
                 continue
 
+            if profiler:
+                profiler.lap("events")
+            ex_stage_manager.world.profiler = profiler
+
             keys = pg.key.get_pressed()
             
-            # EXマネージャを更新し、次のメイン状態を受け取る
-            next_main_state = ex_stage_manager.update(keys, events) 
-            game_state = next_main_state
+            # EXマネージャをティック数分更新し、次のメイン状態を受け取る
+            for _ in range(timestep.advance()):
+                if bot is not None:
+                    keys, bot_pressed = bot(ex_stage_manager.world)
+                    pending_events += [pg.event.Event(pg.KEYDOWN, key=key) for key in bot_pressed]
+                game_state = ex_stage_manager.update(keys, pending_events)
+                pending_events.clear()
+                if game_state != "ex_stage":
+                    break
             
             if game_state == "ex_stage":
-                if background_image:
-                    screen.blit(background_image, (0, 0)) # 背景画像を描画
-                else:
-                    screen.fill(BLACK) # 背景画像がなければ黒で塗りつぶす
-                # EX継続なら描画
-                ex_stage_manager.draw()
-                pg.display.flip() 
+                # EX継続なら描画 (演出・リザルト中は画面全体を描くので None が返る)
+                drawn = ex_stage_manager.draw(timestep.alpha, renderer)
+                overlay_drawn = overlay.draw(screen)
+                if profiler:
+                    profiler.start()
+                renderer.present(None if drawn is None else drawn + overlay_drawn)
+                if profiler:
+                    profiler.lap("flip")
+                overlay.end_frame(len(ex_stage_manager.enemy_bullets))
             
             elif game_state == "quit":
                 # EXマネージャが終了を通知
                 running = False
             
-        clock.tick(FPS)
+        # このフレームのティックで予約された効果音をまとめて鳴らす
+        sounds.flush()
+
+        # 通常ステージが終わったらリプレイを保存する
+        if recorder is not None and game_state != "playing":
+            save_recording(recorder, record_path)
+            recorder = None
+
+        # プレイ中のフレームの処理時間から描画品質を決め、次のフレームから使う
+        if playing and world is not None:
+            governor.record((time.perf_counter() - frame_start) * 1000)
+            governor.apply(world)
+
+        # 描画フレームの上限 (ゲームの進行速度は timestep が決める)
+        clock.tick(MAX_RENDER_FPS)
+    if recorder is not None:
+        save_recording(recorder, record_path)
+    ASSETS.shutdown()
     pg.quit()
     sys.exit()
     
+def parse_value(text: str):
+    """ コマンドラインの値を int / float / 文字列に変換する """
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def run_cli(argv: list[str]) -> int:
+    """
+    開発用コマンド (python Koka_Project.py <command> ...)
+    """
+    parser = argparse.ArgumentParser(prog="Koka_Project.py", description="工科Project 開発用コマンド")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sweep = commands.add_parser("sweep", help="難易度設定を変えながらボス戦をヘッドレスで並列実行する")
+    sweep.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2,...",
+                       help='変える設定と値の候補 (例: "skill_pattern_3.p1_freq=30,50,70")。複数指定で直積')
+    sweep.add_argument("--difficulty", default="NORMAL", help="難易度 (カンマ区切りで複数)")
+    sweep.add_argument("--seeds", type=int, default=1, help="条件ごとに回すシードの数")
+    sweep.add_argument("--ex", action="store_true", help="EXステージ (ex_pattern_final) を実行する")
+    sweep.add_argument("--policy", choices=sorted(POLICIES), default="random", help="自機の操作方法")
+    sweep.add_argument("--max-seconds", type=float, default=300, help="1回あたりの最大ゲーム時間 (秒)")
+    sweep.add_argument("--processes", type=int, default=None, help="ワーカープロセス数 (既定: CPU数)")
+    sweep.add_argument("--out", help="結果を保存する CSV ファイル")
+
+    bench = commands.add_parser("bench", help="決まったシナリオでフレーム時間を計測し、基準と比べる")
+    bench.add_argument("--scenario", action="append", choices=sorted(BENCH_SCENARIOS),
+                       help="実行するシナリオ (複数指定可、既定: 全て)")
+    bench.add_argument("--seconds", type=float, default=20, help="シナリオごとの計測時間 (ゲーム内の秒)")
+    bench.add_argument("--seed", type=int, default=0, help="弾幕と自機操作の乱数のシード")
+    bench.add_argument("--render", choices=("dirty", "full"), default="dirty",
+                       help="描画方法 (dirty: 差分描画, full: 毎フレーム画面全体)")
+    bench.add_argument("--gc", choices=("stage", "auto"), default="stage",
+                       help="GC (stage: プレイ中は止めて画面の切り替えで回収, auto: Python の自動 GC のまま)")
+    bench.add_argument("--baseline", metavar="PATH", help="比較する基準の結果 (JSON)")
+    bench.add_argument("--threshold", type=float, default=0.20,
+                       help="基準よりこの割合だけ遅くなったら性能低下とみなす (既定: 0.20 = 20%%)")
+    bench.add_argument("--save", metavar="PATH", help="結果を JSON で保存する (新しい基準にする場合は --baseline と同じパス)")
+
+    play = commands.add_parser("play", help="シードを固定してゲームを起動する (リプレイの記録)")
+    play.add_argument("--seed", type=int, default=None, help="弾幕の乱数のシード")
+    play.add_argument("--record", metavar="PATH", help="通常ステージのプレイをリプレイとして保存する")
+    play.add_argument("--autopilot", action="store_true", help="自機を敵弾を避ける自動操作にする (F6 で切り替え)")
+
+    replay = commands.add_parser("replay", help="記録したリプレイを再生する")
+    replay.add_argument("path", help="リプレイファイル")
+    replay.add_argument("--speed", type=float, default=1.0, help="再生速度 (倍)")
+    replay.add_argument("--seek", type=float, default=0.0, help="再生を始める位置 (秒)")
+    replay.add_argument("--verify", action="store_true",
+                        help="描画せずに最後まで再生し、チェックサムのずれ (デシンク) を調べる")
+
+    bundle = commands.add_parser("build-bundle", help="スケール済みの画像をまとめたバンドルを作る (起動・ステージ開始を速くする)")
+    bundle.add_argument("--out", default=BUNDLE_PATH, help=f"出力するファイル (既定: {BUNDLE_PATH})")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "sweep":
+        grid = {}
+        for param in args.param:
+            name, sep, values = param.partition("=")
+            if not sep or not values:
+                sweep.error(f"--param は NAME=V1,V2,... の形で指定してください: {param}")
+            grid[name] = [parse_value(v) for v in values.split(",")]
+        # 設定名の確認 (ワーカーを起動する前に、不明な名前を argparse の選択肢の誤りと同じ形で報告する)
+        try:
+            difficulty_settings("NORMAL", {name: values[0] for name, values in grid.items()})
+        except KeyError as e:
+            sweep.error(e.args[0])
+        rows = run_sweep(grid, args.difficulty.split(","), range(args.seeds), args.ex, args.policy,
+                         int(args.max_seconds * FPS), args.processes)
+        print_table(rows)
+        if args.out:
+            write_csv(rows, args.out)
+
+    elif args.command == "bench":
+        baseline = None
+        if args.baseline and os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        results = {name: run_benchmark(name, args.seconds, args.seed, dirty=args.render == "dirty",
+                                       gc_control=args.gc == "stage")
+                   for name in args.scenario or BENCH_SCENARIOS}
+        print_benchmarks(results)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump({"seconds": args.seconds, "seed": args.seed, "render": args.render, "scenarios": results},
+                          f, indent=2)
+        if baseline is not None:
+            regressions = compare_benchmarks(results, baseline["scenarios"], args.threshold)
+            for line in regressions:
+                print(f"性能低下: {line}")
+            if regressions:
+                return 1
+            print(f"基準 ({args.baseline}) からの性能低下はありません")
+
+    elif args.command == "play":
+        main(args.seed, args.record, args.autopilot)
+
+    elif args.command == "build-bundle":
+        init_headless()
+        keys = AssetBundle.build(args.out, list(STAGE_IMAGES),
+                                 [*STAGE_BACKGROUNDS.values(), EX_BACKGROUND])
+        print(f"{args.out}: {len(keys)} 枚 ({os.path.getsize(args.out) / 1024 / 1024:.1f} MB)")
+        for path, size, alpha in keys:
+            print(f"  {path} {size[0]}x{size[1]}{'' if alpha else ' (背景)'}")
+
+    elif args.command == "replay":
+        if not args.verify:
+            play_replay(args.path, args.speed, args.seek)
+            return 0
+        init_headless()
+        replay_data = Replay.load(args.path)
+        desync_tick = ReplayPlayer(replay_data).verify()
+        if desync_tick is not None:
+            print(f"デシンク: {desync_tick} ティック目 ({desync_tick / FPS:.2f}秒)")
+            return 1
+        print(f"OK: {len(replay_data)} ティック ({len(replay_data) / FPS:.1f}秒), キーフレーム {len(replay_data.keyframes)} 個")
+    return 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
\ No newline at end of file